@@ -29,6 +29,8 @@ parser.set_defaults(contour_source='manual')
 
 parser.add_argument('--do-bet',dest='do_extract_brain',action='store_true',default=False,help='extract brain with HD-BET (default = False)')
 
+parser.add_argument('--jobs',dest='jobs',help='number of (subject, session) units to run in parallel (default = 1)',default=1,type=int)
+
 args = parser.parse_args()
 test_one = args.test_one
 start_from = args.start_from
@@ -41,6 +43,7 @@ contour_source = args.contour_source
 
 do_extract_brain = args.do_extract_brain
 
+jobs = args.jobs
 
 ## declare script options
 ##test_one = True # test one subject?
@@ -73,12 +76,12 @@ if start_from:
 
 if do_align:
     # align scans for each subject
-    align_volumes(dirs,subjects,ref_names_only=ref_names_only)
+    align_volumes(dirs,subjects,ref_names_only=ref_names_only,jobs=jobs)
 
 if do_propagate_contours:
     # propagate contours to reference session for each subject
-    propagate_contours(dirs,subjects,source=contour_source)
+    propagate_contours(dirs,subjects,source=contour_source,jobs=jobs)
 
 if do_extract_brain:
     # call HD-BET to extract brain
-    extract_brain(dirs,subjects)
+    extract_brain(dirs,subjects,jobs=jobs)
@@ -2,18 +2,20 @@
 from utils.preproc.project_parameters import get_bids_layout, declare_directories
 from utils.preproc.flirt_utils import flirt_volumes
 from utils.preproc.io import func_msg
+from utils.preproc.parallel import unit, run_units
 from os.path import join, isdir, basename, isfile
 import os
 import pandas as pd
 from pathlib import Path
 import json
 
-def align_volumes(dirs,subjects,ref_names_only=False):
+def align_volumes(dirs,subjects,ref_names_only=False,jobs=1):
     '''Aligns scans for each patient over sessions
     Parameters:
         dirs: dictionary of directories
         subjects: list of subjects
         ref_names_only: if True, will only grab reference names and write to .csv file
+        jobs: number of (subject, session) units to run in parallel
     '''
 
     # communicate with user
@@ -28,6 +30,10 @@ def align_volumes(dirs,subjects,ref_names_only=False):
     # declare list to hold reference name
     rows = []
 
+    # declare lists of (subject, session) units; reference sessions are run before the others
+    units_ref = []
+    units = []
+
     # loop subjects
     for subject in subjects:
 
@@ -63,38 +69,13 @@ def align_volumes(dirs,subjects,ref_names_only=False):
                         src_fnames = src_fnames + fname_dict['dwi']
 
                     if session == ref_session:
-                        out_dir = join(out_parent,'anat')
-                        if not isdir(out_dir):
-                            os.mkdir(out_dir)
-                        # symlink to reference volume and remove from list of volumes to register
-                        ref_bits = ref_name.split('_')
-                        ref_bits.insert(len(ref_bits)-1,'desc-coreg')
-                        tgt_fname = os.path.join(out_dir,'_'.join(ref_bits)+'.nii.gz')
-                        if not isfile(tgt_fname):
-                            os.symlink(ref_fname,tgt_fname)
-                        src_fnames.remove(ref_fname)
-
-                        create_coreg_json(tgt_fname,ref_fname)
-
-                        # rename volume and create .json sidecar
-#                        proc_coreg_for_bids(ref_fname,ref_fname,tgt_fname)
-
-                    for src_fname in src_fnames:
-                        # get datatype and create output directory
-                        datatype = Path(src_fname).parts[-2]
-                        out_dir = join(out_parent,datatype)
-                        if not isdir(out_dir):
-                            os.mkdir(out_dir)
-
-                        # register source volumes to reference volume one at a time
-                        coreg_fname = flirt_volumes(src_fname,ref_fname,[],suffix,out_dir,other_qform=True,overwrite=False,resample=2)
-
-                        create_coreg_json(coreg_fname,ref_fname)
-
-                        # rename co-registered volumes and create sidecar .json file, for BIDS convention
-                        #kproc_coreg_for_bids(src_fname,ref_fname,reg_fname)
-
+                        units_ref.append(unit(align_session,src_fnames,ref_fname,suffix,out_parent,is_reference=True))
+                    else:
+                        units.append(unit(align_session,src_fnames,ref_fname,suffix,out_parent))
 
+    # run reference sessions first, then all other sessions
+    run_units(units_ref,jobs=jobs)
+    run_units(units,jobs=jobs)
         
     # write list of reference names
     filename = join(dirs['proj'],'interim','subject_reference_list.csv')
@@ -106,6 +87,49 @@ def align_volumes(dirs,subjects,ref_names_only=False):
         print('List of reference volumes written: ' + filename)
     func_msg(func,'end')
 
+def align_session(src_fnames,ref_fname,suffix,out_parent,is_reference=False):
+    '''Registers the volumes of one session to the reference volume
+    Parameters:
+        src_fnames: filenames of source volumes
+        ref_fname: filename of reference volume
+        suffix: suffix for entity desc-
+        out_parent: output directory of session; volumes are written to datatype subfolders
+        is_reference: if True, session contains the reference volume, which is symlinked instead of registered
+    '''
+
+    if is_reference:
+        out_dir = join(out_parent,'anat')
+        if not isdir(out_dir):
+            os.mkdir(out_dir)
+        # symlink to reference volume and remove from list of volumes to register
+        ref_name = basename(ref_fname).replace('.nii.gz','')
+        ref_bits = ref_name.split('_')
+        ref_bits.insert(len(ref_bits)-1,'desc-coreg')
+        tgt_fname = os.path.join(out_dir,'_'.join(ref_bits)+'.nii.gz')
+        if not isfile(tgt_fname):
+            os.symlink(ref_fname,tgt_fname)
+        src_fnames = [x for x in src_fnames if x != ref_fname]
+
+        create_coreg_json(tgt_fname,ref_fname)
+
+        # rename volume and create .json sidecar
+#        proc_coreg_for_bids(ref_fname,ref_fname,tgt_fname)
+
+    for src_fname in src_fnames:
+        # get datatype and create output directory
+        datatype = Path(src_fname).parts[-2]
+        out_dir = join(out_parent,datatype)
+        if not isdir(out_dir):
+            os.mkdir(out_dir)
+
+        # register source volumes to reference volume one at a time
+        coreg_fname = flirt_volumes(src_fname,ref_fname,[],suffix,out_dir,other_qform=True,overwrite=False,resample=2)
+
+        create_coreg_json(coreg_fname,ref_fname)
+
+        # rename co-registered volumes and create sidecar .json file, for BIDS convention
+        #kproc_coreg_for_bids(src_fname,ref_fname,reg_fname)
+
 def get_sessions(layout,subject):
     '''Returns a list of sessions for a given subject
     Parameters:
@@ -4,19 +4,22 @@ import os
 from utils.preproc.project_parameters import get_reference_list, declare_directories, get_bids_layout
 from utils.preproc.propagate_contours import get_bids_relative
 from utils.preproc.align_volumes import get_reference_fname
+from utils.preproc.parallel import unit, run_units
 from os.path import basename, dirname
 
-def extract_brain(dirs,subjects):
+def extract_brain(dirs,subjects,jobs=1):
     '''Does brain extraction using HD-BET
     Parameters
         dirs: directories dictionary
         subjects: names of subjects
+        jobs: number of subjects to run in parallel
     '''
 
     # get parameters
     dirs = declare_directories()
     layout = get_bids_layout()
 #    df = get_reference_list()
+    units = []
 
     # Loop subjects
     for subject in subjects:
@@ -33,10 +36,13 @@ def extract_brain(dirs,subjects):
         # Declare path to T1w volume
         if os.path.isfile(t1_path): 
             # Call HD-BET
-            do_hdbet(t1_path,out_dir)
+            units.append(unit(do_hdbet,t1_path,out_dir))
         else:
             print('%s: T1w file not found' %(subject))
 
+    # run subjects
+    run_units(units,jobs=jobs)
+
 
 def create_json(t1_path):
     """Creates the .json sidecar for the brain mask
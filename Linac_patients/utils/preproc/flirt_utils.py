@@ -3,6 +3,27 @@ from os import remove
 import os
 from os.path import basename, join, isfile
 import subprocess
+import numpy as np
+import nibabel as nib
+from utils.preproc.fsl_matrix import concat_matrix_files, invert_matrix_file
+
+def extract_volume(fname,out_fname,index=0):
+    '''Returns a 3D volume for tools that need one: a 3D input as it is, or one volume of a 4D input written to out_fname
+    Parameters:
+        fname: input filename
+        out_fname: filename of extracted volume (e.g. .nii in a work directory)
+        index: index of volume along the 4th dimension
+    Notes:
+        - only the requested volume is read, by slicing the nibabel array proxy, so the other volumes are never written
+    '''
+    img = nib.load(fname)
+    if len(img.shape) == 3:
+        return fname
+    data = np.asanyarray(img.dataobj[(slice(None),)*3 + (index,) + (0,)*(len(img.shape)-4)])
+    header = img.header.copy()
+    header.set_data_dtype(data.dtype)
+    nib.save(nib.Nifti1Image(data,img.affine,header),out_fname)
+    return out_fname
 
 def flirt_apply(in_fnames,ref_fname,in2ref_fname,out_dir,suffix,overwrite=True,method='trilinear'):
     """Applies saved transformation from input to reference space
@@ -82,21 +103,13 @@ def flirt_propagate(in_fname,ref_fname,roi_fnames,suffix,out_dir,overwrite=True,
                     if isfile(out_fname) and not overwrite:
                         print('skipping resampling since iso volume already exists: ' + iso_fname)
                     else:
-                        # split volume
-                        spl = fsl.utils.Split()
-                        spl.inputs.in_file = fname
-                        spl.inputs.out_base_name = join(out_dir,name.replace('.nii.gz','_')) 
-                        spl.inputs.dimension = 't'
-                        print(spl.cmdline)
-                        spl_res = spl.run()
-                        if isinstance(spl_res.outputs.out_files,list):
-                            spl_fnames = spl_res.outputs.out_files
-                        else:
-                            spl_fnames = [spl_res.outputs.out_files]
+                        # extract first volume
+                        work_fname = join(out_dir,name.replace('.nii.gz','_0000.nii'))
+                        vol_fname = extract_volume(fname,work_fname,0)
 
                         # resample
                         iso = fsl.preprocess.FLIRT()
-                        iso.inputs.in_file = spl_fnames[0]
+                        iso.inputs.in_file = vol_fname
                         iso.inputs.reference = iso.inputs.in_file
                         iso.inputs.apply_isoxfm = 2
                         iso.inputs.out_file = iso_fname
@@ -104,9 +117,9 @@ def flirt_propagate(in_fname,ref_fname,roi_fnames,suffix,out_dir,overwrite=True,
                         print(iso.cmdline)
                         iso.run()
 
-                        # delete split volume files
-                        for spl_fname in spl_fnames:
-                            remove(spl_fname)
+                        # delete extracted volume
+                        if vol_fname == work_fname:
+                            remove(vol_fname)
             
                 # update source and reference names for registration
                 in_fname_reg = new_fnames[0]
@@ -148,13 +161,8 @@ def flirt_propagate(in_fname,ref_fname,roi_fnames,suffix,out_dir,overwrite=True,
 
             if inverse:
                 # invert transformation
-                invt = fsl.ConvertXFM()
-                invt.inputs.in_file = trans_matrix_fname
-                invt.inputs.invert_xfm = True
-                invt.inputs.out_file = in2ref_matrix_fname
-                print(invt.cmdline)
+                invert_matrix_file(trans_matrix_fname,in2ref_matrix_fname)
                 print()
-                invt.run()
 
     # apply transformation to ROIs
     for roi_fname in roi_fnames:
@@ -234,21 +242,13 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
                 if isfile(out_fname) and not overwrite:
                     print('skipping resampling since iso volume already exists: ' + iso_fname)
                 else:
-                    # split volume
-                    spl = fsl.utils.Split()
-                    spl.inputs.in_file = fname
-                    spl.inputs.out_base_name = join(out_dir,name.replace('.nii.gz','_')) 
-                    spl.inputs.dimension = 't'
-                    print(spl.cmdline)
-                    spl_res = spl.run()
-                    if isinstance(spl_res.outputs.out_files,list):
-                        spl_fnames = spl_res.outputs.out_files
-                    else:
-                        spl_fnames = [spl_res.outputs.out_files]
+                    # extract first volume
+                    work_fname = join(out_dir,name.replace('.nii.gz','_0000.nii'))
+                    vol_fname = extract_volume(fname,work_fname,0)
 
                     # resample
                     iso = fsl.preprocess.FLIRT()
-                    iso.inputs.in_file = spl_fnames[0]
+                    iso.inputs.in_file = vol_fname
                     iso.inputs.reference = iso.inputs.in_file
                     iso.inputs.apply_isoxfm = 2
                     iso.inputs.out_file = iso_fname
@@ -256,9 +256,9 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
                     print(iso.cmdline)
                     iso.run()
 
-                    # delete split volume files
-                    for spl_fname in spl_fnames:
-                        remove(spl_fname)
+                    # delete extracted volume
+                    if vol_fname == work_fname:
+                        remove(vol_fname)
         
             # update source and reference names for registration
             in_fname_reg = new_fnames[0]
@@ -348,14 +348,8 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
 
 
             # concatenate matrices
-            concat = fsl.ConvertXFM()
-            concat.inputs.in_file2 = in2ref_matrix_fname
-            concat.inputs.in_file = p1_matrix_fname
-            concat.inputs.concat_xfm = True
-            concat.inputs.out_file = out_matrix_fname
-            print(concat.cmdline)
+            concat_matrix_files(p1_matrix_fname,in2ref_matrix_fname,out_matrix_fname)
             print()
-            concat.run() 
 
             # apply transformation to volume
             applyxfm = fsl.preprocess.ApplyXFM()
@@ -0,0 +1,95 @@
+# functions to read, write and construct FLIRT transformation matrices (.mat files)
+#
+# FLIRT matrices map "scaled voxel" coordinates of the input to those of the reference: voxel indices
+# multiplied by the voxel dimensions, with the x-axis flipped when the voxel-to-world matrix has a
+# positive determinant (neurological storage order).
+
+import numpy as np
+
+def read_fsl_matrix(fname):
+    '''Returns the 4x4 matrix in a FLIRT .mat file
+    Parameters:
+        fname: filename of .mat file
+    '''
+    matrix = np.loadtxt(fname)
+    assert matrix.shape == (4,4), 'not a 4x4 FLIRT matrix: ' + fname
+    return matrix
+
+def write_fsl_matrix(fname,matrix):
+    '''Writes a 4x4 matrix as a FLIRT .mat file
+    Parameters:
+        fname: filename of .mat file
+        matrix: 4x4 matrix
+    '''
+    matrix = np.asarray(matrix,dtype=float)
+    assert matrix.shape == (4,4), 'matrix must be 4x4'
+    np.savetxt(fname,matrix,fmt='%.10f',delimiter='  ')
+
+def scaled_voxel_matrix(shape,zooms,affine):
+    '''Returns the matrix from voxel indices to FSL scaled-voxel coordinates
+    Parameters:
+        shape: shape of volume (only the first 3 dimensions are used)
+        zooms: voxel dimensions in mm (only the first 3 are used)
+        affine: 4x4 voxel-to-world matrix (sform or qform)
+    '''
+    vox2mm = np.diag(list(zooms[:3]) + [1.])
+    if np.linalg.det(affine[:3,:3]) > 0:
+        # flip x-axis for images stored in neurological order
+        flip = np.eye(4)
+        flip[0,0] = -1
+        flip[0,3] = shape[0] - 1
+        vox2mm = vox2mm @ flip
+    return vox2mm
+
+def fsl_vox2mm(img):
+    '''Returns the matrix from voxel indices to FSL scaled-voxel coordinates of a nibabel image
+    Parameters:
+        img: nibabel image
+    '''
+    return scaled_voxel_matrix(img.shape,img.header.get_zooms(),img.affine)
+
+def world_matrix(in_img,ref_img):
+    '''Returns the FLIRT matrix that aligns input and reference according to their headers (as flirt -usesqform)
+    Parameters:
+        in_img: input nibabel image
+        ref_img: reference nibabel image
+    '''
+    return fsl_vox2mm(ref_img) @ np.linalg.inv(ref_img.affine) @ in_img.affine @ np.linalg.inv(fsl_vox2mm(in_img))
+
+def concat_fsl_matrices(first,second):
+    '''Returns the FLIRT matrix that applies one transformation after another (as convert_xfm -concat second first)
+    Parameters:
+        first: 4x4 FLIRT matrix from A to B
+        second: 4x4 FLIRT matrix from B to C
+    Returns:
+        4x4 FLIRT matrix from A to C
+    '''
+    return np.asarray(second) @ np.asarray(first)
+
+def invert_fsl_matrix(matrix):
+    '''Returns the inverse of a FLIRT matrix (as convert_xfm -inverse)
+    Parameters:
+        matrix: 4x4 FLIRT matrix from A to B
+    Returns:
+        4x4 FLIRT matrix from B to A
+    '''
+    return np.linalg.inv(matrix)
+
+def concat_matrix_files(first_fname,second_fname,out_fname):
+    '''Writes the concatenation of two FLIRT .mat files (first, then second)
+    Parameters:
+        first_fname: .mat file from A to B
+        second_fname: .mat file from B to C
+        out_fname: output .mat file from A to C
+    '''
+    print('concatenating matrices: %s then %s -> %s' %(first_fname,second_fname,out_fname))
+    write_fsl_matrix(out_fname,concat_fsl_matrices(read_fsl_matrix(first_fname),read_fsl_matrix(second_fname)))
+
+def invert_matrix_file(in_fname,out_fname):
+    '''Writes the inverse of a FLIRT .mat file
+    Parameters:
+        in_fname: .mat file from A to B
+        out_fname: output .mat file from B to A
+    '''
+    print('inverting matrix: %s -> %s' %(in_fname,out_fname))
+    write_fsl_matrix(out_fname,invert_fsl_matrix(read_fsl_matrix(in_fname)))
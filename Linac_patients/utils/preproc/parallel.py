@@ -0,0 +1,40 @@
+# functions to run independent units of work (e.g. one subject/session) in parallel
+
+from concurrent.futures import ProcessPoolExecutor
+
+def unit(func,*args,**kwargs):
+    '''Returns a unit of work to pass to run_units
+    Parameters:
+        func: function to call; must be defined at module level so that it can be sent to a worker process
+        args: positional arguments of func
+        kwargs: keyword arguments of func
+    Returns:
+        (func,args,kwargs) tuple
+    '''
+    return (func,args,kwargs)
+
+def run_units(units,jobs=1):
+    '''Runs independent units of work, in a pool of worker processes if jobs > 1
+    Parameters:
+        units: list of units created with unit()
+        jobs: number of worker processes (1 = run serially in the current process)
+    Returns:
+        results: list of return values, in the same order as units
+    Notes:
+        - units passed in one call must not depend on each other; call run_units once per stage to impose an order
+    '''
+
+    # check inputs
+    assert isinstance(jobs,int) and jobs>0, 'jobs must be a positive integer'
+
+    if jobs == 1 or len(units) <= 1:
+        # run serially, as before parallel mode existed
+        results = [func(*args,**kwargs) for func,args,kwargs in units]
+    else:
+        # run in pool of processes; errors in a unit are raised here
+        print('Running %d units in %d processes' %(len(units),min(jobs,len(units))))
+        with ProcessPoolExecutor(max_workers=min(jobs,len(units))) as pool:
+            futures = [pool.submit(func,*args,**kwargs) for func,args,kwargs in units]
+            results = [future.result() for future in futures]
+
+    return results
@@ -4,8 +4,9 @@
 from bids import BIDSLayout
 import pandas as pd
 import os
-from os.path import join, basename, dirname, isfile
+from os.path import join, basename, dirname, isfile, isdir
 import json
+import threading
 
 # functions
 def declare_directories():
@@ -24,9 +25,79 @@ def get_bids_layout(include_derived=False):
     # get BIDS layout
     dirs = declare_directories()
     if include_derived:
-        layout = BIDSLayout(dirs['bids'],database_path=os.path.join(dirs['bids'],'derivatives','BIDSLayoutWithDerivatives'))
+        layout = load_bids_layout(dirs['bids'],os.path.join(dirs['bids'],'derivatives','BIDSLayoutWithDerivatives'),derivatives=True)
     else:
-        layout = BIDSLayout(dirs['bids'],database_path=os.path.join(dirs['bids'],'derivatives','BIDSLayout'))
+        layout = load_bids_layout(dirs['bids'],os.path.join(dirs['bids'],'derivatives','BIDSLayout'))
+    return layout
+
+# process-wide cache of BIDS layouts: {(root, database_path): (layout, stamp)}
+_layout_cache = {}
+_layout_lock = threading.Lock()
+
+def bids_tree_stamp(roots):
+    '''Returns the modification times of the session and datatype directories of BIDS datasets, by session;
+    these change whenever files are added, removed or renamed, so the tree does not need to be walked file by file
+    Parameters:
+        roots: list of dataset roots
+    Returns:
+        stamp: dictionary of {session directory: {'.': mtime of session directory, datatype: mtime of datatype directory}}
+    '''
+    stamp = {}
+    for root in roots:
+        if not isdir(root):
+            continue
+        for subject in os.scandir(root):
+            if not (subject.is_dir() and subject.name.startswith('sub-')):
+                continue
+            for session in os.scandir(subject.path):
+                if not session.is_dir():
+                    continue
+                stamp[session.path] = {'.': session.stat().st_mtime_ns}
+                for datatype in os.scandir(session.path):
+                    if datatype.is_dir():
+                        stamp[session.path][datatype.name] = datatype.stat().st_mtime_ns
+    return stamp
+
+def stale_sessions(saved,stamp):
+    '''Returns the sorted session directories that were added, removed or changed between two stamps (see bids_tree_stamp)'''
+    return sorted([x for x in set(saved) | set(stamp) if saved.get(x) != stamp.get(x)])
+
+def load_bids_layout(root,database_path,derivatives=False):
+    '''Returns a BIDS layout, re-using the layout already loaded by this process or the saved database if the dataset has not changed
+    Parameters:
+        root: root of BIDS dataset
+        database_path: folder of saved layout database
+        derivatives: if True, derivatives are indexed as well
+    Notes:
+        - the stamp is kept per session (see bids_tree_stamp) and saved with the database, so the sessions that changed
+          are known; pybids can only rebuild its database as a whole, however, so any stale session re-indexes the
+          whole dataset (this is not an incremental index)
+    '''
+    roots = [root]
+    if derivatives:
+        roots += [x.path for x in os.scandir(join(root,'derivatives')) if x.is_dir()] if isdir(join(root,'derivatives')) else []
+    stamp = bids_tree_stamp(roots)
+    key = (root,database_path)
+    with _layout_lock:
+        if (key in _layout_cache) and (_layout_cache[key][1] == stamp):
+            return _layout_cache[key][0]
+
+        # compare with stamp saved with database
+        fn_stamp = join(database_path,'tree_stamp.json')
+        saved = {}
+        if isfile(fn_stamp):
+            with open(fn_stamp) as f:
+                saved = json.load(f)
+        stale = stale_sessions(saved,stamp)
+        kwargs = {'derivatives': True} if derivatives else {}
+        if stale:
+            print('BIDS dataset changed since layout was saved (%d sessions, e.g. %s), re-indexing: %s' %(len(stale),stale[0],root))
+            layout = BIDSLayout(root,database_path=database_path,reset_database=True,**kwargs)
+            with open(fn_stamp,'w') as f:
+                json.dump(stamp,f)
+        else:
+            layout = BIDSLayout(root,database_path=database_path,**kwargs)
+        _layout_cache[key] = (layout,stamp)
     return layout
 
 def declare_subject_list():
@@ -2,19 +2,23 @@
 from utils.preproc.project_parameters import get_bids_layout, get_reference_list
 from utils.preproc.flirt_utils import flirt_volumes, flirt_propagate, declare_out_name, flirt_apply
 from utils.preproc.io import func_msg
+from utils.preproc.parallel import unit, run_units
 from utils.preproc.align_volumes import get_reference_fname, get_sessions
+from utils.preproc.transform_store import get_transform_store
 from os.path import join, isdir, basename, isfile, dirname
 import os
 import pandas as pd
 from pathlib import Path
+from glob import glob
 import json
 
-def propagate_contours(dirs,subjects,source='manual'):
+def propagate_contours(dirs,subjects,source='manual',jobs=1):
     '''Registers CT and T1w of reference space and propagate contours (GTV, CTV)
     Parameters:
         dirs (dict): dictionary of directories
         subjects (list): list of subjects
         source (str,optional): source of contours {manual=drawn by radoncs, aiaa=created by AIAA tool}
+        jobs (int,optional): number of (subject, session) units to run in parallel
     '''
 
     # communicate with user
@@ -26,6 +30,7 @@ def propagate_contours(dirs,subjects,source='manual'):
     layout = get_bids_layout()
     layout_dv = get_bids_layout(include_derived=True)
     df_ref = get_reference_list()
+    transforms = index_transforms(dirs,layout,subjects,suffix)
 
     if source == 'manual':
         out_folder = 'coreg_contours'
@@ -34,6 +39,7 @@ def propagate_contours(dirs,subjects,source='manual'):
 
     # declare list to hold reference name
     rows = []
+    units = []
 
     for subject in subjects:
 
@@ -69,14 +75,31 @@ def propagate_contours(dirs,subjects,source='manual'):
                 else:
 
                     # get T1w-ce transformation matrix
-                    in2ref_fname = t1w_coreg_fname.replace('.nii.gz','.mat')
                     t1w_fname = source_filename(dirs,t1w_coreg_fname)
+                    in2ref_fname = transforms.matrix_file(t1w_fname,ref_fname)
 
                     # co-register T1w-ce and reference T1w and propagate contours
-                    out_fnames = flirt_apply(contour_fnames,ref_fname,in2ref_fname,out_dir,suffix,overwrite=False,method='nearestneighbour')
+                    units.append(unit(propagate_session,contour_fnames,ref_fname,in2ref_fname,t1w_fname,out_dir,suffix))
 
-                    # create .json sidecars
-                    create_json_bids(t1w_fname,ref_fname,contour_fnames,out_fnames)
+    # run sessions
+    run_units(units,jobs=jobs)
+
+def propagate_session(contour_fnames,ref_fname,in2ref_fname,t1w_fname,out_dir,suffix):
+    '''Applies the saved transformation of one session to its contours and creates .json sidecars
+    Parameters
+        contour_fnames: filenames of contours
+        ref_fname: filename of reference volume
+        in2ref_fname: filename of transformation matrix from T1w to reference
+        t1w_fname: filename of T1w on which contours were defined
+        out_dir: output directory
+        suffix: suffix for desc- entity
+    '''
+
+    # co-register T1w-ce and reference T1w and propagate contours
+    out_fnames = flirt_apply(contour_fnames,ref_fname,in2ref_fname,out_dir,suffix,overwrite=False,method='nearestneighbour')
+
+    # create .json sidecars
+    create_json_bids(t1w_fname,ref_fname,contour_fnames,out_fnames)
 
 def get_contour_fnames(dirs,layout,subject,session,source='manual'):
     '''Returns the filename of the T1w scan and contours
@@ -152,6 +175,31 @@ def get_bids_relative(fname,derived=False):
     fname_rel = fname.replace(str(Path(fname).parents[n])+'/','')
     return fname_rel
 
+def index_transforms(dirs,layout,subjects,suffix):
+    """Adds the co-registration matrices of subjects to the transform store of the coreg derivatives
+    Args:
+        dirs: directories dictionary
+        layout: BIDS layout
+        subjects: list of subjects
+        suffix: suffix used for desc- entity in co-registration
+    Returns:
+        transforms: TransformStore, in which each co-registered volume maps to the reference volume of its subject
+    """
+    root = os.path.join(dirs['bids'],'derivatives','coreg')
+    transforms = get_transform_store(root)
+    # matrices already in the store and unchanged since (same size and modification time) are not added again
+    stamps = transforms.stamps()
+    for subject in subjects:
+        ref_fname = get_reference_fname(dirs,layout,subject)
+        matrix_fnames = glob(os.path.join(root,'sub-'+subject,'ses-*','anat','*_desc-'+suffix+'_*.mat'))
+        for matrix_fname in matrix_fnames:
+            if matrix_fname.endswith('_phase1.mat') or matrix_fname.endswith('_inverse.mat'):
+                continue
+            src_fname = source_filename(dirs,matrix_fname)
+            if not transforms.is_current(src_fname,ref_fname,matrix_fname,stamps):
+                transforms.add(src_fname,ref_fname,matrix_fname)
+    return transforms
+
 def get_in2ref_filename(dirs,t1w_fname,suffix):
     """Returns the filename of the transformation matrix to the reference volume
     Args:
@@ -15,11 +15,15 @@ Notes:
 '''
 
 import subprocess as sp
-from os.path import join,isfile,splitext
+from os.path import join,isfile,splitext,dirname,abspath
 import nibabel as nib
 import numpy as np
 import sys
 
+# this script is run from its own folder; the project folder is added to the path for the sparse masks of utils/preproc
+sys.path.insert(0,dirname(dirname(dirname(abspath(__file__)))))
+from utils.preproc.sparse_mask import load_union
+
 def render_lightbox(base_fname,overlay_fnames,zrange,lightbox_shape,out_fname):
     '''
     Renders lightbox scene in axial view with specificed z-range and semitransparent overlays.
@@ -101,14 +105,16 @@ def get_zrange(nii):
     return zrange, lightbox_shape
 
 def load_nifti_union(nii_fnames):
-    nii = nib.load(nii_fnames[0])
-    im_un = nii.get_fdata()
-    for fname in nii_fnames[1:]:
-        nii = nib.load(fname)
-        data = nii.get_fdata()
-        im_un = np.logical_or(im_un,data)
-    nii_un = nib.Nifti1Image(im_un,nii.affine,nii.header)
-    return nii_un 
+    '''
+    Loads the union of the nonzero voxels of ROI niftis on the same grid
+    Parameters:
+        nii_fnames: list of filenames of ROI niftis
+    Returns:
+        nii_un: nifti of union (uint8)
+    Notes:
+        - ROIs are read as sparse masks (sparse_mask.load_union), whose union is a merge of their sorted voxel indices
+    '''
+    return load_union(nii_fnames).to_nifti()
 
 def test_filenames():
     folder="/scratch/llawrence/bids-cns-mrl/derivatives/mrl_dwi/longitudinal_dwi/contours/sub-M001/ses-MRL001"
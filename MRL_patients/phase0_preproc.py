@@ -29,14 +29,32 @@ parser.add_argument('--session-table',dest='do_session_day',action='store_true',
 parser.add_argument('--prop-contours',dest='do_propagate_contours',action='store_true',default=False,help='propagate contours (default = False)')
 parser.add_argument('--contour-source',dest='contour_source',help='source of contours to propagate ("ct" or "glio_t1c"; default = "ct")')
 parser.set_defaults(contour_source='ct')
+parser.add_argument('--contours-to-sessions',dest='contours_to_sessions',action='store_true',default=False,help='also propagate CT contours into the native T1w space of every MR-Linac session, resampling once (default = False)')
 
 parser.add_argument('--do-bet',dest='do_extract_brain',action='store_true',default=False,help='extract brain with HD-BET (default = False)')
+parser.add_argument('--bet-batch',dest='bet_batch',action='store_true',default=False,help='run HD-BET in --jobs worker processes that each load the network once (default = False)')
+parser.add_argument('--bet-threads',dest='bet_threads',help='number of torch threads per HD-BET worker in batch mode (default = 1)',default=1,type=int)
 
 parser.add_argument('--run-aiaa',dest='run_aiaa',action='store_true',default=False,help='Run NVIDIA AIAA to create tumour segmentation (default = False)')
 parser.add_argument('--num-outputs',dest='num_outputs',help='number of outputs for AIAA segmentation (1 or 3)',default=3,type=int)
 
+parser.add_argument('--fit-adc',dest='do_fit_adc',action='store_true',default=False,help='fit ADC maps to co-registered MR-Linac DWI (default = False)')
+parser.add_argument('--adc-method',dest='adc_method',help='ADC fitting method ("wls" or "ols"; default = "wls")',default='wls')
+parser.add_argument('--threads',dest='threads',help='number of threads per unit for stages that support them (default = 1)',default=1,type=int)
+
+parser.add_argument('--low-adc',dest='do_low_adc',action='store_true',default=False,help='compute table of low-ADC volumes (default = False)')
+parser.add_argument('--adc-threshold',dest='adc_threshold',help='low-ADC threshold (default = 1.25)',default=1.25,type=float)
+
+parser.add_argument('--roi-stats',dest='do_roi_stats',action='store_true',default=False,help='compute table of ADC statistics in ROIs of MR-Linac sessions (default = False)')
+
+parser.add_argument('--pack',dest='do_pack',action='store_true',default=False,help='pack co-registered MR-Linac volumes of each subject into a longitudinal HDF5 store (default = False)')
+
 parser.add_argument('--mrl-flair',dest='mrl_flair',action='store_true',default=False,help='align MR-Linac FLAIR volumes (default = False)')
 
+parser.add_argument('--all',dest='run_all',action='store_true',default=False,help='run all stages (align, session-table, prop-contours, do-bet, run-aiaa, fit-adc, low-adc, roi-stats, pack), overlapping independent stages; implies --align-sim and --align-mrl (default = False)')
+
+parser.add_argument('--jobs',dest='jobs',help='number of (subject, session) units to run in parallel (default = 1)',default=1,type=int)
+
 args = parser.parse_args()
 
 subjects_arg = args.subjects_arg
@@ -47,6 +65,7 @@ ref_names_only = args.ref_names_only
 
 do_propagate_contours = args.do_propagate_contours
 contour_source = args.contour_source
+contours_to_sessions = args.contours_to_sessions
 
 do_extract_brain = args.do_extract_brain
 
@@ -59,11 +78,32 @@ do_propagate_contours = args.do_propagate_contours
 
 do_extract_brain = args.do_extract_brain
 
+bet_batch = args.bet_batch
+bet_threads = args.bet_threads
+
 run_aiaa = args.run_aiaa
 num_outputs = args.num_outputs
 
 mrl_flair = args.mrl_flair
 
+do_fit_adc = args.do_fit_adc
+adc_method = args.adc_method
+threads = args.threads
+
+do_low_adc = args.do_low_adc
+adc_threshold = args.adc_threshold
+
+do_roi_stats = args.do_roi_stats
+
+do_pack = args.do_pack
+
+jobs = args.jobs
+run_all = args.run_all
+if run_all:
+    # the whole pipeline aligns both MR-sim and MR-Linac volumes
+    align_sim = True
+    align_mrl = True
+
 ### do imports after argument parser to speed up printing of help info
 from utils.preproc.project_parameters import declare_directories, get_bids_layout, declare_subject_reference_dict, declare_subject_list
 from utils.preproc.align_volumes import align_volumes
@@ -71,7 +111,11 @@ from utils.preproc.session_day_table import make_session_day_table
 from utils.preproc.propagate_contours import propagate_contours, propagate_contours_glio
 from utils.preproc.extract_brain import extract_brain
 from utils.nvidia_aiaa.create_aiaa_seg import create_aiaa_seg
-from os.path import isfile
+from utils.preproc.low_adc import make_dyn_table
+from utils.preproc.adc_fit import fit_adc_sessions
+from utils.preproc.roi_stats import make_roi_stats_table
+from utils.preproc.task_graph import Task, TaskGraph
+from os.path import isfile, join
 from pandas import read_csv
 ###
 
@@ -94,28 +138,83 @@ else:
 if start_from:
     subjects = subjects[subjects.index(start_from):]
 
-if do_align:
-    # align MR-sim scans to space in which Pejman's necrosis ROI was defined
-    align_volumes(dirs,subjects,ref_names_only=ref_names_only,align_sim=align_sim,align_mrl=align_mrl,mrl_flair=mrl_flair)
-
-if do_session_day:
-    # create table of session-treatment day correspondence
-    make_session_day_table(dirs,subjects)
-
-if do_propagate_contours:
-
-    if contour_source == 'ct':
-        # register CT to T1w of reference session and propagate contours (GTV, CTV)
-        propagate_contours(dirs,subjects)
-
-    elif contour_source == 'glio_t1c': 
-        # register GLIO T1w to T1w of reference session and propagate contours (GTV, CTV)
-        propagate_contours_glio(dirs,subjects)
-
-if do_extract_brain:
-    # call HD-BET to extract brain
-    extract_brain(dirs,subjects)
-
-if run_aiaa:
-    # call NVIDIA AIAA to create tumour segmentation from MR-sim scans
-    create_aiaa_seg(dirs,subjects,num_outputs=num_outputs)
+# declare pipeline stages, with the files each stage reads and writes
+fn_ref_list = join(dirs['proj'],'results','subject_reference_list.csv')
+dir_sim_coreg = join(dirs['mr_sim'],'coreg')
+dir_mrl_coreg = join(dirs['mr_linac'],'coreg')
+dir_mrl_contours = join(dirs['mr_linac'],'contours')
+dir_sim_contours = join(dirs['mr_sim'],'glio_contours')
+dir_mrl_seg = join(dirs['mr_linac'],'seg')
+graph = TaskGraph(stamp_dir=join(dirs['proj'],'results','task_stamps'))
+
+# align MR-sim scans to space in which Pejman's necrosis ROI was defined
+graph.add(Task('align',align_volumes,
+    kwargs=dict(dirs=dirs,subjects=subjects,ref_names_only=ref_names_only,align_sim=align_sim,align_mrl=align_mrl,mrl_flair=mrl_flair,jobs=jobs),
+    outputs=[fn_ref_list,dir_sim_coreg,dir_mrl_coreg]))
+
+# create table of session-treatment day correspondence
+graph.add(Task('session-table',make_session_day_table,
+    kwargs=dict(dirs=dirs,subjects=subjects),
+    inputs=[join(dirs['proj'],'data','MOMENTUM_study_tracker_20220518.xlsx')],
+    outputs=[join(dirs['proj'],'results','metadata','session_day_'+x+'.csv') for x in ['mrl','sim']]))
+
+if contour_source == 'ct':
+    # register CT to T1w of reference session and propagate contours (GTV, CTV)
+    graph.add(Task('prop-contours',propagate_contours,
+        kwargs=dict(dirs=dirs,subjects=subjects,jobs=jobs,to_sessions=contours_to_sessions),
+        inputs=[join(dirs['proj'],'data','roi_names.csv')] + ([dir_mrl_coreg] if contours_to_sessions else []),
+        outputs=[dir_mrl_contours] + ([join(dirs['mr_linac'],'contours_sessions')] if contours_to_sessions else [])))
+
+elif contour_source == 'glio_t1c': 
+    # register GLIO T1w to T1w of reference session and propagate contours (GTV, CTV)
+    graph.add(Task('prop-contours',propagate_contours_glio,
+        kwargs=dict(dirs=dirs,subjects=subjects,jobs=jobs),
+        inputs=[fn_ref_list],
+        outputs=[dir_sim_contours]))
+
+# call HD-BET to extract brain
+graph.add(Task('do-bet',extract_brain,
+    kwargs=dict(dirs=dirs,subjects=subjects,jobs=jobs,batch=bet_batch,threads=bet_threads),
+    inputs=[fn_ref_list],
+    outputs=[dir_mrl_seg]))
+
+# call NVIDIA AIAA to create tumour segmentation from MR-sim scans
+graph.add(Task('run-aiaa',create_aiaa_seg,
+    kwargs=dict(dirs=dirs,subjects=subjects,num_outputs=num_outputs,jobs=jobs),
+    inputs=[dir_sim_coreg],
+    outputs=[join(dirs['mr_sim'],'aiaa_seg' if num_outputs == 3 else 'aiaa_seg_tc')]))
+
+# fit ADC maps to co-registered MR-Linac DWI
+dir_mrl_adc = join(dirs['mr_linac'],'adc')
+graph.add(Task('fit-adc',fit_adc_sessions,
+    kwargs=dict(dirs=dirs,subjects=subjects,method=adc_method,jobs=jobs,threads=threads),
+    inputs=[dir_mrl_coreg],
+    outputs=[dir_mrl_adc]))
+
+# compute low-ADC volumes of all sessions
+graph.add(Task('low-adc',make_dyn_table,
+    kwargs=dict(dirs=dirs,subjects=subjects,threshold=adc_threshold),
+    inputs=[dir_mrl_adc,dir_sim_contours,dir_mrl_seg] + [join(dirs['proj'],'results','metadata','session_day_'+x+'.csv') for x in ['mrl','sim']],
+    outputs=[join(dirs['proj'],'results','volume_dynamics','dyn_table.csv')]))
+
+# compute ADC statistics in ROIs of all MR-Linac sessions
+graph.add(Task('roi-stats',make_roi_stats_table,
+    kwargs=dict(dirs=dirs,subjects=subjects,threshold=adc_threshold,jobs=jobs),
+    inputs=[dir_mrl_adc,dir_mrl_contours,dir_mrl_seg],
+    outputs=[join(dirs['proj'],'results','roi_stats')]))
+
+# pack co-registered MR-Linac volumes into one longitudinal store per subject
+def pack_subjects(**kwargs):
+    # h5py is imported only when this stage runs, so the other stages do not depend on it
+    from utils.preproc.longitudinal_store import export_subjects
+    export_subjects(**kwargs)
+graph.add(Task('pack',pack_subjects,
+    kwargs=dict(dirs=dirs,subjects=subjects,jobs=jobs),
+    inputs=[dir_mrl_coreg],
+    outputs=[join(dirs['mr_linac'],'longitudinal')]))
+
+# run requested stages and any missing or stale stages they depend on
+flags = [('align',do_align),('session-table',do_session_day),('prop-contours',do_propagate_contours),('do-bet',do_extract_brain),('run-aiaa',run_aiaa),('fit-adc',do_fit_adc),('low-adc',do_low_adc),('roi-stats',do_roi_stats),('pack',do_pack)]
+targets = [name for name,flag in flags if flag or run_all]
+if targets:
+    graph.run(targets,jobs=jobs)
@@ -5,13 +5,15 @@ from os.path import join
 import sys
 from bids import BIDSLayout
 from utils.nvidia_aiaa.aiaa_utils import seg_list_for_subject
+from utils.preproc.parallel import unit, run_units
 
-def create_aiaa_seg(dirs,subjects,num_outputs=3):
+def create_aiaa_seg(dirs,subjects,num_outputs=3,jobs=1):
     '''Creates AIAA segmentation for listed subjects using MR-sim scans
     args:
         dirs (dict): directories dictionary
         subjects (list): list of subject names
         num_outputs (int): number of segmentation outputs (1 = tumour core, 3 = {tumour core, enhancing tumour, whole tumour})
+        jobs (int): number of (subject, session) units to run in parallel
     '''
 
     # options
@@ -29,18 +31,30 @@ def create_aiaa_seg(dirs,subjects,num_outputs=3):
         folder = 'aiaa_seg_tc'
     out_root = os.path.join(dirs['proj'],'results','mr_sim',folder)
 
+    units = []
     for subject in subjects:
         # get list of SegAI objects
         seg_list = seg_list_for_subject(data_root,subject,out_root,num_outputs=num_outputs)
 
         for seg in seg_list:
-            seg.find_input_filenames()
-            session = seg.get_session()
-            print('processing: sub-%s_ses-%s'%(subject,session))    
-            seg.print_input_filenames()
-            try:
-                seg.run(model,server)
-            except:
-                print('could not run preproc or segment')
+            units.append(unit(run_seg,seg,model,server))
+
+    # run sessions
+    run_units(units,jobs=jobs)
+
+def run_seg(seg,model,server):
+    '''Runs AIAA segmentation for one session
+    args:
+        seg (SegAI): segmentation object for session
+        model (str): name of CLARA model
+        server (str): server URL
+    '''
+    seg.find_input_filenames()
+    print('processing: sub-%s_ses-%s'%(seg.get_subject(),seg.get_session()))    
+    seg.print_input_filenames()
+    try:
+        seg.run(model,server)
+    except:
+        print('could not run preproc or segment')
         
 
@@ -0,0 +1,189 @@
+# mono-exponential ADC fitting of (co-registered) DWI, S(b) = S0 exp(-b ADC), for all voxels of a volume at once
+#
+# The fit is linear in log(S): for every voxel, the 2x2 (weighted) normal equations are formed from sums over b-values
+# and solved in closed form, so a chunk of voxels is fitted with a few array operations.
+
+import os
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, isfile, basename
+from utils.preproc.project_parameters import get_bids_layout
+from utils.preproc.bids_index import get_bids_index
+from utils.preproc.build_manifest import needs_update, get_manifest
+from utils.preproc.nifti_cache import get_nifti_cache
+from utils.preproc.align_volumes import select_mrl_dwi
+from utils.preproc.parallel import unit, run_units
+from utils.preproc.io import func_msg
+
+# declare parameters
+ADC_SCALE = 1e3 # ADC maps are written in 10^-3 mm^2/s for b-values in s/mm^2
+MIN_SIGNAL = 1e-6 # signal is clipped to this value before taking its logarithm
+
+def read_bvals(fname):
+    '''Returns the b-values (s/mm^2) of a BIDS/FSL .bval file as a 1D array'''
+    return np.loadtxt(fname,ndmin=1).ravel()
+
+def weighted_line_fit(x,y,w):
+    '''Fits y = a + b*x for many voxels at once by weighted least squares
+    Parameters:
+        x: N array of abscissae (b-values), shared by all voxels
+        y: V x N array of ordinates (log-signals)
+        w: V x N array of weights, or None for ordinary least squares
+    Returns:
+        a, b: V arrays of intercepts and slopes
+    '''
+    if w is None:
+        sw = np.full(y.shape[0],x.size,dtype=y.dtype)
+        sx = np.full(y.shape[0],x.sum(),dtype=y.dtype)
+        sxx = np.full(y.shape[0],(x*x).sum(),dtype=y.dtype)
+        sy = y.sum(axis=1)
+        sxy = y @ x
+    else:
+        sw = w.sum(axis=1)
+        sx = w @ x
+        sxx = w @ (x*x)
+        wy = w*y
+        sy = wy.sum(axis=1)
+        sxy = wy @ x
+    det = sw*sxx - sx*sx
+    with np.errstate(divide='ignore',invalid='ignore'):
+        b = (sw*sxy - sx*sy)/det
+        a = (sy - b*sx)/sw
+    return a, b
+
+def fit_adc(signal,bvals,method='wls'):
+    '''Fits the mono-exponential model to the signals of many voxels
+    Parameters:
+        signal: V x N array of signals (one row per voxel, one column per b-value)
+        bvals: N array of b-values (s/mm^2)
+        method: 'ols' (log-linear least squares) or 'wls' (log-linear least squares weighted by the squared signal
+            predicted by the OLS fit, which undoes the noise amplification of the logarithm at high b-values)
+    Returns:
+        adc: V array of ADC (mm^2/s)
+        s0: V array of S0
+    '''
+    assert method in ['ols','wls'], 'method must be one of {ols,wls}'
+    x = np.asarray(bvals,dtype=np.float64)
+    y = np.log(np.maximum(signal.astype(np.float64),MIN_SIGNAL))
+    a, b = weighted_line_fit(x,y,None)
+    if method == 'wls':
+        w = np.exp(2*(a[:,None] + b[:,None]*x[None,:]))
+        a, b = weighted_line_fit(x,y,w)
+    return -b, np.exp(a)
+
+def fit_adc_volume(dwi_fname,bval_fname,out_fname,mask_fname='',method='wls',chunk_size=2**16,threads=1,s0_fname='',nifti_cache=None):
+    '''Fits an ADC map to a 4D DWI volume and saves it (in 10^-3 mm^2/s)
+    Parameters:
+        dwi_fname: filename of 4D DWI volume
+        bval_fname: filename of b-values
+        out_fname: filename of ADC map
+        mask_fname: filename of mask of voxels to fit (default = voxels with nonzero signal at the lowest b-value)
+        method: 'ols' or 'wls' (see fit_adc)
+        chunk_size: number of voxels fitted at a time
+        threads: number of chunks fitted in parallel (numpy releases the GIL during the fit)
+        s0_fname: if given, filename of S0 map
+        nifti_cache: NiftiCache; if given, the DWI is memory-mapped from its uncompressed copy
+    Notes:
+        - with nifti_cache, only the chunks being fitted are read into memory: voxels are taken in on-disk (Fortran) order,
+          so a chunk is one contiguous range of each b-value volume; without it, the whole DWI is decompressed into memory
+    '''
+
+    # load DWI and b-values
+    img = nifti_cache.load(dwi_fname) if nifti_cache else nib.load(dwi_fname)
+    bvals = read_bvals(bval_fname)
+    assert img.ndim == 4 and img.shape[3] == bvals.size, 'DWI volume must be 4D with one volume per b-value: ' + dwi_fname
+    dwi = nifti_cache.array(dwi_fname) if nifti_cache else np.asanyarray(img.dataobj)
+    shape = img.shape[:3]
+
+    # declare voxels to fit, in on-disk order
+    if mask_fname:
+        mask = np.asanyarray(nib.load(mask_fname).dataobj) != 0
+    else:
+        mask = dwi[...,int(np.argmin(bvals))] > 0
+    voxels = np.flatnonzero(mask.ravel(order='F'))
+
+    # fit chunks of voxels
+    adc = np.zeros(int(np.prod(shape)),dtype=np.float32)
+    s0 = np.zeros(int(np.prod(shape)),dtype=np.float32)
+    def fit_chunk(start):
+        index = voxels[start:start+chunk_size]
+        signal = dwi[np.unravel_index(index,shape,order='F')]
+        adc[index], s0[index] = fit_adc(signal,bvals,method)
+    starts = range(0,voxels.size,chunk_size)
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(fit_chunk,starts))
+    else:
+        for start in starts:
+            fit_chunk(start)
+
+    # save maps with geometry of DWI
+    adc = np.nan_to_num(adc*ADC_SCALE,nan=0.,posinf=0.,neginf=0.)
+    for data, fname in [(adc,out_fname),(s0,s0_fname)]:
+        if fname:
+            header = img.header.copy()
+            header.set_data_dtype(np.float32)
+            out_img = nib.Nifti1Image(data.reshape(shape,order='F'),img.affine,header)
+            out_img.header.set_slope_inter(1,0)
+            nib.save(out_img,fname)
+            print('map saved: ' + fname)
+
+def fit_adc_sessions(dirs,subjects,method='wls',jobs=1,threads=1,overwrite=False):
+    '''Fits ADC maps to the co-registered MR-Linac DWI of all sessions of subjects
+    Parameters:
+        dirs: directories dictionary
+        subjects: names of subjects
+        method: 'ols' or 'wls' (see fit_adc)
+        jobs: number of sessions fitted in parallel
+        threads: number of threads per session
+        overwrite: if True, existing maps are fitted again
+    Notes:
+        - existing maps are fitted again when the DWI, b-values or method changed (see build_manifest.py)
+        - the DWI of a session is the one co-registered by align_volumes (select_mrl_dwi)
+        - maps are written to <mr_linac>/adc/sub-<subject>/ses-<session>/sub-<subject>_ses-<session>_adc.nii.gz
+    '''
+
+    # communicate with user
+    func = 'fit_adc_sessions'
+    func_msg(func,'start')
+
+    # declare parameters
+    index = get_bids_index(get_bids_layout('mrl').root)
+    manifest = get_manifest(dirs['mr_linac'])
+    nifti_cache = get_nifti_cache(dirs['mr_linac'])
+    tool = 'adc_fit'
+    params = {'method': method, 'scale': ADC_SCALE}
+    units = []
+
+    for subject in subjects:
+        for session in index.get_sessions(subject):
+
+            # get DWI that align_volumes co-registered to the reference volume
+            fnames = index.get(subject,session,suffix='dwi',extension='nii.gz')
+            if not fnames:
+                continue
+            fname = select_mrl_dwi(fnames,subject,session)
+            coreg_fname = join(dirs['mr_linac'],'coreg','sub-'+subject,'ses-'+session,basename(fname).replace('.nii.gz','_coreg.nii.gz'))
+            bval_fname = fname.replace('.nii.gz','.bval')
+            if not (isfile(coreg_fname) and isfile(bval_fname)):
+                print('no co-registered DWI or b-values: %s_%s' %(subject,session))
+                continue
+
+            # declare output
+            out_dir = join(dirs['mr_linac'],'adc','sub-'+subject,'ses-'+session)
+            out_fname = join(out_dir,'sub-%s_ses-%s_adc.nii.gz' %(subject,session))
+            if not needs_update([out_fname],[coreg_fname,bval_fname],tool,params,overwrite,manifest):
+                print('ADC map already exists: ' + out_fname)
+                continue
+            os.makedirs(out_dir,exist_ok=True)
+            units.append(unit(fit_adc_session,coreg_fname,bval_fname,out_fname,method,threads,manifest,nifti_cache))
+
+    run_units(units,jobs=jobs)
+    func_msg(func,'end')
+
+def fit_adc_session(dwi_fname,bval_fname,out_fname,method='wls',threads=1,manifest=None,nifti_cache=None):
+    '''Fits the ADC map of one session and records it in the manifest; see fit_adc_volume'''
+    fit_adc_volume(dwi_fname,bval_fname,out_fname,method=method,threads=threads,nifti_cache=nifti_cache)
+    if manifest:
+        manifest.record([out_fname],[dwi_fname,bval_fname],'adc_fit',{'method': method, 'scale': ADC_SCALE})
@@ -2,12 +2,18 @@
 from utils.preproc.project_parameters import get_bids_layout, declare_subject_reference_dict, date_to_session, declare_protocol_names, session_to_date
 from utils.preproc.flirt_utils import flirt_volumes
 from utils.preproc.io import func_msg
-from os.path import join, isdir, basename, isfile
+from utils.preproc.parallel import unit, run_units
+from utils.preproc.build_manifest import get_manifest
+from utils.preproc.iso_cache import IsoCache
+from utils.preproc.nifti_cache import get_nifti_cache
+from utils.preproc.transform_store import get_transform_store
+from utils.preproc.bids_index import get_bids_index
+from os.path import join, isdir, basename, isfile, dirname
 import os
 import pandas as pd
 import nibabel as nib
 
-def align_volumes(dirs,subjects,ref_names_only=False,align_sim=True,align_mrl=True,mrl_flair=False):
+def align_volumes(dirs,subjects,ref_names_only=False,align_sim=True,align_mrl=True,mrl_flair=False,jobs=1):
     '''Aligns MR-sim and MR-Linac scans to space of Pejman's necrosis ROIs
     Parameters:
         dirs: dictionary of directories
@@ -16,6 +22,7 @@ def align_volumes(dirs,subjects,ref_names_only=False,align_sim=True,align_mrl=Tr
         align_sim: if True, will align MR-sim volumes
         align_mrl: if True, will align MR-Linac volumes
         mrl_flair: if True, will align MR-Linac FLAIR volumes
+        jobs: number of (subject, session) units to run in parallel
     '''
 
     # communicate with user
@@ -27,10 +34,19 @@ def align_volumes(dirs,subjects,ref_names_only=False,align_sim=True,align_mrl=Tr
     suffix = 'coreg'
     layout_sim = get_bids_layout('sim')
     layout_mrl = get_bids_layout('mrl')
+    manifest_sim = get_manifest(dirs['mr_sim'])
+    manifest_mrl = get_manifest(dirs['mr_linac'])
+    iso_cache = IsoCache(join(dirs['mr_linac'],'iso_cache'))
+    nifti_cache = get_nifti_cache(dirs['mr_linac'])
+    transforms = get_transform_store(dirs['mr_linac'])
 
     # declare list to hold reference name
     rows = []
 
+    # declare lists of (subject, session) units; reference sessions are run before the others
+    units_ref = []
+    units = []
+
     # loop subjects
     for subject in subjects:
 
@@ -64,8 +80,7 @@ def align_volumes(dirs,subjects,ref_names_only=False,align_sim=True,align_mrl=Tr
                     src_fnames = get_source_fnames(dirs,'sim',layout_sim,subject,session)
 
                     # register source volumes to reference volume one at a time
-                    for src_fname in src_fnames:
-                        flirt_volumes(src_fname,ref_fname,[],suffix,out_dir,other_qform=True,overwrite=False,resample=2)
+                    units.append(unit(align_sim_session,src_fnames,ref_fname,suffix,out_dir,manifest=manifest_sim,iso_cache=iso_cache,transforms=transforms,nifti_cache=nifti_cache))
 
 
             if align_mrl:
@@ -95,38 +110,21 @@ def align_volumes(dirs,subjects,ref_names_only=False,align_sim=True,align_mrl=Tr
                         
                         if session == ref_session:
                             # create symbolic links if current session is reference session
-                            for fname in fnames:
-                                dst = join(out_dir,basename(fname).replace('.nii.gz','_coreg.nii.gz'))
-                                if isfile(dst):
-                                    print('Symlink already exists: ' + dst)
-                                else:
-                                    os.symlink(fname,dst)
-                                    print('Created symlink: ' + dst)
+                            units_ref.append(unit(link_reference_session,fnames,out_dir))
                         else:
-
-                            # get T1w filename as source
-                            src_fname = fnames[0]
-                            other_fnames = fnames[1:] # other volumes
-
                             # declare path to M0b
                             dst_dir = join(dirs['mr_linac'],'qmt','sub-'+subject,'ses-'+session)
                             m0b_fname_dst = join(dst_dir,'sub-%s_ses-%s_m0b.nii.gz'%(subject,session)) 
-                            if m0b_fname and not isfile(m0b_fname_dst):
-                                print('Appending M0b to list of volumes to co-register: ' + m0b_fname)
-                                other_fnames.append(m0b_fname)
-
-                            # register source volume to reference volume and co-register other volumes using same transformation
-                            flirt_volumes(src_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=True,overwrite=False,resample=2)
 
-                            # move M0b to separate folder, if it exists
-                            if m0b_fname and not isfile(m0b_fname_dst):
-                                if not isdir(dst_dir):
-                                    os.makedirs(dst_dir)
-                                os.rename(join(out_dir,'m0b_'+suffix+'.nii.gz'),m0b_fname_dst)
-                                print('M0b volume moved: ' + m0b_fname_dst)
+                            # register T1w to reference volume and co-register other volumes using same transformation
+                            units.append(unit(align_mrl_session,fnames,ref_fname,suffix,out_dir,m0b_fname,m0b_fname_dst,manifest=manifest_mrl,iso_cache=iso_cache,transforms=transforms,nifti_cache=nifti_cache))
 
                     else:
                         print('no DWI: %s_%s' %(subject,session))
+
+    # run reference sessions first, then all other sessions
+    run_units(units_ref,jobs=jobs)
+    run_units(units,jobs=jobs)
         
     # write list of reference names
     filename = join(dirs['proj'],'results','subject_reference_list.csv')
@@ -138,6 +136,71 @@ def align_volumes(dirs,subjects,ref_names_only=False,align_sim=True,align_mrl=Tr
         print('List of reference volumes written: ' + filename)
     func_msg(func,'end')
 
+def align_sim_session(src_fnames,ref_fname,suffix,out_dir,manifest=None,iso_cache=None,transforms=None,nifti_cache=None):
+    '''Registers the volumes of one MR-sim session to the reference volume
+    Parameters:
+        src_fnames: filenames of source volumes
+        ref_fname: filename of reference volume
+        suffix: suffix to append to coregistered volumes
+        out_dir: output directory
+        manifest: BuildManifest of the MR-sim derivatives
+        iso_cache: IsoCache of resampled reference volumes
+        nifti_cache: NiftiCache of uncompressed input and reference volumes
+        transforms: TransformStore to which the session's matrices are added
+    '''
+
+    # register source volumes to reference volume one at a time
+    for src_fname in src_fnames:
+        flirt_volumes(src_fname,ref_fname,[],suffix,out_dir,other_qform=True,overwrite=False,resample=2,manifest=manifest,iso_cache=iso_cache,transforms=transforms,nifti_cache=nifti_cache)
+
+def link_reference_session(fnames,out_dir):
+    '''Creates symbolic links to the volumes of the reference MR-Linac session, which are already in reference space
+    Parameters:
+        fnames: filenames of volumes in reference session
+        out_dir: output directory
+    '''
+    for fname in fnames:
+        dst = join(out_dir,basename(fname).replace('.nii.gz','_coreg.nii.gz'))
+        if isfile(dst):
+            print('Symlink already exists: ' + dst)
+        else:
+            os.symlink(fname,dst)
+            print('Created symlink: ' + dst)
+
+def align_mrl_session(fnames,ref_fname,suffix,out_dir,m0b_fname,m0b_fname_dst,manifest=None,iso_cache=None,transforms=None,nifti_cache=None):
+    '''Registers the T1w of one MR-Linac session to the reference volume and co-registers the other volumes using the same transformation
+    Parameters:
+        fnames: filenames of volumes in session; the first is the T1w
+        ref_fname: filename of reference volume
+        suffix: suffix to append to coregistered volumes
+        out_dir: output directory
+        m0b_fname: filename of M0b map, or '' if none
+        m0b_fname_dst: destination of co-registered M0b map
+        manifest: BuildManifest of the MR-Linac derivatives
+        iso_cache: IsoCache of resampled reference volumes
+        nifti_cache: NiftiCache of uncompressed input and reference volumes
+        transforms: TransformStore to which the session's matrices are added
+    '''
+
+    # get T1w filename as source
+    src_fname = fnames[0]
+    other_fnames = fnames[1:] # other volumes
+
+    if m0b_fname and not isfile(m0b_fname_dst):
+        print('Appending M0b to list of volumes to co-register: ' + m0b_fname)
+        other_fnames.append(m0b_fname)
+
+    # register source volume to reference volume and co-register other volumes using same transformation
+    flirt_volumes(src_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=True,overwrite=False,resample=2,manifest=manifest,iso_cache=iso_cache,transforms=transforms,nifti_cache=nifti_cache)
+
+    # move M0b to separate folder, if it exists
+    if m0b_fname and not isfile(m0b_fname_dst):
+        dst_dir = dirname(m0b_fname_dst)
+        if not isdir(dst_dir):
+            os.makedirs(dst_dir)
+        os.rename(join(out_dir,'m0b_'+suffix+'.nii.gz'),m0b_fname_dst)
+        print('M0b volume moved: ' + m0b_fname_dst)
+
 def get_sessions(layout,subject):
     '''Returns a list of sessions for a given subject
     Parameters:
@@ -145,8 +208,7 @@ def get_sessions(layout,subject):
         subject: subject
     '''
 
-    sessions = layout.get(return_type='id',subject=subject,target='session')
-    sessions.sort()
+    sessions = get_bids_index(layout.root).get_sessions(subject)
     return sessions
 
 def get_reference_fname(dirs,layout,subject):
@@ -158,17 +220,18 @@ def get_reference_fname(dirs,layout,subject):
     '''
 
     # search for T1w filename in reference session
+    index = get_bids_index(layout.root)
     ref_dict = declare_subject_reference_dict()
     if subject in ref_dict.keys():
         # if subject is part of qMT cohort
         session = date_to_session(layout,subject,ref_dict[subject])
         if subject in ['M082','M089']: # override to make run-02 the T1w volume (space of Pejman's necrosis ROI for these subjects)
-            t1w_fnames = layout.get(subject=subject,session=session,run='02',return_type='filename',suffix='T1w',extension='nii.gz')
+            t1w_fnames = index.get(subject,session,run='02',suffix='T1w',extension='nii.gz')
         else:
-            t1w_fnames = layout.get(subject=subject,session=session,return_type='filename',suffix='T1w',extension='nii.gz')
+            t1w_fnames = index.get(subject,session,suffix='T1w',extension='nii.gz')
     else:
         session = 'MRL001'
-        t1w_fnames = layout.get(subject=subject,session=session,return_type='filename',suffix='T1w',extension='nii.gz')
+        t1w_fnames = index.get(subject,session,suffix='T1w',extension='nii.gz')
     
     # return last run (assumed that multiple runs done if the first few scans were unusable), if any T1w filenames exist
     if len(t1w_fnames)>0:
@@ -190,6 +253,7 @@ def get_source_fnames(dirs,dataset,layout,subject,session,force_t1w=False,mrl_fl
     '''
     # check inputs
     assert any([x == dataset for x in ['mrl','sim']]), 'dataset must be one of {mrl,sim}'
+    index = get_bids_index(layout.root)
 
     if dataset == 'sim':
 
@@ -198,18 +262,18 @@ def get_source_fnames(dirs,dataset,layout,subject,session,force_t1w=False,mrl_fl
         # get pre- and post-Gd T1w filenames; search for fatsat first, then inphase if one of the fatsat scans does not exist
         acqs = ['fatsat','inphase']
         for acq in acqs:
-            fnames = layout.get(subject=subject,session=session,suffix='T1w',extension='nii.gz',acquisition=acq,return_type='filename')
+            fnames = index.get(subject,session,suffix='T1w',extension='nii.gz',acquisition=acq)
             pre = any(['acq-'+acq+'_T1w' in x for x in fnames])
             post = any(['acq-'+acq+'_ce-GADOLINIUM_T1w' in x for x in fnames])
             if pre and post:
                 break
 
         # get DWI filenames and append to list of filenames
-        dwi_filenames = layout.get(subject=subject,session=session,suffix='dwi',extension='nii.gz',return_type='filename')
+        dwi_filenames = index.get(subject,session,suffix='dwi',extension='nii.gz')
         fnames = fnames + dwi_filenames
 
         # get FLAIR filename and append to list of filenames
-        flair_filenames = layout.get(subject=subject,session=session,suffix='FLAIR',extension='nii.gz',return_type='filename')
+        flair_filenames = index.get(subject,session,suffix='FLAIR',extension='nii.gz')
         for test_filename in reversed(flair_filenames): # find greatest run that is not an RGB image
             img = nib.load(test_filename)
             if img.header['datatype'] != 128:
@@ -228,37 +292,53 @@ def get_source_fnames(dirs,dataset,layout,subject,session,force_t1w=False,mrl_fl
        protocols = declare_protocol_names()
 
        # search for DWI filenames
-       dwi_fnames = layout.get(subject=subject,session=session,suffix='dwi',extension='nii.gz',return_type='filename')
+       dwi_fnames = index.get(subject,session,suffix='dwi',extension='nii.gz')
 
        if (len(dwi_fnames)==0) and (not force_t1w):
            fnames = []
        else:
 
            # get T1w filename
-           t1_fnames = layout.get(subject=subject,session=session,suffix='T1w',extension='nii.gz',return_type='filename')
+           t1_fnames = index.get(subject,session,suffix='T1w',extension='nii.gz')
            assert len(t1_fnames)>0, 'no T1w found: %s_%s' %(subject,session)
             
            # get FLAIR filenames
            if mrl_flair:
-               flair_fnames = layout.get(subject=subject,session=session,suffix='FLAIR',extension='nii.gz',return_type='filename')
+               flair_fnames = index.get(subject,session,suffix='FLAIR',extension='nii.gz')
 
            # create list of filenames
-           if subject == 'M125' and session == 'MRL017':
-               fnames = [t1_fnames[1]] # select run-02 because run-01 has bad FOV
-           else:
-               fnames = [t1_fnames[0]]
+           fnames = [select_mrl_t1w(t1_fnames,subject,session)]
 
            if len(dwi_fnames)>0:
-               if subject == 'M029' and session == 'MRL009':
-                   fnames.append(dwi_fnames[1]) # use run-02 (beam-on) DWI because run-01 (pre-beam) DWI has singular matrix
-               else:
-                   fnames.append(dwi_fnames[0])
+               fnames.append(select_mrl_dwi(dwi_fnames,subject,session))
 
            if len(flair_fnames)>0:
                fnames.append(flair_fnames[0])
 
     return fnames
 
+def select_mrl_t1w(t1_fnames,subject,session):
+    '''Returns the MR-Linac T1w of a session that is registered to the reference
+    Parameters
+        t1_fnames: T1w filenames of session, sorted by run
+        subject: subject name
+        session: session name
+    '''
+    if subject == 'M125' and session == 'MRL017':
+        return t1_fnames[1] # select run-02 because run-01 has bad FOV
+    return t1_fnames[0]
+
+def select_mrl_dwi(dwi_fnames,subject,session):
+    '''Returns the MR-Linac DWI of a session that is co-registered to the reference
+    Parameters
+        dwi_fnames: DWI filenames of session, sorted by run
+        subject: subject name
+        session: session name
+    '''
+    if subject == 'M029' and session == 'MRL009':
+        return dwi_fnames[1] # use run-02 (beam-on) DWI because run-01 (pre-beam) DWI has singular matrix
+    return dwi_fnames[0]
+
 def get_m0b_fname(dirs,layout,subject,session):
     '''Returns the filenames of the M0b map for a given subject and session, if it exists
     Parameters
@@ -0,0 +1,99 @@
+# in-process replacement for "flirt -applyxfm" for many volumes that share one transformation and reference
+#
+# The reference header and grid are read once, and the input voxel coordinates of each block of reference
+# voxels are computed once and used for every input volume on the same grid.
+# Outputs are checked against hand-worked references (test_apply_xfm.py), not against FLIRT itself: they can differ
+# from FLIRT at boundaries and where nearest neighbour coordinates fall exactly between voxels.
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from utils.preproc.fsl_matrix import fsl_vox2mm, read_fsl_matrix
+
+def ref_to_in_voxel_matrix(matrix,in_img,ref_img):
+    '''Returns the matrix from reference voxel indices to input voxel indices for a FLIRT matrix
+    Parameters:
+        matrix: 4x4 FLIRT matrix from input to reference
+        in_img: input nibabel image
+        ref_img: reference nibabel image
+    '''
+    return np.linalg.inv(fsl_vox2mm(in_img)) @ np.linalg.inv(matrix) @ fsl_vox2mm(ref_img)
+
+def resample_block(data,coords,interp):
+    '''Returns the values of a volume at voxel coordinates; coordinates outside the volume give 0
+    Parameters:
+        data: 3D or 4D array (4D volumes are resampled volume by volume)
+        coords: 3 x N array of voxel coordinates
+        interp: 'nearestneighbour' or 'trilinear'
+    Returns:
+        values: N array, or N x T array for 4D data
+    '''
+    shape = np.array(data.shape[:3])
+    n_vols = int(np.prod(data.shape[3:]))
+    values = np.zeros((coords.shape[1],n_vols),dtype=np.float64)
+    if interp == 'nearestneighbour':
+        index = np.floor(coords + 0.5).astype(np.int64)
+        inside = np.all((index >= 0) & (index < shape[:,None]),axis=0)
+        flat = np.ravel_multi_index(tuple(index[:,inside]),tuple(shape))
+        values[inside] = data.reshape(-1,n_vols)[flat]
+    else:
+        inside = np.all((coords >= 0) & (coords <= shape[:,None] - 1),axis=0)
+        vols = data.reshape(tuple(shape) + (n_vols,))
+        for ii in range(n_vols):
+            values[inside,ii] = ndimage.map_coordinates(vols[...,ii],coords[:,inside],order=1,mode='nearest')
+    return values.reshape((coords.shape[1],) + data.shape[3:])
+
+def apply_xfm_batch(in_fnames,ref_fname,matrix,out_fnames,interp='trilinear',block_size=16):
+    '''Resamples several volumes into the space of a reference with one FLIRT matrix, in one process
+    Parameters:
+        in_fnames: list of input filenames
+        ref_fname: reference filename (defines the output grid and header)
+        matrix: 4x4 FLIRT matrix from input to reference, or filename of .mat file
+        out_fnames: list of output filenames, one per input
+        interp: 'nearestneighbour' (e.g. ROIs) or 'trilinear'
+        block_size: number of reference slices resampled at a time
+    Notes:
+        - nearest neighbour rounds input coordinates half up; voxels mapped from outside the input are 0
+        - outputs keep the data type of their input; trilinear values are rounded for integer types
+    '''
+
+    # check inputs
+    assert len(in_fnames) == len(out_fnames), 'in_fnames and out_fnames must have the same length'
+    assert interp in ['nearestneighbour','trilinear'], 'interp must be one of {nearestneighbour,trilinear}'
+    if isinstance(matrix,str):
+        matrix = read_fsl_matrix(matrix)
+
+    # read reference header once
+    ref_img = nib.load(ref_fname)
+    ref_shape = ref_img.shape[:3]
+
+    # group inputs by grid, so that coordinates are computed once per grid
+    in_imgs = [nib.load(x) for x in in_fnames]
+    groups = {}
+    for ii, img in enumerate(in_imgs):
+        vox = ref_to_in_voxel_matrix(matrix,img,ref_img)
+        key = (img.shape[:3],tuple(np.round(vox,6).ravel()))
+        groups.setdefault(key,(vox,[]))[1].append(ii)
+
+    for vox, members in groups.values():
+        datas = [np.asanyarray(in_imgs[ii].dataobj) for ii in members]
+        outs = [np.zeros(ref_shape + x.shape[3:],dtype=np.float64) for x in datas]
+
+        # resample reference slices in blocks
+        for k0 in range(0,ref_shape[2],block_size):
+            k1 = min(k0 + block_size,ref_shape[2])
+            grid = np.mgrid[0:ref_shape[0],0:ref_shape[1],k0:k1].reshape(3,-1)
+            coords = vox[:3,:3] @ grid + vox[:3,3:]
+            for data, out in zip(datas,outs):
+                out[:,:,k0:k1] = resample_block(data,coords,interp).reshape((ref_shape[0],ref_shape[1],k1-k0) + data.shape[3:])
+
+        # write outputs with reference geometry and input data type
+        for ii, out in zip(members,outs):
+            dtype = in_imgs[ii].get_data_dtype()
+            if np.issubdtype(dtype,np.integer):
+                out = np.round(out)
+            header = ref_img.header.copy()
+            header.set_data_dtype(dtype)
+            out_img = nib.Nifti1Image(out.astype(dtype),ref_img.affine,header)
+            nib.save(out_img,out_fnames[ii])
+            print('resampled: %s -> %s' %(in_fnames[ii],out_fnames[ii]))
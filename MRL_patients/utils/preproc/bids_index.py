@@ -0,0 +1,154 @@
+# flat in-memory index of the files of a BIDS dataset, for the lookups made for every subject and session
+#
+# Files are found from their BIDS names (sub-<label>_ses-<label>[_<key>-<value>...]_<suffix>.<extension>) in
+# sub-*/ses-*/<datatype>/ folders, without going through the pybids database.
+
+import os
+import re
+import threading
+from os.path import join
+
+# process-wide cache of indexes: {root: BidsIndex}
+_index_cache = {}
+_index_lock = threading.Lock()
+
+# pybids names of the entities that are queried by this project
+ENTITY_KEYS = {'acquisition': 'acq', 'ceagent': 'ce', 'run': 'run', 'echo': 'echo', 'direction': 'dir'}
+
+def natural_key(fname):
+    '''Returns a key that sorts filenames with numbers in numerical order (as pybids does)'''
+    return [int(x) if x.isdigit() else x for x in re.split(r'(\d+)',fname)]
+
+def match_entity(key,value,query):
+    '''Returns True if an entity value matches a query value; runs are compared as numbers (e.g. '02' matches 2)'''
+    if value is None:
+        return False
+    if (key == 'run') and value.isdigit() and query.isdigit():
+        return int(value) == int(query)
+    return value == query
+
+def parse_bids_name(fname):
+    '''Returns the entities, suffix and extension of a BIDS filename, or None if the name is not a BIDS name
+    Parameters:
+        fname: filename (with or without folder)
+    Returns:
+        entities: dictionary of {key: value} (e.g. {'sub': 'M001', 'ses': 'MRL001', 'acq': 'fatsat'})
+        suffix: suffix (e.g. 'T1w')
+        extension: extension without leading dot (e.g. 'nii.gz')
+    '''
+    name = os.path.basename(fname)
+    if '.' not in name:
+        return None
+    stem, extension = name.split('.',1)
+    bits = stem.split('_')
+    entities = {}
+    for bit in bits[:-1]:
+        if '-' not in bit:
+            return None
+        key, value = bit.split('-',1)
+        entities[key] = value
+    return entities, bits[-1], extension
+
+class BidsIndex(object):
+    """
+    Index of a BIDS dataset from (subject, session, suffix, extension) to the files with those entities.
+    Each session is indexed separately and re-indexed only when its folders change (see refresh).
+
+    Args:
+        root (str): root of BIDS dataset
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}      # (subject, session) -> {(suffix, extension): list of (entities, filename)}
+        self.sessions = {}   # subject -> {session: stamp}
+        self.refresh()
+
+    def session_stamp(self, session_dir):
+        '''returns the modification times of a session folder and its datatype folders'''
+        stamp = [os.stat(session_dir).st_mtime_ns]
+        for entry in os.scandir(session_dir):
+            if entry.is_dir():
+                stamp.append((entry.name,entry.stat().st_mtime_ns))
+        return stamp
+
+    def index_session(self, subject, session):
+        '''(re-)indexes the files of one session'''
+        files = {}
+        session_dir = join(self.root,'sub-'+subject,'ses-'+session)
+        for entry in os.scandir(session_dir):
+            if not entry.is_dir():
+                continue
+            for f in os.scandir(entry.path):
+                parsed = parse_bids_name(f.name)
+                if parsed is None:
+                    continue
+                entities, suffix, extension = parsed
+                files.setdefault((suffix,extension),[]).append((entities,f.path))
+        for records in files.values():
+            records.sort(key=lambda x: natural_key(x[1]))
+        self.files[(subject,session)] = files
+
+    def refresh(self):
+        '''re-indexes new and changed sessions, and drops removed ones'''
+        n_indexed = 0
+        subjects = [x.name.replace('sub-','') for x in os.scandir(self.root) if x.is_dir() and x.name.startswith('sub-')]
+        for subject in list(self.sessions.keys()):
+            if subject not in subjects:
+                for session in self.sessions.pop(subject):
+                    self.files.pop((subject,session),None)
+        for subject in subjects:
+            subject_dir = join(self.root,'sub-'+subject)
+            sessions = [x.name.replace('ses-','') for x in os.scandir(subject_dir) if x.is_dir() and x.name.startswith('ses-')]
+            known = self.sessions.setdefault(subject,{})
+            for session in list(known.keys()):
+                if session not in sessions:
+                    del known[session]
+                    self.files.pop((subject,session),None)
+            for session in sessions:
+                stamp = self.session_stamp(join(subject_dir,'ses-'+session))
+                if known.get(session) != stamp:
+                    self.index_session(subject,session)
+                    known[session] = stamp
+                    n_indexed += 1
+        if n_indexed:
+            print('BIDS index: indexed %d sessions in %s' %(n_indexed,self.root))
+
+    def get_sessions(self, subject):
+        '''returns the sorted sessions of a subject'''
+        return sorted(self.sessions.get(subject,{}).keys())
+
+    def get(self, subject, session=None, suffix=None, extension='nii.gz', **entities):
+        '''returns the filenames that match the given entities, in the order of layout.get(return_type='filename')
+        args:
+            subject (str): subject label
+            session (str): session label; if None, all sessions of the subject
+            suffix (str): suffix (e.g. 'T1w')
+            extension (str): extension (e.g. 'nii.gz' or 'json')
+            entities: other entities using pybids names (acquisition, ceagent, run, ...)
+        '''
+        assert suffix, 'suffix must be given'
+        extension = extension.lstrip('.')
+        sessions = [session] if session else self.get_sessions(subject)
+        query = {ENTITY_KEYS.get(k,k): str(v) for k,v in entities.items() if v is not None}
+        fnames = []
+        for ses in sessions:
+            for ents, fname in self.files.get((subject,ses),{}).get((suffix,extension),[]):
+                if all([match_entity(k,ents.get(k),v) for k,v in query.items()]):
+                    fnames.append(fname)
+        if session is None:
+            fnames.sort(key=natural_key)
+        return fnames
+
+def get_bids_index(root,refresh=False):
+    '''Returns the index of a BIDS dataset, built once per process
+    Parameters:
+        root: root of BIDS dataset (e.g. layout.root)
+        refresh: if True, re-indexes the sessions that changed since the index was built
+    '''
+    with _index_lock:
+        if root not in _index_cache:
+            _index_cache[root] = BidsIndex(root)
+        elif refresh:
+            _index_cache[root].refresh()
+        return _index_cache[root]
@@ -0,0 +1,129 @@
+# build manifest: records the inputs, tool version and parameters that produced each derived file
+
+import sqlite3
+import hashlib
+import json
+import os
+from os.path import isfile, join, dirname
+from importlib import metadata
+
+def file_hash(fname,block_size=2**20):
+    '''Returns the SHA-256 hash of the contents of a file
+    Parameters:
+        fname: filename
+        block_size: number of bytes read at a time
+    Returns:
+        hex digest of hash
+    '''
+    h = hashlib.sha256()
+    with open(fname,'rb') as f:
+        for block in iter(lambda: f.read(block_size),b''):
+            h.update(block)
+    return h.hexdigest()
+
+def fsl_version():
+    '''Returns the version of FSL in $FSLDIR, or 'unknown' if it cannot be found'''
+    fname = join(os.environ.get('FSLDIR','/usr/local/fsl'),'etc','fslversion')
+    if isfile(fname):
+        with open(fname) as f:
+            version = f.read().strip()
+    else:
+        version = 'unknown'
+    return version
+
+def package_version(name):
+    '''Returns the version of an installed python package, or 'unknown' if it is not installed
+    Parameters:
+        name: name of package (e.g. 'HD_BET')
+    '''
+    try:
+        version = metadata.version(name)
+    except metadata.PackageNotFoundError:
+        version = 'unknown'
+    return version
+
+class BuildManifest(object):
+    """
+    SQLite record of how each derived file was built, kept in the root of a derivatives folder.
+    An output is current if the hashes of its inputs, the tool version and the parameters match those recorded when it was built.
+
+    Args:
+        db_fname (str): filename of database (e.g. <derivatives root>/build_manifest.sqlite)
+    """
+
+    def __init__(self, db_fname):
+        self.db_fname = db_fname
+        os.makedirs(dirname(db_fname),exist_ok=True)
+        with self.connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)')
+            con.execute('CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, inputs TEXT, tool TEXT, params TEXT)')
+        con.close()
+
+    def connect(self):
+        # connections are opened per call so that the manifest can be passed to worker processes
+        return sqlite3.connect(self.db_fname,timeout=60)
+
+    def hash(self, fname):
+        '''returns the hash of a file, re-reading the file only if its size or modification time changed'''
+        st = os.stat(fname)
+        con = self.connect()
+        with con:
+            row = con.execute('SELECT size, mtime_ns, sha256 FROM hashes WHERE path=?',(fname,)).fetchone()
+            if row and (row[0] == st.st_size) and (row[1] == st.st_mtime_ns):
+                sha = row[2]
+            else:
+                sha = file_hash(fname)
+                con.execute('INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)',(fname,st.st_size,st.st_mtime_ns,sha))
+        con.close()
+        return sha
+
+    def signature(self, in_fnames, tool, params):
+        '''returns the (inputs, tool, params) strings that are recorded for an output'''
+        inputs = json.dumps({x: self.hash(x) for x in in_fnames},sort_keys=True)
+        params = json.dumps(params,sort_keys=True)
+        return inputs, tool, params
+
+    def record(self, out_fnames, in_fnames, tool, params):
+        '''records the inputs, tool and parameters used to build a list of outputs'''
+        sig = self.signature(in_fnames,tool,params)
+        con = self.connect()
+        with con:
+            for out_fname in out_fnames:
+                con.execute('INSERT OR REPLACE INTO outputs VALUES (?,?,?,?)',(out_fname,)+sig)
+        con.close()
+
+    def is_current(self, out_fnames, in_fnames, tool, params):
+        '''returns True if all outputs were built from the same inputs, tool and parameters.
+        Outputs with no record (e.g. built before the manifest existed) are adopted as current.'''
+        sig = self.signature(in_fnames,tool,params)
+        con = self.connect()
+        rows = [con.execute('SELECT inputs, tool, params FROM outputs WHERE path=?',(x,)).fetchone() for x in out_fnames]
+        con.close()
+        unknown = [x for x,row in zip(out_fnames,rows) if row is None]
+        if unknown:
+            self.record(unknown,in_fnames,tool,params)
+        return all([(row is None) or (tuple(row) == sig) for row in rows])
+
+def get_manifest(root):
+    '''Returns the build manifest of a derivatives folder
+    Parameters:
+        root: root of derivatives folder (e.g. dirs['mr_linac'])
+    '''
+    return BuildManifest(join(root,'build_manifest.sqlite'))
+
+def needs_update(out_fnames,in_fnames,tool,params,overwrite=False,manifest=None):
+    '''Returns True if outputs must be (re)built
+    Parameters:
+        out_fnames: list of output filenames
+        in_fnames: list of input filenames that the outputs are built from
+        tool: name and version of tool that builds the outputs
+        params: dictionary of parameters of tool
+        overwrite: if True, outputs are always rebuilt
+        manifest: BuildManifest; if None, existing outputs are never rebuilt
+    '''
+    if overwrite or not all([isfile(x) for x in out_fnames]):
+        return True
+    if manifest is None:
+        return False
+    return not manifest.is_current(out_fnames,in_fnames,tool,params)
@@ -1,19 +1,31 @@
 # Imports
-from utils.preproc.seg_utils import do_hdbet
+from utils.preproc.seg_utils import do_hdbet, hdbet_batch
 import os
 from utils.preproc.project_parameters import get_reference_list, declare_directories
+from utils.preproc.parallel import unit, run_units
+from utils.preproc.build_manifest import get_manifest
+from utils.preproc.nifti_cache import get_nifti_cache
 
-def extract_brain(dirs,subjects):
+def extract_brain(dirs,subjects,jobs=1,batch=False,threads=1):
     '''Does brain extraction using HD-BET
     Parameters
         dirs: directories dictionary
         subjects: names of subjects
+        jobs: number of subjects to run in parallel (in batch mode, number of HD-BET workers)
+        batch: if True, runs HD-BET in worker processes that load the network once for many subjects,
+            instead of one hd-bet call per subject
+        threads: number of torch threads per HD-BET worker (batch mode only)
     '''
 
     # get parameters
     dirs = declare_directories()
     coreg_suffix = 'coreg' # suffix for coregistered volumes
     df = get_reference_list()
+    manifest = get_manifest(dirs['mr_linac'])
+    nifti_cache = get_nifti_cache(dirs['mr_linac'])
+    units = []
+    t1_paths = []
+    out_dirs = []
 
     # Loop subjects
     for subject in subjects:
@@ -33,6 +45,14 @@ def extract_brain(dirs,subjects):
         t1_path = os.path.join(dirs['bids'],'dataset-mrl','sub-'+subject,'ses-'+session,'anat',name_ref + '.nii.gz')
         if os.path.isfile(t1_path): 
             # Call HD-BET
-            do_hdbet(t1_path,out_dir)
+            units.append(unit(do_hdbet,t1_path,out_dir,manifest=manifest,nifti_cache=nifti_cache))
+            t1_paths.append(t1_path)
+            out_dirs.append(out_dir)
         else:
             print('%s: T1w file not found' %(subject))
+
+    # run subjects
+    if batch:
+        hdbet_batch(t1_paths,out_dirs,workers=jobs,threads=threads,manifest=manifest,nifti_cache=nifti_cache)
+    else:
+        run_units(units,jobs=jobs)
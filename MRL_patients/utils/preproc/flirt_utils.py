@@ -2,9 +2,74 @@ import nipype.interfaces.fsl as fsl
 from os import remove
 import os
 from os.path import basename, join, isfile
-import subprocess
+import numpy as np
+import nibabel as nib
+from utils.preproc.build_manifest import needs_update, fsl_version
+from utils.preproc.mi_registration import mi_register
+from utils.preproc.apply_xfm import apply_xfm_batch
+from utils.preproc.fsl_matrix import concat_matrix_files, invert_matrix_file
+from utils.preproc.parallel import fsl_slot, run_command
 
-def flirt_propagate(in_fname,ref_fname,roi_fnames,suffix,out_dir,overwrite=True,resample=0,inverse=False,remove_interim=True):
+def run_fsl(cmd):
+    '''Runs an FSL command line once one of the machine-wide FSL slots is free (see parallel.fsl_slot)
+    Parameters:
+        cmd: command line
+    Notes:
+        - raises RuntimeError if the command fails, so that its outputs are never recorded in a manifest
+    '''
+    with fsl_slot():
+        returncode, seconds = run_command(cmd)
+    if returncode != 0:
+        raise RuntimeError('FSL command failed with return code %d: %s' %(returncode,cmd))
+
+def extract_volume(fname,out_fname,index=0,nifti_cache=None):
+    '''Returns a 3D volume for tools that need one: a 3D input as it is, or one volume of a 4D input written to out_fname
+    Parameters:
+        fname: input filename
+        out_fname: filename of extracted volume (e.g. .nii in a work directory)
+        index: index of volume along the 4th dimension
+        nifti_cache: NiftiCache; if given, the volume is read from a memory-mapped uncompressed copy of the input
+    Notes:
+        - only the requested volume is read, by slicing the nibabel array proxy, so the other volumes are never written
+    '''
+    img = nifti_cache.load(fname) if nifti_cache else nib.load(fname)
+    if len(img.shape) == 3:
+        return nifti_cache.path(fname) if nifti_cache else fname
+    data = np.asanyarray(img.dataobj[(slice(None),)*3 + (index,) + (0,)*(len(img.shape)-4)])
+    header = img.header.copy()
+    header.set_data_dtype(data.dtype)
+    nib.save(nib.Nifti1Image(data,img.affine,header),out_fname)
+    return out_fname
+
+def resample_iso(fname,iso_fname,resample,work_dir,nifti_cache=None):
+    '''Resamples a volume (the first volume, if 4D) to isotropic voxels with FLIRT
+    Parameters:
+        fname: input filename
+        iso_fname: output filename; the resampling matrix is written alongside it (.mat)
+        resample: voxel size (mm)
+        work_dir: directory for the extracted first volume, which is deleted afterwards
+        nifti_cache: NiftiCache; if given, the input is read from its uncompressed copy
+    '''
+
+    # extract first volume
+    work_fname = join(work_dir,basename(fname).split('.')[0] + '_0000.nii')
+    vol_fname = extract_volume(fname,work_fname,0,nifti_cache)
+
+    # resample
+    iso = fsl.preprocess.FLIRT()
+    iso.inputs.in_file = vol_fname
+    iso.inputs.reference = iso.inputs.in_file
+    iso.inputs.apply_isoxfm = resample
+    iso.inputs.out_file = iso_fname
+    iso.inputs.out_matrix_file = iso_fname.replace('.nii.gz','.mat')
+    print(iso.cmdline)
+    run_fsl(iso.cmdline)
+
+    # delete extracted volume
+    if vol_fname == work_fname:
+        remove(vol_fname)
+
+def flirt_propagate(in_fname,ref_fname,roi_fnames,suffix,out_dir,overwrite=True,resample=0,inverse=False,remove_interim=True,manifest=None,backend='fsl',pyramid=None,iso_cache=None,transforms=None,nifti_cache=None):
     '''Registers input to reference and applies the same transformation to ROIs in the same space as the input
     Parameters:
         in_fname: input filename
@@ -16,64 +81,67 @@ def flirt_propagate(in_fname,ref_fname,roi_fnames,suffix,out_dir,overwrite=True,
         resample: if nonzero, resamples source and reference to 2 mm voxels before registration
         inverse: if true, will register reference to source then invert the transformation
         remove_interim: if true, will delete intermediate files used to estimate transformation
+        manifest: BuildManifest; if given, existing outputs are rebuilt when their inputs, FSL version or parameters changed
+        backend: 'fsl' to estimate the transformation with FLIRT, or 'python' to estimate it in-process (mi_registration.py), sampling at the resample spacing without writing resampled volumes
+        pyramid: for the 'python' backend, resolutions (mm) of coarse-to-fine registration (e.g. [8,4,2]); finer levels are skipped once mutual information stops improving
+        iso_cache: IsoCache; if given, the resampled reference is taken from (and added to) this cache instead of being resampled and deleted on every call
+        transforms: TransformStore; if given, the estimated matrices are added to it
+        nifti_cache: NiftiCache; if given, registration and resampling read uncompressed copies of the input and reference from this cache
     '''
 
     # check inputs
     assert resample>=0, 'resample must be non-negative'
+    assert backend in ['fsl','python'], 'backend must be one of {fsl,python}'
+    assert (not pyramid) or (backend == 'python'), 'pyramid registration requires the python backend'
+
+    # read input and reference from uncompressed copies if a cache is given; outputs and records keep the original names
+    read_fname = nifti_cache.path if nifti_cache else (lambda x: x)
         
     # register input to reference
     in_name = basename(in_fname).split('.')[0]
     out_basename = join(out_dir,in_name + '_' + suffix)
     out_fname = out_basename + '.nii.gz'
     in2ref_matrix_fname = out_basename + '.mat'
-    if isfile(in2ref_matrix_fname) and not overwrite:
+    tool = 'flirt ' + fsl_version()
+    reg_tool = tool if backend == 'fsl' else 'mi_registration'
+    reg_params = {'cost': 'mutualinfo', 'dof': 6, 'no_search': True, 'resample': resample, 'inverse': inverse}
+    if pyramid:
+        reg_params['pyramid'] = list(pyramid)
+    if backend == 'python':
+        reg_params['init'] = 'identity'
+    if not needs_update([in2ref_matrix_fname],[in_fname,ref_fname],reg_tool,reg_params,overwrite,manifest):
         print('skipping input-to-reference registration since output matrix exists: ' + in2ref_matrix_fname)
         print()
+    elif backend == 'python':
+        # estimate transformation in-process
+        mi_register(read_fname(in_fname),read_fname(ref_fname),in2ref_matrix_fname,sampling=resample,inverse=inverse,levels=pyramid)
+        if manifest:
+            manifest.record([in2ref_matrix_fname],[in_fname,ref_fname],reg_tool,reg_params)
     else:
         if resample:
             # resample source and reference
             resample_fnames = [in_fname,ref_fname]
             new_fnames = []
             for fname in resample_fnames:
+                if iso_cache and (fname == ref_fname):
+                    # reference is shared across sessions, so its resampled volume is cached
+                    iso_fname, _ = iso_cache.get(fname,resample)
+                    new_fnames.append(iso_fname)
+                    continue
                 name = basename(fname)
                 iso_fname = join(out_dir,name.replace('.nii.gz','_iso'+str(resample)+'.nii.gz'))
                 new_fnames.append(iso_fname)
-                if isfile(out_fname) and not overwrite:
-                    print('skipping resampling since iso volume already exists: ' + iso_fname)
-                else:
-                    # split volume
-                    spl = fsl.utils.Split()
-                    spl.inputs.in_file = fname
-                    spl.inputs.out_base_name = join(out_dir,name.replace('.nii.gz','_')) 
-                    spl.inputs.dimension = 't'
-                    print(spl.cmdline)
-                    spl_res = spl.run()
-                    if isinstance(spl_res.outputs.out_files,list):
-                        spl_fnames = spl_res.outputs.out_files
-                    else:
-                        spl_fnames = [spl_res.outputs.out_files]
-
-                    # resample
-                    iso = fsl.preprocess.FLIRT()
-                    iso.inputs.in_file = spl_fnames[0]
-                    iso.inputs.reference = iso.inputs.in_file
-                    iso.inputs.apply_isoxfm = 2
-                    iso.inputs.out_file = iso_fname
-                    iso.inputs.out_matrix_file = iso_fname.replace('.nii.gz','.mat')
-                    print(iso.cmdline)
-                    iso.run()
-                    
-                    # delete split volume files
-                    for spl_fname in spl_fnames:
-                        remove(spl_fname)
+                # always resample: this branch runs only when the registration is rebuilt, when an iso volume left
+                # behind by an earlier run may be of an input that has since changed
+                resample_iso(fname,iso_fname,resample,out_dir,nifti_cache)
         
             # update source and reference names for registration
             in_fname_reg = new_fnames[0]
             ref_fname_reg = new_fnames[1]
         else:
             # use passed source and reference
-            in_fname_reg = in_fname
-            ref_fname_reg = ref_fname
+            in_fname_reg = read_fname(in_fname)
+            ref_fname_reg = read_fname(ref_fname)
 
         if inverse:
             # if inverting transformation, swap input and reference
@@ -100,49 +168,52 @@ def flirt_propagate(in_fname,ref_fname,roi_fnames,suffix,out_dir,overwrite=True,
             cmd = flt.cmdline.replace('-out . ','-out ' + os.path.join(out_dir,'registered_' + out_vol_name) + ' ')
         print(cmd)
         print()
-        subprocess.call(cmd,shell=True)
+        run_fsl(cmd)
 
         if resample and remove_interim:
             # remove resampled volumes
             for new_fname in new_fnames:
+                if iso_cache and iso_cache.contains(new_fname):
+                    continue
                 print('removing resampled volumes and mat file: ' + new_fname)
                 remove(new_fname)
                 remove(new_fname.replace('.nii.gz','.mat'))
 
         if inverse:
             # invert transformation
-            invt = fsl.ConvertXFM()
-            invt.inputs.in_file = trans_matrix_fname
-            invt.inputs.invert_xfm = True
-            invt.inputs.out_file = in2ref_matrix_fname
-            print(invt.cmdline)
+            invert_matrix_file(trans_matrix_fname,in2ref_matrix_fname)
             print()
-            invt.run()
+
+        if manifest:
+            manifest.record([in2ref_matrix_fname],[in_fname,ref_fname],tool,reg_params)
+
+    if transforms and isfile(in2ref_matrix_fname):
+        transforms.add(in_fname,ref_fname,in2ref_matrix_fname)
 
     # apply transformation to ROIs
+    roi_tool = 'apply_xfm'
+    roi_params = {'interp': 'nearestneighbour'}
+    todo = []
     for roi_fname in roi_fnames:
         roi_name = basename(roi_fname).split('.')[0]
         out_basename = join(out_dir,roi_name + '_' + suffix)
         out_fname = out_basename + '.nii.gz'
+        roi_inputs = [roi_fname,ref_fname,in2ref_matrix_fname]
 
-        if isfile(out_fname) and not overwrite:
+        if not needs_update([out_fname],roi_inputs,roi_tool,roi_params,overwrite,manifest):
             print('skipping registration of other volume since output files exist:')
             print(out_fname)
             print()
         else:
+            todo.append((roi_fname,out_fname))
 
-            # apply transformation to ROI
-            applyxfm = fsl.preprocess.ApplyXFM()
-            applyxfm.inputs.in_file = roi_fname
-            applyxfm.inputs.uses_qform = False
-            applyxfm.inputs.in_matrix_file = in2ref_matrix_fname
-            applyxfm.inputs.out_matrix_file = in2ref_matrix_fname
-            applyxfm.inputs.reference = ref_fname
-            applyxfm.inputs.out_file = out_fname
-            applyxfm.inputs.interp = 'nearestneighbour'
-            print(applyxfm.cmdline)
-            print()
-            applyxfm.run()
+    if todo:
+        # apply transformation to all ROIs in one pass (same matrix and reference)
+        apply_xfm_batch([x[0] for x in todo],ref_fname,in2ref_matrix_fname,[x[1] for x in todo],interp='nearestneighbour')
+        print()
+        if manifest:
+            for roi_fname, out_fname in todo:
+                manifest.record([out_fname],[roi_fname,ref_fname,in2ref_matrix_fname],roi_tool,roi_params)
 
     # symlink to reference
     dst = join(out_dir,'reference.nii.gz')
@@ -152,7 +223,7 @@ def flirt_propagate(in_fname,ref_fname,roi_fnames,suffix,out_dir,overwrite=True,
     else:
         print('Symbolic link to reference already exists: ' + dst)
         
-def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=True,overwrite=True,create_intermediate=False,resample=0):
+def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=True,overwrite=True,create_intermediate=False,resample=0,manifest=None,backend='fsl',pyramid=None,iso_cache=None,transforms=None,nifti_cache=None):
     '''Registers input to reference and uses same transformation for other volumes
     Parameters:
         in_fname: input filename
@@ -164,66 +235,69 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
         create_intermediate: if True, creates intermediate other->in registered volume
         overwrite: overwrite existing files?
         resample: if nonzero, resamples source and reference to 2 mm voxels before registration
+        manifest: BuildManifest; if given, existing outputs are rebuilt when their inputs, FSL version or parameters changed
+        backend: 'fsl' to estimate transformations with FLIRT, or 'python' to estimate them in-process (mi_registration.py), sampling at the resample spacing without writing resampled volumes
+        pyramid: for the 'python' backend, resolutions (mm) of coarse-to-fine input-to-reference registration (e.g. [8,4,2]); finer levels are skipped once mutual information stops improving
+        iso_cache: IsoCache; if given, the resampled reference is taken from (and added to) this cache instead of being resampled and deleted on every call
+        transforms: TransformStore; if given, the estimated matrices are added to it
+        nifti_cache: NiftiCache; if given, registration and resampling read uncompressed copies of the input and reference from this cache
     Notes:
-        - if the input or reference is a 4D volume, "resample" must be non-zero
+        - if the input or reference is a 4D volume, "resample" must be non-zero for the 'fsl' backend
     '''
 
     # check inputs
     assert resample>=0, 'resample must be non-negative'
+    assert backend in ['fsl','python'], 'backend must be one of {fsl,python}'
+    assert (not pyramid) or (backend == 'python'), 'pyramid registration requires the python backend'
+
+    # read input and reference from uncompressed copies if a cache is given; outputs and records keep the original names
+    read_fname = nifti_cache.path if nifti_cache else (lambda x: x)
         
     # register input to reference
     in_name = basename(in_fname).split('.')[0]
     out_basename = join(out_dir,in_name + '_' + suffix)
     out_fname = out_basename + '.nii.gz'
     in2ref_matrix_fname = out_basename + '.mat'
-    if isfile(in2ref_matrix_fname) and not overwrite:
+    tool = 'flirt ' + fsl_version()
+    reg_tool = tool if backend == 'fsl' else 'mi_registration'
+    reg_params = {'cost': 'mutualinfo', 'dof': 6, 'no_search': True, 'resample': resample}
+    if pyramid:
+        reg_params['pyramid'] = list(pyramid)
+    if backend == 'python':
+        reg_params['init'] = 'identity'
+    if not needs_update([in2ref_matrix_fname],[in_fname,ref_fname],reg_tool,reg_params,overwrite,manifest):
         print('skipping input-to-reference registration since output matrix exists: ' + in2ref_matrix_fname)
         print()
+    elif backend == 'python':
+        # estimate transformation in-process
+        mi_register(read_fname(in_fname),read_fname(ref_fname),in2ref_matrix_fname,sampling=resample,levels=pyramid)
+        if manifest:
+            manifest.record([in2ref_matrix_fname],[in_fname,ref_fname],reg_tool,reg_params)
     else:
         if resample:
             # resample source and reference
             resample_fnames = [in_fname,ref_fname]
             new_fnames = []
             for fname in resample_fnames:
+                if iso_cache and (fname == ref_fname):
+                    # reference is shared across sessions, so its resampled volume is cached
+                    iso_fname, _ = iso_cache.get(fname,resample)
+                    new_fnames.append(iso_fname)
+                    continue
                 name = basename(fname)
                 iso_fname = join(out_dir,name.replace('.nii.gz','_iso'+str(resample)+'.nii.gz'))
                 new_fnames.append(iso_fname)
-                if isfile(out_fname) and not overwrite:
-                    print('skipping resampling since iso volume already exists: ' + iso_fname)
-                else:
-                    # split volume
-                    spl = fsl.utils.Split()
-                    spl.inputs.in_file = fname
-                    spl.inputs.out_base_name = join(out_dir,name.replace('.nii.gz','_')) 
-                    spl.inputs.dimension = 't'
-                    print(spl.cmdline)
-                    spl_res = spl.run()
-                    if isinstance(spl_res.outputs.out_files,list):
-                        spl_fnames = spl_res.outputs.out_files
-                    else:
-                        spl_fnames = [spl_res.outputs.out_files]
-
-                    # resample
-                    iso = fsl.preprocess.FLIRT()
-                    iso.inputs.in_file = spl_fnames[0]
-                    iso.inputs.reference = iso.inputs.in_file
-                    iso.inputs.apply_isoxfm = 2
-                    iso.inputs.out_file = iso_fname
-                    iso.inputs.out_matrix_file = iso_fname.replace('.nii.gz','.mat')
-                    print(iso.cmdline)
-                    iso.run()
-
-                    # delete split volume files
-                    for spl_fname in spl_fnames:
-                        remove(spl_fname)
+                # always resample: this branch runs only when the registration is rebuilt, when an iso volume left
+                # behind by an earlier run may be of an input that has since changed
+                resample_iso(fname,iso_fname,resample,out_dir,nifti_cache)
         
             # update source and reference names for registration
             in_fname_reg = new_fnames[0]
             ref_fname_reg = new_fnames[1]
         else:
             # use passed source and reference
-            in_fname_reg = in_fname
-            ref_fname_reg = ref_fname
+            in_fname_reg = read_fname(in_fname)
+            ref_fname_reg = read_fname(ref_fname)
 
         # estimate transformation
         flt = fsl.FLIRT(cost='mutualinfo')
@@ -236,30 +310,41 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
         cmd = flt.cmdline.replace('-out . ','')
         print(cmd)
         print()
-        subprocess.call(cmd,shell=True)
+        run_fsl(cmd)
 
         if resample:
             # remove resampled volumes
             for new_fname in new_fnames:
+                if iso_cache and iso_cache.contains(new_fname):
+                    continue
                 print('removing resampled volumes and mat file: ' + new_fname)
                 remove(new_fname)
                 remove(new_fname.replace('.nii.gz','.mat'))
 
-    if isfile(out_fname) and not overwrite:
+        if manifest:
+            manifest.record([in2ref_matrix_fname],[in_fname,ref_fname],tool,reg_params)
+
+    if transforms and isfile(in2ref_matrix_fname):
+        transforms.add(in_fname,ref_fname,in2ref_matrix_fname)
+
+    in2ref_inputs = [in_fname,ref_fname,in2ref_matrix_fname]
+    if not needs_update([out_fname],in2ref_inputs,tool,{},overwrite,manifest):
         print('skipping input-to-reference applyxfm since output volume exists: ' + out_fname)
         print()
     else:
         # apply transformation
         applyxfm_in2ref = fsl.preprocess.ApplyXFM()
-        applyxfm_in2ref.inputs.in_file = in_fname
-        applyxfm_in2ref.inputs.reference = ref_fname
+        applyxfm_in2ref.inputs.in_file = read_fname(in_fname)
+        applyxfm_in2ref.inputs.reference = read_fname(ref_fname)
         applyxfm_in2ref.inputs.out_file = out_fname
         applyxfm_in2ref.inputs.in_matrix_file = in2ref_matrix_fname
         applyxfm_in2ref.inputs.out_matrix_file = in2ref_matrix_fname
         applyxfm_in2ref.inputs.apply_xfm = True
         print(applyxfm_in2ref.cmdline)
         print()
-        applyxfm_in2ref.run() 
+        run_fsl(applyxfm_in2ref.cmdline)
+        if manifest:
+            manifest.record([out_fname],in2ref_inputs,tool,{})
 
     # apply transformation to other volumes
     for other_fname in other_fnames:
@@ -268,18 +353,31 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
         out_fname = out_basename + '.nii.gz'
         out_matrix_fname = out_basename + '.mat'
         p1_matrix_fname = out_basename + '_phase1.mat'
+        p1_inputs = [other_fname,in_fname]
+        p1_params = {'other_qform': other_qform}
+        if backend != 'fsl':
+            p1_params['backend'] = backend
+        # the phase 1 matrix is estimated in-process with the python backend, so it is recorded under that tool
+        p1_python = (not other_qform) and (backend == 'python')
+        p1_tool = 'mi_registration' if p1_python else tool
+        p1_reg_params = dict(p1_params,cost='mutualinfo',dof=6,no_search=True,init='identity') if p1_python else p1_params
+        other_inputs = [other_fname,in_fname,ref_fname,in2ref_matrix_fname]
 
-        if isfile(out_fname) and isfile(out_matrix_fname) and not overwrite:
+        if not needs_update([out_fname,out_matrix_fname],other_inputs,tool,p1_params,overwrite,manifest):
             print('skipping registration of other volume since output files exist:')
             print(out_fname)
             print(out_matrix_fname)
             print()
         else:
             # put volume into space of input file
-            if isfile(p1_matrix_fname) and not overwrite:
+            if not needs_update([p1_matrix_fname],p1_inputs,p1_tool,p1_reg_params,overwrite,manifest):
                 print('skipping registration of other volume to input volume since phase 1 matrix exists: ' + p1_matrix_fname)
             else:
-                if other_qform:
+                if p1_python:
+                    # estimate transformation in-process
+                    mi_register(read_fname(other_fname),read_fname(in_fname),p1_matrix_fname)
+                    cmd = ''
+                elif other_qform:
                     # use qform
                     applyxfm = fsl.preprocess.ApplyXFM()
                     applyxfm.inputs.in_file = other_fname
@@ -299,20 +397,17 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
                     flt_other.inputs.out_file = ''
                     flt_other.inputs.out_matrix_file = p1_matrix_fname
                     cmd = flt_other.cmdline.replace('-out . ','')
-                print(cmd)
-                print()
-                subprocess.call(cmd,shell=True)
+                if cmd:
+                    print(cmd)
+                    print()
+                    run_fsl(cmd)
+                if manifest:
+                    manifest.record([p1_matrix_fname],p1_inputs,p1_tool,p1_reg_params)
 
 
             # concatenate matrices
-            concat = fsl.ConvertXFM()
-            concat.inputs.in_file2 = in2ref_matrix_fname
-            concat.inputs.in_file = p1_matrix_fname
-            concat.inputs.concat_xfm = True
-            concat.inputs.out_file = out_matrix_fname
-            print(concat.cmdline)
+            concat_matrix_files(p1_matrix_fname,in2ref_matrix_fname,out_matrix_fname)
             print()
-            concat.run() 
 
             # apply transformation to volume
             applyxfm = fsl.preprocess.ApplyXFM()
@@ -320,17 +415,24 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
             applyxfm.inputs.uses_qform = False
             applyxfm.inputs.in_matrix_file = out_matrix_fname
             applyxfm.inputs.out_matrix_file = out_matrix_fname
-            applyxfm.inputs.reference = ref_fname
+            applyxfm.inputs.reference = read_fname(ref_fname)
             applyxfm.inputs.out_file = out_fname
             print(applyxfm.cmdline)
             print()
-            applyxfm.run()
+            run_fsl(applyxfm.cmdline)
+            if manifest:
+                manifest.record([out_fname,out_matrix_fname],other_inputs,tool,p1_params)
+
+        if transforms:
+            for (src,dst,matrix_fname) in [(other_fname,in_fname,p1_matrix_fname),(other_fname,ref_fname,out_matrix_fname)]:
+                if isfile(matrix_fname):
+                    transforms.add(src,dst,matrix_fname)
         
         # create intermediate other->in registered volume 
         if create_intermediate:
             # apply phase 1 transformation to other volume
             out_p1_fname = out_basename + '_phase1.nii.gz'
-            if isfile(out_p1_fname) and not overwrite:
+            if not needs_update([out_p1_fname],[other_fname,in_fname,p1_matrix_fname],tool,{},overwrite,manifest):
                 print('phase 1 registered volume already exists: ' + out_p1_fname)
             else:
                 applyxfm = fsl.preprocess.ApplyXFM()
@@ -342,4 +444,58 @@ def flirt_volumes(in_fname,ref_fname,other_fnames,suffix,out_dir,other_qform=Tru
                 applyxfm.inputs.apply_xfm = True
                 print(applyxfm.cmdline)
                 print()
-                applyxfm.run()
+                run_fsl(applyxfm.cmdline)
+                if manifest:
+                    manifest.record([out_p1_fname],[other_fname,in_fname,p1_matrix_fname],tool,{})
+
+def propagate_chain(in_fnames,src_fname,dst_fname,transforms,suffix,out_dir,interp='nearestneighbour',intermediate_fnames=None,overwrite=True,manifest=None):
+    '''Resamples volumes in the space of one volume into the space of another in a single step, composing the chain of registrations between them
+    Parameters:
+        in_fnames: list of filenames of volumes (e.g. contours) in the space of src_fname
+        src_fname: filename of the volume on which the inputs are defined
+        dst_fname: filename of the destination volume
+        transforms: TransformStore holding the registrations that connect src_fname and dst_fname
+        suffix: suffix to append to the resampled volumes
+        out_dir: output directory
+        interp: 'nearestneighbour' (e.g. contours) or 'trilinear'
+        intermediate_fnames: optional list of volumes on the way (e.g. the reference) into whose space the inputs are also written;
+            these are resampled from the inputs as well, never from another resampled volume
+        overwrite: overwrite existing files?
+        manifest: BuildManifest; if given, existing outputs are rebuilt when their inputs or matrices changed
+    Returns:
+        out_fnames: filenames of the inputs resampled into the space of dst_fname
+    '''
+
+    # declare parameters
+    tool = 'apply_xfm'
+    params = {'interp': interp}
+    spaces = (intermediate_fnames if intermediate_fnames else []) + [dst_fname]
+
+    for space_fname in spaces:
+
+        # compose matrices from source to this space
+        matrix_fname = transforms.matrix_file(src_fname,space_fname)
+        if space_fname == dst_fname:
+            space_suffix = suffix
+        else:
+            space_suffix = suffix + '_' + basename(space_fname).split('.')[0]
+
+        todo = []
+        out_fnames = []
+        for in_fname in in_fnames:
+            out_fname = join(out_dir,basename(in_fname).split('.')[0] + '_' + space_suffix + '.nii.gz')
+            out_fnames.append(out_fname)
+            if not needs_update([out_fname],[in_fname,space_fname,matrix_fname],tool,params,overwrite,manifest):
+                print('skipping propagation since output volume exists: ' + out_fname)
+            else:
+                todo.append((in_fname,out_fname))
+
+        if todo:
+            # resample all inputs once, directly from the source
+            apply_xfm_batch([x[0] for x in todo],space_fname,matrix_fname,[x[1] for x in todo],interp=interp)
+            print()
+            if manifest:
+                for in_fname, out_fname in todo:
+                    manifest.record([out_fname],[in_fname,space_fname,matrix_fname],tool,params)
+
+    return out_fnames
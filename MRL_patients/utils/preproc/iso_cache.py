@@ -0,0 +1,102 @@
+# persistent cache of volumes resampled to isotropic voxels, shared by the registrations of every session to the same reference
+
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+from contextlib import contextmanager
+from os.path import join, isfile, getsize, getmtime, dirname, abspath
+from utils.preproc.build_manifest import BuildManifest
+from utils.preproc.flirt_utils import resample_iso
+
+class IsoCache(object):
+    """
+    Cache of resampled volumes (and their resampling matrices) kept in one directory.
+    Entries are keyed by the SHA-256 of the source file and the voxel size, so a source that changes is resampled again.
+    Least recently used entries are removed once the cache exceeds its disk budget. Entries used within the grace
+    period are never removed, since the workers that were given them may still be reading them (e.g. with FLIRT).
+
+    Args:
+        cache_dir (str): directory of cache (e.g. <derivatives root>/iso_cache)
+        budget (float): disk budget in GB
+        grace (float): time (s) after its last use during which an entry is kept, even over budget
+    """
+
+    def __init__(self, cache_dir, budget=5., grace=3600.):
+        self.cache_dir = abspath(cache_dir)
+        self.budget = budget
+        self.grace = grace
+        # hashes of source files are kept with their size and modification time, so unchanged sources are not re-read
+        self.hashes = BuildManifest(join(self.cache_dir,'hashes.sqlite'))
+
+    def entry(self, fname, resample):
+        '''returns the filenames of the cached volume and matrix for a source file and voxel size'''
+        key = '%s_iso%s' %(self.hashes.hash(fname),resample)
+        iso_fname = join(self.cache_dir,key + '.nii.gz')
+        return iso_fname, iso_fname.replace('.nii.gz','.mat')
+
+    @contextmanager
+    def locked(self, mode):
+        '''holds the lock of the cache directory while the block runs; entries are looked up and marked as used under a
+        shared lock (fcntl.LOCK_SH), and removed under an exclusive lock (fcntl.LOCK_EX), so an entry is never removed
+        between being found and being marked'''
+        with open(join(self.cache_dir,'.lock'),'w') as f:
+            fcntl.flock(f,mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f,fcntl.LOCK_UN)
+
+    def contains(self, fname):
+        '''returns True if a filename is an entry of the cache'''
+        return dirname(abspath(fname)) == self.cache_dir
+
+    def get(self, fname, resample):
+        '''returns the filenames of the resampled volume and matrix of a source file, resampling it if it is not cached
+        args:
+            fname (str): source filename
+            resample (float): voxel size (mm)
+        '''
+        iso_fname, iso_matrix_fname = self.entry(fname,resample)
+        with self.locked(fcntl.LOCK_SH):
+            cached = isfile(iso_fname) and isfile(iso_matrix_fname)
+            if cached:
+                # mark as recently used, which keeps the entry for the grace period while the caller reads it
+                os.utime(iso_fname)
+        if cached:
+            print('using cached iso volume: %s (%s)' %(iso_fname,fname))
+        else:
+            # resample in a private directory, then move into place so that concurrent workers never read a partial file
+            work_dir = tempfile.mkdtemp(dir=self.cache_dir)
+            try:
+                work_fname = join(work_dir,'iso.nii.gz')
+                resample_iso(fname,work_fname,resample,work_dir)
+                os.replace(work_fname.replace('.nii.gz','.mat'),iso_matrix_fname)
+                os.replace(work_fname,iso_fname)
+            finally:
+                shutil.rmtree(work_dir,ignore_errors=True)
+            print('cached iso volume: %s (%s)' %(iso_fname,fname))
+            self.evict(keep=iso_fname)
+        return iso_fname, iso_matrix_fname
+
+    def evict(self, keep=None):
+        '''removes least recently used entries until the cache is within its disk budget; entries used within the
+        grace period are kept
+        args:
+            keep (str): entry that is never removed (e.g. the entry just added)
+        '''
+        with self.locked(fcntl.LOCK_EX):
+            entries = [join(self.cache_dir,x) for x in os.listdir(self.cache_dir) if x.endswith('.nii.gz')]
+            mtimes = {x: getmtime(x) for x in entries}
+            entries.sort(key=mtimes.get,reverse=True)
+            now = time.time()
+            total = 0
+            for iso_fname in entries:
+                iso_matrix_fname = iso_fname.replace('.nii.gz','.mat')
+                total += getsize(iso_fname) + (getsize(iso_matrix_fname) if isfile(iso_matrix_fname) else 0)
+                if (total > self.budget*1e9) and (iso_fname != keep) and (now - mtimes[iso_fname] > self.grace):
+                    print('removing least recently used iso volume: ' + iso_fname)
+                    for x in [iso_fname,iso_matrix_fname]:
+                        if isfile(x):
+                            os.remove(x)
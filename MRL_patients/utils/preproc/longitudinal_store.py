@@ -0,0 +1,189 @@
+# per-subject store of co-registered volumes, packed as one chunked, compressed HDF5 array (session x contrast x X x Y x Z)
+#
+# After align_volumes, all volumes of a subject are on the grid of its reference volume, so the volumes of every session
+# and contrast can be stacked; voxelwise longitudinal analyses then read a few chunks instead of every .nii.gz file.
+
+import os
+import h5py
+import numpy as np
+import nibabel as nib
+from os.path import join, isfile, isdir, getmtime, basename
+from utils.preproc.bids_index import parse_bids_name, natural_key
+from utils.preproc.parallel import unit, run_units
+from utils.preproc.io import func_msg
+
+def contrast_name(fname):
+    '''Returns the contrast of a co-registered volume from its BIDS name (e.g. 'T1w', 'T1w_acq-fatsat', 'dwi', 'm0b'), or '' if the name is not a BIDS name'''
+    parsed = parse_bids_name(basename(fname).replace('_coreg.','.'))
+    if parsed is None:
+        return ''
+    entities, suffix, extension = parsed
+    name = suffix
+    for key in ['acq','ce','run']:
+        if key in entities:
+            name += '_%s-%s' %(key,entities[key])
+    return name
+
+def get_session_volumes(dirs,subject,session):
+    '''Returns a dictionary {contrast: filename} of the co-registered volumes of an MR-Linac session (coreg/ and qmt/ folders)'''
+    fnames = []
+    for folder in [join(dirs['mr_linac'],'coreg','sub-'+subject,'ses-'+session),join(dirs['mr_linac'],'qmt','sub-'+subject,'ses-'+session)]:
+        if isdir(folder):
+            fnames += [join(folder,x) for x in os.listdir(folder) if x.endswith('.nii.gz') and contrast_name(x)]
+    return {contrast_name(x): x for x in sorted(fnames,key=natural_key)}
+
+def store_fname(dirs,subject):
+    '''Returns the filename of the longitudinal store of a subject'''
+    return join(dirs['mr_linac'],'longitudinal','sub-%s.h5' %(subject))
+
+def export_subject(dirs,subject,overwrite=False,chunks=(1,1,32,32,16),compression='gzip',compression_opts=4):
+    '''Packs the co-registered volumes of all MR-Linac sessions of a subject into one HDF5 store
+    Parameters:
+        dirs: directories dictionary
+        subject: subject name
+        overwrite: if True, the store is rewritten even if no volume changed
+        chunks: chunk shape (sessions, contrasts, x, y, z); clipped to the array shape. Volumes are written one session at a
+            time, so a chunk spanning several sessions would be decompressed and compressed again for each of them
+        compression, compression_opts: HDF5 compression filter and level
+    Returns:
+        fname: filename of store
+    Notes:
+        - the store holds the dataset 'volumes' (float32, NaN where a session has no volume of a contrast), 'present' (bool,
+          session x contrast), and attributes sessions, contrasts, affine and the filenames and modification times of sources
+        - each contrast of a 4D volume (e.g. DWI) is stored as one contrast per volume (dwi[0], dwi[1], ...)
+        - volumes that are not on the grid of the first T1w are skipped
+        - volumes are written one at a time, so memory use is one volume
+    '''
+
+    # get volumes of sessions
+    coreg_dir = join(dirs['mr_linac'],'coreg','sub-'+subject)
+    sessions = sorted([x.replace('ses-','') for x in os.listdir(coreg_dir) if x.startswith('ses-')],key=natural_key) if isdir(coreg_dir) else []
+    volumes = {x: get_session_volumes(dirs,subject,x) for x in sessions}
+    sources = sorted(set([y for x in volumes.values() for y in x.values()]),key=natural_key)
+    fname = store_fname(dirs,subject)
+    if not sources:
+        print('no co-registered volumes: ' + subject)
+        return ''
+
+    # skip if store is current
+    mtimes = [getmtime(x) for x in sources]
+    if isfile(fname) and not overwrite:
+        with h5py.File(fname,'r') as f:
+            current = (list(f.attrs['sources']) == sources) and np.allclose(f.attrs['mtimes'],mtimes)
+        if current:
+            print('Longitudinal store is up to date: ' + fname)
+            return fname
+
+    # declare reference grid (that of the first T1w) and contrasts, expanding 4D volumes into one contrast per volume
+    ref_fname = ([y for x in sessions for c, y in volumes[x].items() if c.startswith('T1w')] + sources)[0]
+    ref_img = nib.load(ref_fname)
+    grid = (ref_img.shape[:3],ref_img.affine)
+    contrasts = []
+    for session in sessions:
+        for contrast, src in list(volumes[session].items()):
+            img = nib.load(src)
+            if img.shape[:3] != grid[0] or not np.allclose(img.affine,grid[1],atol=1e-3):
+                print('volume is not on reference grid, skipping: ' + src)
+                del volumes[session][contrast]
+                continue
+            names = [contrast] if len(img.shape) == 3 else ['%s[%d]' %(contrast,ii) for ii in range(int(np.prod(img.shape[3:])))]
+            contrasts += [x for x in names if x not in contrasts]
+    shape = (len(sessions),len(contrasts)) + grid[0]
+
+    # write volumes to a temporary file, then move into place so that readers never see a partial store
+    os.makedirs(os.path.dirname(fname),exist_ok=True)
+    tmp_fname = fname + '.part'
+    with h5py.File(tmp_fname,'w') as f:
+        dset = f.create_dataset('volumes',shape=shape,dtype=np.float32,chunks=tuple(min(x,y) for x,y in zip(chunks,shape)),
+            compression=compression,compression_opts=compression_opts,fillvalue=np.nan)
+        present = np.zeros(shape[:2],dtype=bool)
+        for ix, session in enumerate(sessions):
+            for contrast, src in volumes[session].items():
+                img = nib.load(src)
+                if len(img.shape) == 3:
+                    dset[ix,contrasts.index(contrast)] = img.get_fdata(dtype=np.float32)
+                    present[ix,contrasts.index(contrast)] = True
+                else:
+                    for ii in range(int(np.prod(img.shape[3:]))):
+                        index = np.unravel_index(ii,img.shape[3:])
+                        jx = contrasts.index('%s[%d]' %(contrast,ii))
+                        dset[ix,jx] = np.asarray(img.dataobj[(slice(None),)*3 + tuple(index)],dtype=np.float32)
+                        present[ix,jx] = True
+        f.create_dataset('present',data=present)
+        f.attrs['subject'] = subject
+        f.attrs['sessions'] = sessions
+        f.attrs['contrasts'] = contrasts
+        f.attrs['affine'] = grid[1]
+        f.attrs['sources'] = sources
+        f.attrs['mtimes'] = mtimes
+    os.replace(tmp_fname,fname)
+    print('Longitudinal store written: %s (%d sessions x %d contrasts)' %(fname,len(sessions),len(contrasts)))
+    return fname
+
+def export_subjects(dirs,subjects,overwrite=False,jobs=1):
+    '''Packs the co-registered volumes of subjects into longitudinal stores (see export_subject)
+    Parameters:
+        dirs: directories dictionary
+        subjects: names of subjects
+        overwrite: if True, stores are rewritten even if no volume changed
+        jobs: number of subjects to run in parallel
+    '''
+    func = 'export_subjects'
+    func_msg(func,'start')
+    run_units([unit(export_subject,dirs,x,overwrite) for x in subjects],jobs=jobs)
+    func_msg(func,'end')
+
+class LongitudinalStore(object):
+    """
+    Reader of the longitudinal store of a subject (see export_subject); use as a context manager or call close().
+
+    Args:
+        fname (str): filename of store
+    """
+
+    def __init__(self, fname):
+        self.file = h5py.File(fname,'r')
+        self.volumes = self.file['volumes']
+        self.sessions = [str(x) for x in self.file.attrs['sessions']]
+        self.contrasts = [str(x) for x in self.file.attrs['contrasts']]
+        self.affine = np.array(self.file.attrs['affine'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def present(self):
+        '''returns a boolean array (session x contrast) of the volumes in the store'''
+        return self.file['present'][()]
+
+    def volume(self, session, contrast):
+        '''returns the 3D volume of a session and contrast'''
+        return self.volumes[self.sessions.index(session),self.contrasts.index(contrast)]
+
+    def image(self, session, contrast):
+        '''returns the volume of a session and contrast as a nibabel image on the reference grid'''
+        return nib.Nifti1Image(self.volume(session,contrast),self.affine)
+
+    def series(self, contrast, index=(slice(None),)*3, sessions=None):
+        '''returns the values of a contrast in a region for several sessions, as a session x region array
+        args:
+            contrast (str): contrast
+            index (tuple): slices of x, y and z (e.g. a bounding box); chunks outside the region are not read
+            sessions (list): sessions (default = all)
+        '''
+        jx = self.contrasts.index(contrast)
+        if sessions is None:
+            return self.volumes[(slice(None),jx) + tuple(index)]
+        return np.stack([self.volumes[(self.sessions.index(x),jx) + tuple(index)] for x in sessions])
+
+    def voxels(self, contrast, mask, sessions=None):
+        '''returns the values of a contrast in the voxels of a mask, as a session x voxel array; only the bounding box of the mask is read'''
+        where = np.nonzero(mask)
+        box = tuple(slice(x.min(),x.max()+1) for x in where)
+        values = self.series(contrast,box,sessions)
+        return values[(slice(None),) + tuple(x - y.start for x,y in zip(where,box))]
@@ -0,0 +1,289 @@
+# volumes of low-ADC regions, computed from co-registered ADC maps and tumour contours and written in the
+# table schema read by the R scripts:
+#     dyn_table.csv (= MRL_dyn_table.csv): Subject, Session, Day, TumourcoreSession, Metric, Value
+#     dyn_table_baseline.csv: Subject, Metric, Value
+#     response_correlation_dataframe.csv: one row per subject and event, with % changes from baseline per metric and timepoint
+#
+# The low-ADC region of a session is the set of voxels of its ADC map below a threshold inside the GTV contoured on
+# an MR-sim session (the "tumourcore session"), as in utils/qmri_rois/create_low_adc.m. Voxels with ADC <= 0 are not
+# counted: adc_fit.py writes 0 where the fit failed (e.g. outside the brain mask or where the signal is too low).
+
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from os.path import join, isdir, isfile
+from utils.preproc.io import func_msg
+from utils.preproc.apply_xfm import resample_block
+from utils.preproc.sparse_mask import SparseMask
+
+# declare parameters
+ADC_THRESHOLD = 1.25 # low-ADC threshold (units of ADC maps, i.e. 10^-3 mm^2/s)
+BOUNDARY_THRESHOLD = 0.9 # contours resampled to the grid of an ADC map are thresholded at this value
+METRIC_NAMES = {'VolumeLowADC': 'dLowADC', 'VolumeTumourcore': 'dGTV'}
+MEDIAN_EVENT_TIMES = {'Death': 14.6, 'Progression': 6.9} # months, for RT + TMZ from Stupp et al., New Engl J Med, 2005
+
+def get_sessions(subject_dir):
+    '''Returns the sorted session names (without "ses-") in a subject folder, or [] if the folder does not exist'''
+    if not isdir(subject_dir):
+        return []
+    return sorted([x.replace('ses-','') for x in os.listdir(subject_dir) if x.startswith('ses-')])
+
+def get_keyed_fname(folder,key,extension='.nii.gz'):
+    '''Returns the filename in a folder that contains a key and ends with an extension, or '' if there is none'''
+    if not isdir(folder):
+        return ''
+    fnames = sorted([x for x in os.listdir(folder) if (key in x) and x.endswith(extension)])
+    assert len(fnames)<=1, 'multiple files with key %s found: %s' %(key,folder)
+    return join(folder,fnames[0]) if fnames else ''
+
+def get_contour_fnames(dirs,subject,session):
+    '''Returns the filenames of the GTV contour(s) of an MR-sim session, or [] if a contour is missing
+    Parameters:
+        dirs: directories dictionary
+        subject: subject name
+        session: MR-sim session (e.g. 'sim001')
+    '''
+    roi_names = ['GTV1','GTV2'] if subject == 'M174' else ['GTV']
+    folder = join(dirs['mr_sim'],'glio_contours','sub-'+subject,'ses-'+session)
+    fnames = []
+    for roi_name in roi_names:
+        # 'GTV' must not match 'GTV1' or 'GTV2'
+        keyed = [x for x in (os.listdir(folder) if isdir(folder) else []) if (roi_name in x) and x.endswith('.nii.gz') and not x.split(roi_name,1)[1][:1].isdigit()]
+        assert len(keyed)<=1, 'multiple ROIs found: %s' %(folder)
+        if not keyed:
+            return []
+        fnames.append(join(folder,keyed[0]))
+    return fnames
+
+def mask_volume(fname):
+    '''Returns the volume (cc) of the nonzero voxels of a mask, on its own grid'''
+    return SparseMask.load(fname).volume()
+
+def resample_mask(fname,ref_img):
+    '''Returns a mask on the grid of a reference image: the mask is resampled through the world (sform) coordinates
+    of both images with trilinear interpolation and thresholded at BOUNDARY_THRESHOLD'''
+    img = nib.load(fname)
+    data = np.asanyarray(img.dataobj)
+    ref_shape = ref_img.shape[:3]
+    if (data.shape[:3] == ref_shape) and np.allclose(img.affine,ref_img.affine,atol=1e-4):
+        return data > BOUNDARY_THRESHOLD
+    vox = np.linalg.inv(img.affine) @ ref_img.affine
+    grid = np.indices(ref_shape).reshape(3,-1)
+    coords = vox[:3,:3] @ grid + vox[:3,3:]
+    return resample_block((data > 0).astype(np.float32),coords,'trilinear').reshape(ref_shape) > BOUNDARY_THRESHOLD
+
+def low_adc_volumes(adc_fnames,bound_fnames,threshold=ADC_THRESHOLD,ref_fnames=None):
+    '''Computes the volumes of the low-ADC regions of all sessions of a subject within all boundary ROIs
+    Parameters:
+        adc_fnames: list of ADC map filenames (one per session)
+        bound_fnames: list of boundary ROIs, each a list of contour filenames whose union is the boundary (multifocal tumours)
+        threshold: ADC threshold; if ref_fnames are given, a fraction of the median ADC in the reference ROI of each session
+        ref_fnames: list of reference ROI filenames (e.g. contralateral WM), one per session
+    Returns:
+        volumes: array of low-ADC volumes (cc), sessions x boundaries
+    Notes:
+        - sessions on the same grid (i.e. all co-registered sessions) are stacked as one 4D array and thresholded together
+        - boundary ROIs are resampled once per grid, and the contours of a multifocal boundary are resampled one by one
+          and joined as sparse masks (as in create_low_adc.m), so a boundary is read at its voxels only
+        - voxels with ADC <= 0 (unfit voxels of adc_fit.py) are neither low-ADC voxels nor part of the reference median
+    '''
+
+    # group sessions by grid
+    imgs = [nib.load(x) for x in adc_fnames]
+    groups = {}
+    for ix, img in enumerate(imgs):
+        key = (img.shape[:3],tuple(np.round(img.affine,4).ravel()))
+        groups.setdefault(key,[]).append(ix)
+
+    volumes = np.zeros((len(adc_fnames),len(bound_fnames)))
+    for members in groups.values():
+        ref_img = imgs[members[0]]
+
+        # stack ADC maps of sessions as voxels x sessions, voxels in the on-disk order of sparse masks
+        adc = np.stack([imgs[ix].get_fdata(dtype=np.float32).reshape(-1,order='F') for ix in members],axis=1)
+
+        # declare thresholds of sessions
+        thresholds = np.full(len(members),threshold,dtype=np.float32)
+        if ref_fnames:
+            for ii, ix in enumerate(members):
+                ref = resample_mask(ref_fnames[ix],ref_img).reshape(-1,order='F') & (adc[:,ii] > 0)
+                thresholds[ii] = threshold*np.nanmedian(adc[ref,ii])
+
+        # count low-ADC voxels of each (session, boundary) pair within the union of the resampled contours of the boundary
+        low = (adc > 0) & (adc < thresholds)
+        voxel_volume = np.prod(np.array(ref_img.header.get_zooms()[:3],dtype=float))*1e-3
+        for k, fnames in enumerate(bound_fnames):
+            bound = SparseMask.from_array(resample_mask(fnames[0],ref_img),ref_img.affine)
+            for fname in fnames[1:]:
+                bound = bound | SparseMask.from_array(resample_mask(fname,ref_img),ref_img.affine)
+            volumes[members,k] = low[bound.index].sum(axis=0)*voxel_volume
+
+    return volumes
+
+def read_session_days(dirs,scanner):
+    '''Returns a dictionary {(subject, session): treatment day} from the session-day table of a scanner ('mrl' or 'sim')'''
+    fname = join(dirs['proj'],'results','metadata','session_day_'+scanner+'.csv')
+    if not isfile(fname):
+        print('Session-day table not found, days are left empty: ' + fname)
+        return {}
+    df = pd.read_csv(fname,dtype={'Subject':str,'Session':str})
+    return dict(zip(zip(df['Subject'],df['Session']),df['TxDay']))
+
+def make_dyn_table(dirs,subjects,threshold=ADC_THRESHOLD,adc_type='original',reference_roi=None,out_fname=None):
+    '''Computes the low-ADC and tumour core volumes of every MR-Linac and MR-sim session and writes the table of volume dynamics
+    Parameters:
+        dirs: directories dictionary
+        subjects: names of subjects
+        threshold: ADC threshold (see low_adc_volumes)
+        adc_type: MR-Linac ADC maps to use {original, adjusted}
+        reference_roi: if given ('wm', 'gm' or 'csf'), the threshold is relative to the median ADC in the contralateral ROI of
+            each session (<seg folder>/*_<reference_roi>.nii.gz, see seg_utils.contralateral_rois)
+        out_fname: output filename (default = <proj>/results/volume_dynamics/dyn_table[_adc_adjusted].csv)
+    Returns:
+        df: table of volume dynamics
+    '''
+
+    # communicate with user
+    func = 'make_dyn_table'
+    func_msg(func,'start')
+
+    # check inputs
+    assert adc_type in ['original','adjusted'], 'adc_type must be one of {original,adjusted}'
+    assert reference_roi in [None,'wm','gm','csf'], 'reference_roi must be one of {wm,gm,csf}'
+
+    # declare parameters
+    suffix = '_adc_adjusted' if adc_type == 'adjusted' else ''
+    scanners = [('mr_linac','mrl','adc_adjusted' if adc_type == 'adjusted' else 'adc'),('mr_sim','sim','adc')]
+    if not out_fname:
+        out_fname = join(dirs['proj'],'results','volume_dynamics','dyn_table%s.csv' %(suffix))
+    rows = []
+
+    # loop scanners and subjects
+    for scanner, scanner_short, adc_dirname in scanners:
+        days = read_session_days(dirs,scanner_short)
+        for subject in subjects:
+
+            # get ADC maps of sessions
+            adc_dir = join(dirs[scanner],adc_dirname,'sub-'+subject)
+            sessions = [x for x in get_sessions(adc_dir) if get_keyed_fname(join(adc_dir,'ses-'+x),'adc')]
+            adc_fnames = [get_keyed_fname(join(adc_dir,'ses-'+x),'adc') for x in sessions]
+            ref_fnames = None
+            if reference_roi:
+                ref_fnames = [get_keyed_fname(join(dirs[scanner],'seg','sub-'+subject,'ses-'+x),'_'+reference_roi+'.nii.gz') for x in sessions]
+                missing = [x for x,y in zip(sessions,ref_fnames) if not y]
+                for session in missing:
+                    print('%s %s: contralateral %s ROI not found, session skipped' %(subject,session,reference_roi))
+                adc_fnames = [x for x,y in zip(adc_fnames,ref_fnames) if y]
+                sessions = [x for x,y in zip(sessions,ref_fnames) if y]
+                ref_fnames = [x for x in ref_fnames if x]
+
+            # get GTV contours of MR-sim sessions
+            bound_sessions = get_sessions(join(dirs['mr_sim'],'glio_contours','sub-'+subject))
+            bound_fnames = [get_contour_fnames(dirs,subject,x) for x in bound_sessions]
+            bound_sessions = [x for x,y in zip(bound_sessions,bound_fnames) if y]
+            bound_fnames = [x for x in bound_fnames if x]
+            if not (sessions and bound_sessions):
+                continue
+
+            # compute volumes of all sessions at once
+            print('Computing low-ADC volumes: %s %s (%d sessions x %d contours)' %(subject,scanner_short,len(sessions),len(bound_sessions)))
+            volumes = low_adc_volumes(adc_fnames,bound_fnames,threshold,ref_fnames)
+            tumourcore = [sum([mask_volume(x) for x in fnames]) for fnames in bound_fnames]
+            for ix, session in enumerate(sessions):
+                for k, bound_session in enumerate(bound_sessions):
+                    day = days.get((subject,session),np.nan)
+                    rows.append((subject,session,day,bound_session,'VolumeLowADC',volumes[ix,k]))
+                    rows.append((subject,session,day,bound_session,'VolumeTumourcore',tumourcore[k]))
+
+    # write table
+    df = pd.DataFrame(rows,columns=['Subject','Session','Day','TumourcoreSession','Metric','Value'])
+    df['Day'] = df['Day'].astype('Int64')
+    os.makedirs(os.path.dirname(out_fname),exist_ok=True)
+    df.to_csv(out_fname,index=False)
+    print('Table of volume dynamics written: ' + out_fname)
+    func_msg(func,'end')
+    return df
+
+def sim_dynamics(df_dyn,df_timepoints):
+    '''Returns the MR-sim rows of a table of volume dynamics measured within the contour of the same session, with their
+    timepoint (Fx0, Fx10, ...) and their changes from the baseline (Fx0) session, as in the R scripts
+    Parameters:
+        df_dyn: table of volume dynamics
+        df_timepoints: table of (Subject, Timepoint, Session), e.g. MRL_fraction_session.csv
+    '''
+    df = df_dyn[df_dyn['Session'].astype(str).str.contains('sim',regex=False) & (df_dyn['Session'] == df_dyn['TumourcoreSession'])]
+    df = df.merge(df_timepoints[['Subject','Session','Timepoint']],on=['Subject','Session'],how='left')
+    df_baseline = df.loc[df['Timepoint'] == 'Fx0',['Subject','Metric','Value']]
+    df = df.merge(df_baseline,on=['Subject','Metric'],how='left',suffixes=('','.baseline'))
+    df['Delta'] = df['Value'] - df['Value.baseline']
+    df['DeltaPc'] = 100*df['Delta']/df['Value.baseline']
+    return df, df_baseline
+
+def make_response_table(df_dyn,df_timepoints,df_outcomes,df_clinical=None,exclude=None):
+    '''Returns the baseline table and the response correlation table (% change of each metric at each timepoint, per subject and event)
+    Parameters:
+        df_dyn: table of volume dynamics
+        df_timepoints: table of (Subject, Timepoint, Session)
+        df_outcomes: table of (Subject, Event, TimeToEventMonths, Status)
+        df_clinical: table of clinical variables with a Subject column, joined in front of the response columns
+        exclude: list of subjects, or (subject, session) pairs, to exclude from the response table
+    Returns:
+        df_baseline: table of (Subject, Metric, Value) at baseline
+        df_cor: response correlation table
+    '''
+    df, df_baseline = sim_dynamics(df_dyn,df_timepoints)
+    for item in (exclude if exclude else []):
+        if isinstance(item,str):
+            df = df[df['Subject'] != item]
+        else:
+            df = df[~((df['Subject'] == item[0]) & (df['Session'] == item[1]))]
+
+    # pivot % changes after baseline to one column per metric and timepoint
+    df = df[(df['Timepoint'] != 'Fx0') & df['Metric'].isin(METRIC_NAMES.keys())].copy()
+    df['Column'] = df['Metric'].map(METRIC_NAMES) + '.' + df['Timepoint'].astype(str)
+    df = df.merge(df_outcomes[['Subject','Event','TimeToEventMonths','Status']],on='Subject',how='inner')
+    id_cols = ['Subject','TimeToEventMonths','Event','Status']
+    columns = list(dict.fromkeys(df['Column']))
+    df_cor = df[id_cols].drop_duplicates().reset_index(drop=True)
+    for column in columns:
+        values = df.loc[df['Column'] == column,id_cols + ['DeltaPc']].drop_duplicates(id_cols)
+        df_cor = df_cor.merge(values.rename(columns={'DeltaPc': column}),on=id_cols,how='left')
+
+    # add early/late event columns and clinical variables
+    df_cor['MedianEventTime'] = df_cor['Event'].map(MEDIAN_EVENT_TIMES)
+    df_cor['IsEarly'] = (df_cor['TimeToEventMonths'] < df_cor['MedianEventTime']).astype(float)
+    df_cor.loc[df_cor['TimeToEventMonths'].isna() | df_cor['MedianEventTime'].isna(),'IsEarly'] = np.nan
+    if df_clinical is not None:
+        df_cor = df_clinical.merge(df_cor,on='Subject',how='right')
+
+    return df_baseline, df_cor
+
+def make_low_adc_tables(dirs,subjects,threshold=ADC_THRESHOLD,adc_type='original',reference_roi=None,
+        fn_timepoints='',fn_outcomes='',fn_clinical='',exclude=None):
+    '''Writes the table of volume dynamics and, if timepoints and outcomes are given, the baseline and response correlation tables
+    Parameters:
+        dirs: directories dictionary
+        subjects: names of subjects
+        threshold, adc_type, reference_roi: see make_dyn_table
+        fn_timepoints: filename of table of (Subject, Timepoint, Session) (e.g. MRL_fraction_session.csv)
+        fn_outcomes: filename of table of (Subject, Event, TimeToEventMonths, Status)
+        fn_clinical: filename of table of clinical variables (optional)
+        exclude: see make_response_table
+    '''
+    df_dyn = make_dyn_table(dirs,subjects,threshold,adc_type,reference_roi)
+    if not (fn_timepoints and fn_outcomes):
+        return
+
+    df_timepoints = pd.read_csv(fn_timepoints,dtype=str)
+    df_outcomes = pd.read_csv(fn_outcomes,dtype={'Subject':str})
+    df_clinical = pd.read_csv(fn_clinical,dtype={'Subject':str}) if fn_clinical else None
+    df_baseline, df_cor = make_response_table(df_dyn,df_timepoints,df_outcomes,df_clinical,exclude)
+
+    # write tables where the R scripts read them
+    fn_baseline = join(dirs['proj'],'results','volume_dynamics','dyn_table_baseline.csv')
+    fn_cor = join(dirs['proj'],'results','response_correlation_dataframe.csv')
+    df_baseline.to_csv(fn_baseline,index=False)
+    print('Baseline table written: ' + fn_baseline)
+    df_cor.to_csv(fn_cor,index=False)
+    print('Response correlation table written: ' + fn_cor)
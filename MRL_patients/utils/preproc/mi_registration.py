@@ -0,0 +1,237 @@
+# rigid (6 degrees of freedom) registration by maximization of mutual information
+# in-process alternative to "flirt -cost mutualinfo -dof 6 -nosearch"; matrices follow the FLIRT convention (see fsl_matrix.py)
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage, optimize
+from utils.preproc.fsl_matrix import fsl_vox2mm, world_matrix, write_fsl_matrix
+
+def first_volume(img):
+    '''Returns the data of a 3D image, or of the first volume of a 4D image, as float32
+    Parameters:
+        img: nibabel image
+    '''
+    index = (slice(None),)*3 + (0,)*(len(img.shape)-3)
+    data = np.asarray(img.dataobj[index],dtype=np.float32)
+    return data
+
+def rigid_matrix(params,centre):
+    '''Returns the 4x4 matrix of a rigid transformation
+    Parameters:
+        params: rotations about x, y, z (radians) and translations along x, y, z (mm)
+        centre: centre of rotation (mm)
+    '''
+    rx, ry, rz, tx, ty, tz = params
+    cx, sx = np.cos(rx), np.sin(rx)
+    cy, sy = np.cos(ry), np.sin(ry)
+    cz, sz = np.cos(rz), np.sin(rz)
+    rot_x = np.array([[1,0,0],[0,cx,-sx],[0,sx,cx]])
+    rot_y = np.array([[cy,0,sy],[0,1,0],[-sy,0,cy]])
+    rot_z = np.array([[cz,-sz,0],[sz,cz,0],[0,0,1]])
+    rot = rot_z @ rot_y @ rot_x
+    matrix = np.eye(4)
+    matrix[:3,:3] = rot
+    matrix[:3,3] = np.asarray(centre) + np.array([tx,ty,tz]) - rot @ np.asarray(centre)
+    return matrix
+
+def intensity_range(data):
+    '''Returns the 1st and 99th percentiles of the nonzero voxels of an array (of all voxels if none is nonzero)'''
+    nonzero = data[data != 0]
+    if nonzero.size == 0:
+        nonzero = data.ravel()
+    lo, hi = np.percentile(nonzero,[1,99])
+    if hi <= lo:
+        hi = lo + 1
+    return lo, hi
+
+def intensity_bins(values,lo,hi,bins):
+    '''Returns the histogram bin of each value, for bins spanning an intensity range (see intensity_range)
+    Parameters:
+        values: values to bin
+        lo, hi: intensity range; values outside are put in the first or last bin
+        bins: number of bins
+    '''
+    index = ((values - lo)/(hi - lo)*(bins - 1)).astype(np.int64)
+    return np.clip(index,0,bins-1)
+
+def mutual_information(a,b,bins):
+    '''Returns the mutual information of two arrays of histogram bins
+    Parameters:
+        a, b: integer arrays of bins in [0,bins)
+        bins: number of bins
+    '''
+    joint = np.bincount(a*bins + b,minlength=bins*bins).reshape(bins,bins).astype(float)
+    p = joint/joint.sum()
+    pa = p.sum(axis=1)
+    pb = p.sum(axis=0)
+    nz = p > 0
+    mi = np.sum(p[nz]*np.log(p[nz]/np.outer(pa,pb)[nz]))
+    return mi
+
+def smooth(data,zooms,fwhm):
+    '''Returns data smoothed to a resolution of approximately fwhm mm; data already at that resolution is returned unchanged
+    Parameters:
+        data: 3D array
+        zooms: voxel dimensions in mm
+        fwhm: target resolution in mm
+    '''
+    zooms = np.abs(np.asarray(zooms[:3],dtype=float))
+    sigma = np.sqrt(np.maximum(fwhm**2 - zooms**2,0))/(2*np.sqrt(2*np.log(2)))/zooms
+    if not np.any(sigma > 0):
+        return data
+    return ndimage.gaussian_filter(data,sigma)
+
+def mi_cost(in_data,in_vox2mm,ref_data,ref_vox2mm,init,sampling,bins):
+    '''Returns the cost function of a rigid registration (negative mutual information) and its centre of rotation
+    Parameters:
+        see register_arrays
+    Returns:
+        cost: function of the 6 rigid parameters (rotations in degrees, translations in mm) applied after init
+        centre: centre of rotation (mm), the centre of the reference
+    '''
+
+    # check inputs
+    assert np.ndim(in_data) == 3 and np.ndim(ref_data) == 3, 'in_data and ref_data must be 3D arrays'
+    assert sampling >= 0, 'sampling must be non-negative'
+
+    # sample reference on a grid with the requested spacing
+    zooms = np.abs(np.diag(ref_vox2mm)[:3])
+    steps = [max(1,int(round(sampling/z))) for z in zooms]
+    grid = np.mgrid[0:ref_data.shape[0]:steps[0],0:ref_data.shape[1]:steps[1],0:ref_data.shape[2]:steps[2]]
+    ref_vox = np.vstack([grid.reshape(3,-1),np.ones((1,grid[0].size))])
+    ref_bins = intensity_bins(ref_data[tuple(grid)].ravel(),*intensity_range(ref_data),bins)
+    # the intensity range of the input is fixed, so it is computed once rather than at every evaluation
+    in_lo, in_hi = intensity_range(in_data)
+    ref_mm = ref_vox2mm @ ref_vox
+
+    # rotate about centre of reference
+    centre = (ref_vox2mm @ np.append((np.array(ref_data.shape) - 1)/2.,1))[:3]
+    in_mm2vox = np.linalg.inv(in_vox2mm)
+    upper = np.array(in_data.shape)[:,None] - 1
+
+    # rotations are in degrees so that the optimizer takes steps of similar size in all parameters
+    scales = np.array([np.pi/180.]*3 + [1.]*3)
+
+    def cost(x):
+        matrix = rigid_matrix(x*scales,centre) @ init
+        in_vox = (in_mm2vox @ np.linalg.inv(matrix) @ ref_mm)[:3]
+        inside = np.all((in_vox >= 0) & (in_vox <= upper),axis=0)
+        if np.count_nonzero(inside) < bins:
+            return 0.
+        values = ndimage.map_coordinates(in_data,in_vox[:,inside],order=1)
+        return -mutual_information(ref_bins[inside],intensity_bins(values,in_lo,in_hi,bins),bins)
+
+    return cost, centre
+
+def minimize_cost(cost,centre,init):
+    '''Minimizes a registration cost function (see mi_cost) from the identity
+    Returns:
+        matrix: 4x4 FLIRT matrix at the solution
+        mi: mutual information at the solution
+    '''
+    res = optimize.minimize(cost,np.zeros(6),method='Powell',options={'xtol':1e-2,'ftol':1e-5})
+    params = np.concatenate([np.radians(res.x[:3]),res.x[3:]])
+    matrix = rigid_matrix(params,centre) @ init
+    return matrix, -res.fun
+
+def register_arrays(in_data,in_vox2mm,ref_data,ref_vox2mm,init=None,sampling=2.,bins=64):
+    '''Estimates the rigid transformation from input to reference that maximizes mutual information
+    Parameters:
+        in_data: 3D input array
+        in_vox2mm: voxel-to-scaled-voxel matrix of input (fsl_matrix.fsl_vox2mm)
+        ref_data: 3D reference array
+        ref_vox2mm: voxel-to-scaled-voxel matrix of reference
+        init: initial 4x4 FLIRT matrix (default = identity)
+        sampling: spacing (mm) of the reference voxels at which mutual information is evaluated (0 = every voxel)
+        bins: number of histogram bins
+    Returns:
+        matrix: 4x4 FLIRT matrix from input to reference
+        mi: mutual information at the solution
+    '''
+    if init is None:
+        init = np.eye(4)
+    cost, centre = mi_cost(in_data,in_vox2mm,ref_data,ref_vox2mm,init,sampling,bins)
+    matrix, mi = minimize_cost(cost,centre,init)
+    return matrix, mi
+
+def register_pyramid(in_data,in_vox2mm,ref_data,ref_vox2mm,init=None,levels=(8.,4.,2.),tol=1e-2,bins=64,verbose=False):
+    '''Estimates the rigid transformation from input to reference coarse-to-fine, in memory
+    Parameters:
+        in_data, in_vox2mm, ref_data, ref_vox2mm, init, bins: see register_arrays
+        levels: resolutions (mm), coarse to fine; at each level both volumes are smoothed to the resolution and sampled at that spacing
+        tol: if a level improves mutual information by less than tol (relative), the transformation is taken as converged and finer levels are skipped
+        bins: maximum number of histogram bins; fewer bins are used at coarse levels, where there are fewer samples
+        verbose: if True, prints the mutual information before and after each level
+    Returns:
+        matrix: 4x4 FLIRT matrix from input to reference
+        mi: mutual information at the solution (at the last level that was run)
+    '''
+    assert len(levels) > 0, 'levels must not be empty'
+    matrix = np.eye(4) if init is None else init
+    in_zooms = np.abs(np.diag(in_vox2mm)[:3])
+    ref_zooms = np.abs(np.diag(ref_vox2mm)[:3])
+    for ii, level in enumerate(levels):
+        in_level = smooth(in_data,in_zooms,level)
+        ref_level = smooth(ref_data,ref_zooms,level)
+        n_samples = np.prod([np.ceil(n/max(1,round(level/z))) for n,z in zip(ref_data.shape,ref_zooms)])
+        level_bins = int(np.clip(np.sqrt(n_samples/10.),16,bins))
+        cost, centre = mi_cost(in_level,in_vox2mm,ref_level,ref_vox2mm,matrix,level,level_bins)
+        mi_start = -cost(np.zeros(6))
+        matrix, mi = minimize_cost(cost,centre,matrix)
+        if verbose:
+            print('pyramid level %g mm: MI %.4f -> %.4f' %(level,mi_start,mi))
+        if (ii > 0) and (mi - mi_start < tol*mi_start):
+            if verbose and (ii < len(levels) - 1):
+                print('converged, skipping levels: ' + ', '.join(['%g mm' %x for x in levels[ii+1:]]))
+            break
+    return matrix, mi
+
+def register_images(in_img,ref_img,init='header',sampling=2.,bins=64,levels=None,verbose=False):
+    '''Estimates the rigid transformation from input to reference image that maximizes mutual information
+    Parameters:
+        in_img: input nibabel image; first volume is used if 4D
+        ref_img: reference nibabel image; first volume is used if 4D
+        init: initial alignment, 'header' (sform/qform, as flirt -usesqform), 'identity' (as flirt without -usesqform) or a 4x4 FLIRT matrix
+        sampling: spacing (mm) of the reference voxels at which mutual information is evaluated
+        bins: number of histogram bins
+        levels: if given, resolutions (mm) of coarse-to-fine registration (see register_pyramid); sampling is then ignored
+        verbose: if True, prints the progress of coarse-to-fine registration
+    Returns:
+        matrix: 4x4 FLIRT matrix from input to reference
+        mi: mutual information at the solution
+    '''
+    if isinstance(init,str):
+        assert init in ['header','identity'], 'init must be one of {header,identity} or a 4x4 matrix'
+        init = world_matrix(in_img,ref_img) if init == 'header' else np.eye(4)
+    args = (first_volume(in_img),fsl_vox2mm(in_img),first_volume(ref_img),fsl_vox2mm(ref_img))
+    if levels:
+        matrix, mi = register_pyramid(*args,init=init,levels=levels,bins=bins,verbose=verbose)
+    else:
+        matrix, mi = register_arrays(*args,init=init,sampling=sampling,bins=bins)
+    return matrix, mi
+
+def mi_register(in_fname,ref_fname,out_matrix_fname,sampling=2.,inverse=False,levels=None,init='identity',verbose=False):
+    '''Registers input to reference in-process and writes the FLIRT matrix from input to reference
+    Parameters:
+        in_fname: input filename
+        ref_fname: reference filename
+        out_matrix_fname: filename of output .mat file
+        sampling: spacing (mm) at which mutual information is evaluated (0 = every reference voxel)
+        inverse: if True, registers reference to input and inverts the transformation
+        levels: if given, resolutions (mm) of coarse-to-fine registration, e.g. [8,4,2]; sampling is then ignored
+        init: initial alignment (see register_images); the default, 'identity', starts where the FLIRT calls of
+            flirt_utils (which do not pass -usesqform) start, so both backends solve the same problem
+        verbose: if True, prints the progress of coarse-to-fine registration
+    Returns:
+        matrix: 4x4 FLIRT matrix from input to reference
+    '''
+    in_img = nib.load(in_fname)
+    ref_img = nib.load(ref_fname)
+    if inverse:
+        matrix, mi = register_images(ref_img,in_img,init=init,sampling=sampling,levels=levels,verbose=verbose)
+        matrix = np.linalg.inv(matrix)
+    else:
+        matrix, mi = register_images(in_img,ref_img,init=init,sampling=sampling,levels=levels,verbose=verbose)
+    print('mutual information registration (MI = %.4f): %s -> %s' %(mi,in_fname,ref_fname))
+    write_fsl_matrix(out_matrix_fname,matrix)
+    return matrix
@@ -0,0 +1,89 @@
+# persistent cache of decompressed copies of .nii.gz volumes, so that volumes read by many stages are decompressed once
+
+import os
+import gzip
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+from os.path import join, isfile, getsize, getmtime, dirname, abspath
+from utils.preproc.build_manifest import BuildManifest
+
+class NiftiCache(object):
+    """
+    Cache of uncompressed .nii copies of volumes, kept in one directory.
+    Entries are keyed by the SHA-256 of the source file, so a source that changes is decompressed again.
+    External tools (FSL, HD-BET) are given the path of the .nii copy, and python code is given arrays memory-mapped from it.
+    Least recently used entries are removed once the cache exceeds its disk budget.
+
+    Args:
+        cache_dir (str): directory of cache (e.g. <derivatives root>/nifti_cache)
+        budget (float): disk budget in GB
+    """
+
+    def __init__(self, cache_dir, budget=20.):
+        self.cache_dir = abspath(cache_dir)
+        self.budget = budget
+        # hashes of source files are kept with their size and modification time, so unchanged sources are not re-read
+        self.hashes = BuildManifest(join(self.cache_dir,'hashes.sqlite'))
+
+    def entry(self, fname):
+        '''returns the filename of the cached copy of a source file'''
+        return join(self.cache_dir,self.hashes.hash(fname) + '.nii')
+
+    def contains(self, fname):
+        '''returns True if a filename is an entry of the cache'''
+        return dirname(abspath(fname)) == self.cache_dir
+
+    def path(self, fname):
+        '''returns the filename of an uncompressed copy of a volume, decompressing it if it is not cached;
+        volumes that are not compressed are returned as they are'''
+        if not fname.endswith('.gz'):
+            return fname
+        nii_fname = self.entry(fname)
+        if isfile(nii_fname):
+            # mark as recently used
+            os.utime(nii_fname)
+        else:
+            # decompress to a private file, then move into place so that concurrent workers never read a partial file
+            fd, work_fname = tempfile.mkstemp(dir=self.cache_dir,suffix='.part')
+            try:
+                with gzip.open(fname,'rb') as f_in, os.fdopen(fd,'wb') as f_out:
+                    shutil.copyfileobj(f_in,f_out,2**22)
+                os.replace(work_fname,nii_fname)
+            finally:
+                if isfile(work_fname):
+                    os.remove(work_fname)
+            print('cached uncompressed volume: %s (%s)' %(nii_fname,fname))
+            self.evict(keep=nii_fname)
+        return nii_fname
+
+    def load(self, fname):
+        '''returns a nibabel image of a volume whose data are memory-mapped from the cached copy'''
+        return nib.load(self.path(fname),mmap='r')
+
+    def array(self, fname):
+        '''returns the voxels of a volume as a read-only np.memmap (an in-memory array if the volume has scaling factors)'''
+        return np.asanyarray(self.load(fname).dataobj)
+
+    def evict(self, keep=None):
+        '''removes least recently used entries until the cache is within its disk budget
+        args:
+            keep (str): entry that is never removed (e.g. the entry just added)
+        '''
+        entries = [join(self.cache_dir,x) for x in os.listdir(self.cache_dir) if x.endswith('.nii')]
+        entries.sort(key=getmtime,reverse=True)
+        total = 0
+        for nii_fname in entries:
+            total += getsize(nii_fname)
+            if (total > self.budget*1e9) and (nii_fname != keep):
+                print('removing least recently used uncompressed volume: ' + nii_fname)
+                os.remove(nii_fname)
+
+def get_nifti_cache(root, budget=20.):
+    '''Returns the cache of uncompressed volumes of a derivatives folder
+    Parameters:
+        root: root of derivatives folder (e.g. dirs['mr_linac'])
+        budget: disk budget in GB
+    '''
+    return NiftiCache(join(root,'nifti_cache'),budget)
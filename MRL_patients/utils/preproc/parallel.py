@@ -0,0 +1,106 @@
+# functions to run independent units of work (e.g. one subject/session) in parallel
+
+import os
+import time
+import fcntl
+import tempfile
+import subprocess
+from os.path import join
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+def unit(func,*args,**kwargs):
+    '''Returns a unit of work to pass to run_units
+    Parameters:
+        func: function to call; must be defined at module level so that it can be sent to a worker process
+        args: positional arguments of func
+        kwargs: keyword arguments of func
+    Returns:
+        (func,args,kwargs) tuple
+    '''
+    return (func,args,kwargs)
+
+def run_units(units,jobs=1):
+    '''Runs independent units of work, in a pool of worker processes if jobs > 1
+    Parameters:
+        units: list of units created with unit()
+        jobs: number of worker processes (1 = run serially in the current process)
+    Returns:
+        results: list of return values, in the same order as units
+    Notes:
+        - units passed in one call must not depend on each other; call run_units once per stage to impose an order
+    '''
+
+    # check inputs
+    assert isinstance(jobs,int) and jobs>0, 'jobs must be a positive integer'
+
+    if jobs == 1 or len(units) <= 1:
+        # run serially, as before parallel mode existed
+        results = [func(*args,**kwargs) for func,args,kwargs in units]
+    else:
+        # run in pool of processes; errors in a unit are raised here
+        print('Running %d units in %d processes' %(len(units),min(jobs,len(units))))
+        with ProcessPoolExecutor(max_workers=min(jobs,len(units))) as pool:
+            futures = [pool.submit(func,*args,**kwargs) for func,args,kwargs in units]
+            results = [future.result() for future in futures]
+
+    return results
+
+def fsl_max_jobs():
+    '''Returns the maximum number of FSL commands that may run at once on this machine, from $FSL_MAX_JOBS (default = number of cores)'''
+    return int(os.environ.get('FSL_MAX_JOBS',len(os.sched_getaffinity(0))))
+
+@contextmanager
+def fsl_slot(poll=0.5):
+    '''Context manager that waits for one of fsl_max_jobs() slots and holds it until the block exits
+    Parameters:
+        poll: seconds between attempts while all slots are taken
+    Returns:
+        slot: index of slot held (0 to fsl_max_jobs()-1)
+    Notes:
+        - slots are lock files in $FSL_SLOT_DIR (default = <tmp>/fsl_slots), so the cap is shared by every process
+          and stage on the machine (e.g. FLIRT in --jobs workers and FAST pools)
+        - a slot held by a process that dies is released by the operating system
+    '''
+    slot_dir = os.environ.get('FSL_SLOT_DIR',join(tempfile.gettempdir(),'fsl_slots'))
+    os.makedirs(slot_dir,exist_ok=True)
+    n_slots = fsl_max_jobs()
+    while True:
+        for slot in range(n_slots):
+            f = open(join(slot_dir,'slot%d.lock' %(slot)),'w')
+            try:
+                fcntl.flock(f,fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            try:
+                yield slot
+            finally:
+                fcntl.flock(f,fcntl.LOCK_UN)
+                f.close()
+            return
+        time.sleep(poll)
+
+def slot_cores(slot,cores_per_job=1):
+    '''Returns the set of cores that a slot is pinned to; slots take consecutive blocks of the cores available to this process
+    Parameters:
+        slot: index of slot (see fsl_slot)
+        cores_per_job: number of cores per slot
+    '''
+    cores = sorted(os.sched_getaffinity(0))
+    start = (slot*cores_per_job) % len(cores)
+    return set([cores[(start + ii) % len(cores)] for ii in range(min(cores_per_job,len(cores)))])
+
+def run_command(cmd,cores=None):
+    '''Runs a shell command, optionally pinned to a set of cores, and returns its return code and wall time
+    Parameters:
+        cmd: command line
+        cores: set of cores to run on (default = all cores)
+    Returns:
+        returncode: return code of command
+        seconds: wall time (s)
+    '''
+    pin = (lambda: os.sched_setaffinity(0,cores)) if cores else None
+    start = time.time()
+    returncode = subprocess.call(cmd,shell=True,preexec_fn=pin)
+    return returncode, time.time() - start
@@ -4,8 +4,10 @@
 from bids import BIDSLayout
 import pandas as pd
 import os
-from os.path import join, basename, dirname, isfile
+from os.path import join, basename, dirname, isfile, isdir
 import json
+import threading
+from utils.preproc.sidecar_cache import SidecarCache
 
 # functions
 def declare_directories():
@@ -37,7 +39,82 @@ def get_bids_layout(scanner):
 
     # get BIDS layout
     dirs = declare_directories()
-    layout = BIDSLayout(os.path.join(dirs['proj'],'data','bids-cns-mrl','dataset-'+scanner),database_path=os.path.join(dirs['proj'],'data','bids_layout',scanner))
+    layout = load_bids_layout(os.path.join(dirs['proj'],'data','bids-cns-mrl','dataset-'+scanner),os.path.join(dirs['proj'],'data','bids_layout',scanner))
+    return layout
+
+# process-wide cache of BIDS layouts: {(root, database_path): (layout, stamp)}
+_layout_cache = {}
+_layout_lock = threading.Lock()
+
+# process-wide cache of sidecar metadata: {root: SidecarCache}
+_sidecar_caches = {}
+
+def bids_tree_stamp(roots):
+    '''Returns the modification times of the session and datatype directories of BIDS datasets, by session;
+    these change whenever files are added, removed or renamed, so the tree does not need to be walked file by file
+    Parameters:
+        roots: list of dataset roots
+    Returns:
+        stamp: dictionary of {session directory: {'.': mtime of session directory, datatype: mtime of datatype directory}}
+    '''
+    stamp = {}
+    for root in roots:
+        if not isdir(root):
+            continue
+        for subject in os.scandir(root):
+            if not (subject.is_dir() and subject.name.startswith('sub-')):
+                continue
+            for session in os.scandir(subject.path):
+                if not session.is_dir():
+                    continue
+                stamp[session.path] = {'.': session.stat().st_mtime_ns}
+                for datatype in os.scandir(session.path):
+                    if datatype.is_dir():
+                        stamp[session.path][datatype.name] = datatype.stat().st_mtime_ns
+    return stamp
+
+def stale_sessions(saved,stamp):
+    '''Returns the sorted session directories that were added, removed or changed between two stamps (see bids_tree_stamp)'''
+    return sorted([x for x in set(saved) | set(stamp) if saved.get(x) != stamp.get(x)])
+
+def load_bids_layout(root,database_path,derivatives=False):
+    '''Returns a BIDS layout, re-using the layout already loaded by this process or the saved database if the dataset has not changed
+    Parameters:
+        root: root of BIDS dataset
+        database_path: folder of saved layout database
+        derivatives: if True, derivatives are indexed as well
+    Notes:
+        - the stamp is kept per session (see bids_tree_stamp) and saved with the database, so the sessions that changed
+          are known; pybids can only rebuild its database as a whole, however, so any stale session re-indexes the
+          whole dataset (this is not an incremental index)
+        - the per-session lookups of this project go through bids_index.BidsIndex, which does re-index only the
+          stale sessions; the layout is needed for the queries that it does not cover
+    '''
+    roots = [root]
+    if derivatives:
+        roots += [x.path for x in os.scandir(join(root,'derivatives')) if x.is_dir()] if isdir(join(root,'derivatives')) else []
+    stamp = bids_tree_stamp(roots)
+    key = (root,database_path)
+    with _layout_lock:
+        if (key in _layout_cache) and (_layout_cache[key][1] == stamp):
+            return _layout_cache[key][0]
+
+        # compare with stamp saved with database
+        fn_stamp = join(database_path,'tree_stamp.json')
+        saved = {}
+        if isfile(fn_stamp):
+            with open(fn_stamp) as f:
+                saved = json.load(f)
+        stale = stale_sessions(saved,stamp)
+        if stale:
+            print('BIDS dataset changed since layout was saved (%d sessions, e.g. %s), re-indexing: %s' %(len(stale),stale[0],root))
+            kwargs = {'derivatives': True} if derivatives else {}
+            layout = BIDSLayout(root,database_path=database_path,reset_database=True,**kwargs)
+            with open(fn_stamp,'w') as f:
+                json.dump(stamp,f)
+        else:
+            layout = BIDSLayout(root,database_path=database_path)
+        _layout_cache[key] = (layout,stamp)
     return layout
 
 def declare_subject_reference_dict():
@@ -181,6 +258,19 @@ def get_gbm_list():
     gbm_list = [x for x in flist if 'M' in x]
     return gbm_list
 
+def get_sidecar_cache(layout):
+    '''Returns the cache of sidecar metadata of a BIDS layout (one per dataset and process)
+    Parameters:
+        layout: BIDS layout object
+    '''
+    root = layout.root
+    with _layout_lock:
+        if root not in _sidecar_caches:
+            dirs = declare_directories()
+            db_fname = join(dirs['proj'],'data','bids_layout','sidecars_' + basename(root) + '.sqlite')
+            _sidecar_caches[root] = SidecarCache(root,db_fname)
+    return _sidecar_caches[root]
+
 def date_to_session(layout,subject,date):
     '''Returns the BIDS session associated with a given date
     Parameters:
@@ -188,16 +278,7 @@ def date_to_session(layout,subject,date):
         subject: subject name
         date: date
     '''
-    fnames = layout.get(subject=subject,suffix='T1w',extension='json',return_type='filename')
-    session = ''
-    for fname in fnames:
-        with open(fname) as f:
-            data = json.load(f)
-        bits = data['AcquisitionDateTime'].split('T')
-        json_date = bits[0].replace('-','')
-        if date == json_date:
-            session = basename(dirname(dirname(fname))).replace('ses-','')
-            break
+    session = get_sidecar_cache(layout).date_to_session(subject,date)
     return session
 
 def session_to_date(layout,subject,session):
@@ -207,12 +288,7 @@ def session_to_date(layout,subject,session):
         subject: subject name
         session: session name
     '''
-    fnames = layout.get(subject=subject,session=session,suffix='T1w',extension='json',return_type='filename')
-    assert len(fnames)>0, 'no T1w .json file found: %s %s'%(subject,session)
-    with open(fnames[0]) as f:
-        data = json.load(f)
-    bits = data['AcquisitionDateTime'].split('T')
-    json_date = bits[0].replace('-','')
+    json_date = get_sidecar_cache(layout).session_to_date(subject,session)
     return json_date
 
 def get_reference_list():
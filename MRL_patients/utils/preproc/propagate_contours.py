@@ -1,19 +1,24 @@
 # imports
 from utils.preproc.project_parameters import get_bids_layout, declare_subject_reference_dict, date_to_session, declare_protocol_names, get_t1w_reference
-from utils.preproc.flirt_utils import flirt_volumes, flirt_propagate
+from utils.preproc.flirt_utils import flirt_volumes, flirt_propagate, propagate_chain
 from utils.preproc.io import func_msg, select_filenames
-from utils.preproc.align_volumes import get_reference_fname
+from utils.preproc.parallel import unit, run_units
+from utils.preproc.build_manifest import get_manifest
+from utils.preproc.transform_store import get_transform_store
+from utils.preproc.align_volumes import get_reference_fname, select_mrl_t1w
+from utils.preproc.bids_index import get_bids_index
 from os.path import join, isdir, basename, isfile
 from glob import glob
 import os
 import pandas as pd
 import re
 
-def propagate_contours_glio(dirs,subjects):
+def propagate_contours_glio(dirs,subjects,jobs=1):
     '''Registers the MR-sim T1w to the reference MRL T1w and propagates contours (GTV, CTV)
     params:
         dirs: dictionary of directories
         subjects: list of subjects
+        jobs: number of (subject, session) units to run in parallel
     '''
 
     # communicate with user
@@ -23,6 +28,9 @@ def propagate_contours_glio(dirs,subjects):
     # declare parameters
     suffix = 'coreg'
     debug = False
+    manifest = get_manifest(dirs['mr_sim'])
+    transforms = get_transform_store(dirs['mr_linac'])
+    units = []
 
     # loop list of subjects
     for subject in subjects:
@@ -57,7 +65,10 @@ def propagate_contours_glio(dirs,subjects):
 
                 # propagate contours
                 remove_interim = not debug
-                flirt_propagate(fname_t1,fname_ref,fnames_contours,suffix,out_dir,overwrite=False,resample=2,inverse=False,remove_interim=remove_interim)
+                units.append(unit(flirt_propagate,fname_t1,fname_ref,fnames_contours,suffix,out_dir,overwrite=False,resample=2,inverse=False,remove_interim=remove_interim,manifest=manifest,transforms=transforms))
+
+    # run sessions
+    run_units(units,jobs=jobs)
 
     # communicate with user
     func = 'propagate_contours_glio'
@@ -84,11 +95,16 @@ def get_glio_contour_filenames(folder):
 
     return fname_t1, fnames_contours
 
-def propagate_contours(dirs,subjects):
+def propagate_contours(dirs,subjects,jobs=1,to_sessions=False):
     '''Registers CT and T1w of reference space and propagate contours (GTV, CTV)
     Parameters:
         dirs: dictionary of directories
         subjects: list of subjects
+        jobs: number of subjects to run in parallel
+        to_sessions: if True, also propagates contours into the native T1w space of every other MR-Linac session
+            (<mr_linac>/contours_sessions), composing CT->reference->session so that each contour is resampled once
+    Notes:
+        - sessions must have been aligned (align_volumes) for their T1w to be connected to the reference in the transform store
     '''
 
     # communicate with user
@@ -98,9 +114,12 @@ def propagate_contours(dirs,subjects):
     # declare parameters
     suffix = 'coreg'
     layout_mrl = get_bids_layout('mrl')
+    manifest = get_manifest(dirs['mr_linac'])
+    transforms = get_transform_store(dirs['mr_linac'])
 
     # declare list to hold reference name
     rows = []
+    units = []
 
     # loop subjects
     for subject in subjects:
@@ -123,7 +142,35 @@ def propagate_contours(dirs,subjects):
         [ct_fname,contour_fnames] = get_ct_fnames(dirs,subject)
 
         # co-register CT and T1w and propagate contours
-        flirt_propagate(ct_fname,ref_fname,contour_fnames,suffix,out_dir,overwrite=False,resample=2,inverse=True)
+        units.append(unit(flirt_propagate,ct_fname,ref_fname,contour_fnames,suffix,out_dir,overwrite=False,resample=2,inverse=True,manifest=manifest,transforms=transforms))
+
+    # run subjects
+    run_units(units,jobs=jobs)
+
+    if to_sessions:
+        # propagate contours from CT to each session in one resample, once CT->reference matrices exist
+        units = []
+        index = get_bids_index(layout_mrl.root)
+        for subject in subjects:
+            ref_fname = get_reference_fname(dirs,layout_mrl,subject)
+            [ct_fname,contour_fnames] = get_ct_fnames(dirs,subject)
+            for session in index.get_sessions(subject):
+                t1_fnames = index.get(subject,session,suffix='T1w',extension='nii.gz')
+                if not t1_fnames:
+                    continue
+                t1_fname = select_mrl_t1w(t1_fnames,subject,session)
+                if t1_fname == ref_fname:
+                    continue
+                if transforms.path(ct_fname,t1_fname) is None:
+                    print('no transformation from CT to session T1w, skipping: ' + t1_fname)
+                    continue
+                out_dir = join(dirs['mr_linac'],'contours_sessions','sub-'+subject,'ses-'+session)
+                os.makedirs(out_dir,exist_ok=True)
+                units.append(unit(propagate_chain,contour_fnames,ct_fname,t1_fname,transforms,suffix,out_dir,overwrite=False,manifest=manifest))
+        run_units(units,jobs=jobs)
+
+    # communicate with user
+    func_msg(func,'end')
 
 def get_ct_fnames(dirs,subject):
     '''Returns the filename of the CT scan and contours
@@ -0,0 +1,222 @@
+# ADC statistics (volume, mean, SD, median, percentiles and fixed-bin histograms) in every ROI of every MR-Linac session:
+# GTV, CTV, contralateral CSF/GM/WM and the low-ADC subregions of the GTV and CTV
+#
+# The ROIs of a session overlap (e.g. GTV within CTV), so they are encoded in one integer label image whose labels are the
+# distinct combinations of ROIs found in the session. Sums and histograms are computed for all labels in one pass with
+# np.bincount and added up per ROI; percentiles are taken from one sort of the labelled voxels.
+
+import os
+import re
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from os.path import join
+from utils.preproc.low_adc import ADC_THRESHOLD, get_sessions, get_keyed_fname, resample_mask, read_session_days
+from utils.preproc.parallel import unit, run_units
+from utils.preproc.io import func_msg
+
+# declare parameters
+ADC_BINS = np.linspace(0,4,81) # histogram bin edges (10^-3 mm^2/s); values outside are counted in the first/last bin
+PERCENTILES = [10,25,50,75,90]
+CONTOUR_PATTERNS = {'GTV': re.compile('gtv',re.IGNORECASE), 'CTV': re.compile('ctv',re.IGNORECASE)}
+TISSUE_ROIS = ['csf','gm','wm'] # contralateral ROIs (see seg_utils.contralateral_rois)
+LOW_ADC_ROIS = ['GTV','CTV'] # ROIs whose low-ADC subregion is added
+
+def label_image(masks):
+    '''Encodes overlapping masks as one label image
+    Parameters:
+        masks: list of boolean arrays of the same shape
+    Returns:
+        labels: int32 array, 0 outside all masks and 1..L for the L distinct combinations of masks found
+        membership: (L+1) x len(masks) boolean array, True where a label lies within a mask (row 0 = background)
+    '''
+    code = np.zeros(masks[0].shape,dtype=np.int64)
+    for ix, mask in enumerate(masks):
+        code[mask] |= 1 << ix
+    labels = np.zeros(code.shape,dtype=np.int32)
+    inside = code > 0
+    codes, inverse = np.unique(code[inside],return_inverse=True)
+    labels[inside] = inverse.ravel() + 1
+    codes = np.concatenate([[0],codes])
+    membership = ((codes[:,None] >> np.arange(len(masks))[None,:]) & 1).astype(bool)
+    return labels, membership
+
+def sorted_percentiles(x,q):
+    '''Returns the percentiles of a sorted array with linear interpolation (as np.percentile), or NaN if it is empty'''
+    if x.size == 0:
+        return np.full(len(q),np.nan)
+    pos = np.asarray(q,dtype=float)/100*(x.size-1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo+1,x.size-1)
+    return x[lo] + (pos-lo)*(x[hi]-x[lo])
+
+def label_stats(values,labels,membership,bins=ADC_BINS,percentiles=PERCENTILES):
+    '''Computes statistics of values in the ROIs of a label image (see label_image)
+    Parameters:
+        values: array of values (e.g. ADC map)
+        labels: label image of the same shape
+        membership: (L+1) x R boolean array of the labels within each ROI
+        bins: histogram bin edges
+        percentiles: percentiles to compute
+    Returns:
+        stats: R x S array of voxels, mean, SD and percentiles per ROI (columns as stat_names)
+        hist: R x (len(bins)-1) array of histogram counts per ROI
+    Notes:
+        - voxels with non-finite values are ignored
+    '''
+
+    # get labelled voxels
+    valid = (labels > 0) & np.isfinite(values)
+    v = values[valid].astype(np.float64)
+    a = labels[valid]
+    n_labels, n_rois = membership.shape
+    n_bins = len(bins)-1
+    weights = membership.T.astype(np.float64) # ROI x label
+
+    # sums and histograms of all labels in one pass, added up per ROI
+    count = weights @ np.bincount(a,minlength=n_labels)
+    total = weights @ np.bincount(a,weights=v,minlength=n_labels)
+    total_sq = weights @ np.bincount(a,weights=v*v,minlength=n_labels)
+    b = np.clip(np.searchsorted(bins,v,side='right')-1,0,n_bins-1)
+    hist = weights @ np.bincount(a*n_bins + b,minlength=n_labels*n_bins).reshape(n_labels,n_bins)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mean = total/count
+        sd = np.sqrt(np.maximum(total_sq/count - mean*mean,0)*count/(count-1))
+
+    # percentiles from one sort of all labelled voxels
+    order = np.argsort(v,kind='stable')
+    v, a = v[order], a[order]
+    pct = np.stack([sorted_percentiles(v[membership[a,ix]],percentiles) for ix in range(n_rois)]) if n_rois else np.zeros((0,len(percentiles)))
+
+    stats = np.column_stack([count,mean,sd,pct])
+    return stats, np.round(hist).astype(np.int64)
+
+def stat_names(percentiles=PERCENTILES):
+    '''Returns the names of the columns of label_stats'''
+    return ['Voxels','Mean','SD'] + ['Median' if x == 50 else 'P%g' %(x) for x in percentiles]
+
+def get_session_rois(dirs,subject,session):
+    '''Returns a dictionary {ROI name: list of filenames} of the ROIs of an MR-Linac session; a ROI with several files is
+    their union (e.g. multifocal GTV)
+    Notes:
+        - GTV and CTV are the contours propagated to the reference session (<mr_linac>/contours), which all co-registered
+          sessions share; contralateral ROIs are those of the session if it has them, else those of the reference session
+    '''
+    rois = {}
+    contour_dir = join(dirs['mr_linac'],'contours','sub-'+subject)
+    for ref_session in get_sessions(contour_dir):
+        folder = join(contour_dir,'ses-'+ref_session)
+        for name, pattern in CONTOUR_PATTERNS.items():
+            fnames = sorted([join(folder,x) for x in os.listdir(folder) if x.endswith('.nii.gz') and pattern.search(x)])
+            if fnames and name not in rois:
+                rois[name] = fnames
+    seg_dir = join(dirs['mr_linac'],'seg','sub-'+subject)
+    seg_sessions = [session] + [x for x in get_sessions(seg_dir) if x != session]
+    for tissue in TISSUE_ROIS:
+        for seg_session in seg_sessions:
+            fname = get_keyed_fname(join(seg_dir,'ses-'+seg_session),'_'+tissue+'.nii.gz')
+            if fname:
+                rois[tissue.upper()] = [fname]
+                break
+    return rois
+
+def session_roi_stats(adc_fname,rois,threshold=ADC_THRESHOLD,bins=ADC_BINS,percentiles=PERCENTILES):
+    '''Computes the ADC statistics of the ROIs of one session
+    Parameters:
+        adc_fname: filename of ADC map
+        rois: dictionary {ROI name: list of filenames} (see get_session_rois)
+        threshold: ADC threshold of low-ADC subregions
+        bins: histogram bin edges
+        percentiles: percentiles to compute
+    Returns:
+        names: ROI names, including the low-ADC subregions (<ROI>_LowADC)
+        stats: ROI x statistic array (see label_stats), with the volume (cc) appended as the last column
+        hist: ROI x bin array of histogram counts
+    '''
+
+    # load ADC map and ROIs on its grid
+    img = nib.load(adc_fname)
+    adc = img.get_fdata(dtype=np.float32)
+    names, masks = [], []
+    for name, fnames in rois.items():
+        mask = np.zeros(adc.shape[:3],dtype=bool)
+        for fname in fnames:
+            mask |= resample_mask(fname,img)
+        names.append(name)
+        masks.append(mask)
+    for name in [x for x in LOW_ADC_ROIS if x in rois]:
+        names.append(name+'_LowADC')
+        masks.append(masks[names.index(name)] & (adc > 0) & (adc < threshold)) # unfit voxels (ADC of 0) are not low ADC
+
+    # compute statistics of all ROIs at once
+    labels, membership = label_image(masks)
+    stats, hist = label_stats(adc,labels,membership,bins,percentiles)
+    voxel_volume = np.prod(np.array(img.header.get_zooms()[:3],dtype=float))*1e-3
+    stats = np.column_stack([stats,stats[:,0]*voxel_volume])
+    return names, stats, hist
+
+def make_roi_stats_table(dirs,subjects,threshold=ADC_THRESHOLD,adc_type='original',jobs=1,out_dir=None):
+    '''Computes the ADC statistics of the ROIs of all MR-Linac sessions and writes them as tidy tables
+    Parameters:
+        dirs: directories dictionary
+        subjects: names of subjects
+        threshold: ADC threshold of low-ADC subregions
+        adc_type: ADC maps to use {original, adjusted}
+        jobs: number of sessions to run in parallel
+        out_dir: output folder (default = <proj>/results/roi_stats)
+    Returns:
+        df_stats: table with columns Subject, Session, Day, ROI, Statistic, Value (statistics: Voxels, Mean, SD, Median,
+            P<percentile>, Volume (cc))
+        df_hist: table with columns Subject, Session, ROI, BinLow, BinHigh, Count
+    '''
+
+    # communicate with user
+    func = 'make_roi_stats_table'
+    func_msg(func,'start')
+
+    # check inputs
+    assert adc_type in ['original','adjusted'], 'adc_type must be one of {original,adjusted}'
+
+    # declare parameters
+    adc_dirname = 'adc_adjusted' if adc_type == 'adjusted' else 'adc'
+    suffix = '_adc_adjusted' if adc_type == 'adjusted' else ''
+    if not out_dir:
+        out_dir = join(dirs['proj'],'results','roi_stats')
+    days = read_session_days(dirs,'mrl')
+    keys, units = [], []
+
+    # declare sessions with an ADC map and at least one ROI
+    for subject in subjects:
+        adc_dir = join(dirs['mr_linac'],adc_dirname,'sub-'+subject)
+        for session in get_sessions(adc_dir):
+            adc_fname = get_keyed_fname(join(adc_dir,'ses-'+session),'adc')
+            rois = get_session_rois(dirs,subject,session)
+            if not (adc_fname and rois):
+                print('%s %s: no ADC map or ROIs, session skipped' %(subject,session))
+                continue
+            keys.append((subject,session))
+            units.append(unit(session_roi_stats,adc_fname,rois,threshold))
+
+    # compute statistics of sessions in parallel
+    results = run_units(units,jobs=jobs)
+
+    # collect tidy tables
+    columns = stat_names() + ['Volume']
+    rows_stats, rows_hist = [], []
+    for (subject, session), (names, stats, hist) in zip(keys,results):
+        day = days.get((subject,session),np.nan)
+        for ix, name in enumerate(names):
+            rows_stats += [(subject,session,day,name,x,y) for x,y in zip(columns,stats[ix])]
+            rows_hist += [(subject,session,name,x,y,z) for x,y,z in zip(ADC_BINS[:-1],ADC_BINS[1:],hist[ix])]
+    df_stats = pd.DataFrame(rows_stats,columns=['Subject','Session','Day','ROI','Statistic','Value'])
+    df_stats['Day'] = df_stats['Day'].astype('Int64')
+    df_hist = pd.DataFrame(rows_hist,columns=['Subject','Session','ROI','BinLow','BinHigh','Count'])
+
+    # write tables
+    os.makedirs(out_dir,exist_ok=True)
+    for df, name in [(df_stats,'roi_stats'),(df_hist,'roi_histograms')]:
+        fname = join(out_dir,name+suffix+'.csv')
+        df.to_csv(fname,index=False)
+        print('Table written: ' + fname)
+    func_msg(func,'end')
+    return df_stats, df_hist
@@ -4,33 +4,68 @@ import subprocess
 import nibabel as nib
 from os.path import isfile, isdir, join
 from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from utils.preproc.parallel import fsl_slot, slot_cores, run_command
+from utils.preproc.build_manifest import needs_update, fsl_version, package_version
+from utils.preproc.sparse_mask import SparseMask
 os.environ['MKL_THREADING_LAYER'] = 'GNU' # to fix issue with hd-bet: Error: mkl-service + Intel(R) MKL: MKL_THREADING_LAYER=INTEL is incompatible with libgomp-a34b3233.so.1 library. 
 
-def erode_mask(img):
-    '''Computes the binary erosion of a 3D image slice-by-slice
+def erode_mask(img,radius=1,iterations=1,shape='cross',fast=False):
+    '''Computes the in-plane binary erosion of a 3D image (each axial slice is eroded independently)
     Parameters:
         img: 3D image
+        radius: in-plane radius of structuring element (voxels), or list of radii
+        iterations: number of times the erosion is repeated
+        shape: 'cross' (4-connected, diamond for radius > 1) or 'square' (8-connected)
+        fast: if True, erodes with separable 1D minimum filters instead of ndimage.binary_erosion (same result, faster for large masks)
     Returns:
-        image after erosion
+        image after erosion, with the data type of img; a list of images if radius is a list
+    Notes:
+        - the whole volume is eroded in one call with a (3,3,1) structure, which gives the same result as eroding slice by slice
+        - voxels outside the image count as background, as in ndimage.binary_erosion
     '''
     # check inputs
     assert np.ndim(img)==3, 'img must be a 3D array'
-#    assert isinstance(r,int) and r>0, 'r must be a positive integer'
+    assert shape in ['cross','square'], 'shape must be one of {cross,square}'
+    radii = [radius] if np.ndim(radius) == 0 else list(radius)
+    assert all([isinstance(r,(int,np.integer)) and r>=0 for r in radii]), 'radius must be a non-negative integer or list of integers'
+    assert isinstance(iterations,int) and iterations>0, 'iterations must be a positive integer'
 
-    # create structuring element
-    el = ndimage.generate_binary_structure(2,1)
+    # erode by increasing radius, each erosion starting from the previous one
+    # (iterations of an element of radius r, or erosions by radii r1 then r2, equal one erosion by radius r*iterations or r1+r2)
+    mask = np.asarray(img) != 0
+    eroded = {}
+    done = 0
+    for r in sorted(set(radii)):
+        mask = erode_inplane(mask,r*iterations - done,shape,fast)
+        done = r*iterations
+        eroded[r] = mask.astype(np.asarray(img).dtype)
 
-    # erode image slice-by-slice
-    img = np.transpose(img,(2,0,1))
-    ns = img.shape[0]
-    for ix in range(ns):
-        s = img[ix,:,:]
-        img[ix,:,:] = ndimage.binary_erosion(s,el)
-    img = np.transpose(img,(1,2,0))
+    if np.ndim(radius) == 0:
+        return eroded[radius]
+    return [eroded[r] for r in radii]
 
-    return img
+def erode_inplane(mask,radius,shape,fast):
+    '''Erodes a 3D boolean mask in-plane by a cross (diamond) or square of given radius; see erode_mask'''
+    if radius == 0:
+        return mask
+    if not fast:
+        el = ndimage.generate_binary_structure(2,1 if shape == 'cross' else 2)[:,:,None]
+        return ndimage.binary_erosion(mask,el,iterations=radius)
 
-def contralateral_rois(seg_filename,c_filename,ven_filename,out_dir,ctv_filename='',overwrite=True):
+    # separable minimum filters; voxels outside the image are 0
+    mask = mask.view(np.uint8)
+    if shape == 'square':
+        for axis in [0,1]:
+            mask = ndimage.minimum_filter1d(mask,2*radius+1,axis=axis,mode='constant',cval=0)
+    else:
+        # a cross is the union of a row and a column, so its erosion is the intersection of their erosions
+        for ii in range(radius):
+            mask = np.minimum(ndimage.minimum_filter1d(mask,3,axis=0,mode='constant',cval=0),
+                ndimage.minimum_filter1d(mask,3,axis=1,mode='constant',cval=0))
+    return mask.view(bool)
+
+def contralateral_rois(seg_filename,c_filename,ven_filename,out_dir,ctv_filename='',overwrite=True,manifest=None):
     '''Intersects contralateral region with WM, GM masks, and ventricles with CSF, from FSL FAST. Also excludes CTV. Saves ROIs.
     Parameters:
         seg_filename: path to _seg.nii.gz from FSL FAST
@@ -39,73 +74,114 @@ def contralateral_rois(seg_filename,c_filename,ven_filename,out_dir,ctv_filename
         out_dir: directory to save outputs
         ctv_filename: filename of CTV, to exclude from contralteral regions
         overwrite: overwrite existing files?
+        manifest: BuildManifest; if given, existing ROIs are rebuilt when their input masks or options changed
+    '''
+    contralateral_rois_batch([seg_filename],c_filename,ven_filename,[out_dir],ctv_filename,overwrite,manifest)
+
+# lookup table from (FAST label, in ventricles) to ROI label (0 = none, 1 = CSF, 2 = GM, 3 = WM), indexed by 2*seg + ven:
+# CSF is kept inside the ventricles only, GM and WM everywhere
+ROI_LUT = np.array([0,0, 0,1, 2,2, 3,3],dtype=np.uint8)
+
+def load_mask(filename,cache):
+    '''Returns a nifti and its voxels as a boolean mask (nonzero voxels), reading each file once per cache
+    Parameters:
+        filename: path to nifti
+        cache: dictionary {filename: (nii, mask)} shared by the calls of one batch
+    '''
+    if filename not in cache:
+        nii = nib.load(filename)
+        cache[filename] = (nii,np.asanyarray(nii.dataobj) != 0)
+    return cache[filename]
+
+def contralateral_rois_batch(seg_filenames,c_filenames,ven_filenames,out_dirs,ctv_filenames='',overwrite=True,manifest=None):
+    '''Makes the contralateral CSF, GM and WM ROIs (see contralateral_rois) of many sessions, reading each mask once
+    Parameters:
+        seg_filenames: list of paths to _seg.nii.gz from FSL FAST, one per session
+        c_filenames: path to contralateral nifti, or list of paths (one per session)
+        ven_filenames: path to ventricle nifti, or list of paths (one per session)
+        out_dirs: list of directories to save outputs, one per session
+        ctv_filenames: filename of CTV to exclude from contralateral regions, or list of filenames (one per session; '' = none)
+        overwrite: overwrite existing files?
+        manifest: BuildManifest; if given, existing ROIs are rebuilt when their input masks or options changed
+    Notes:
+        - masks are kept as bool and labels as uint8; the contralateral mask is repeated axially by broadcasting
+        - the three ROIs of a session are labelled in one pass with ROI_LUT
+        - ROIs are saved as uint8 (0/1) with the geometry of the contralateral mask
     '''
+
     # check inputs
-    assert isfile(seg_filename), 'seg_filename does not exist: ' + seg_filename
-    assert isfile(c_filename), 'c_filename does not exist: ' + c_filename
-    assert isfile(ven_filename), 'ven_filename does not exist: ' + ven_filename
-    assert (not ctv_filename) or isfile(ctv_filename), 'ctv_filename does not exist: ' + ctv_filename
-    assert isdir(out_dir), 'out_dir does not exist: ' + out_dir
+    n = len(seg_filenames)
+    per_session = lambda x: [x]*n if isinstance(x,str) else list(x)
+    c_filenames, ven_filenames, ctv_filenames = per_session(c_filenames), per_session(ven_filenames), per_session(ctv_filenames)
+    assert len(out_dirs) == n and len(c_filenames) == n and len(ven_filenames) == n and len(ctv_filenames) == n, 'one filename per session expected'
+    for seg_filename, c_filename, ven_filename, out_dir, ctv_filename in zip(seg_filenames,c_filenames,ven_filenames,out_dirs,ctv_filenames):
+        assert isfile(seg_filename), 'seg_filename does not exist: ' + seg_filename
+        assert isfile(c_filename), 'c_filename does not exist: ' + c_filename
+        assert isfile(ven_filename), 'ven_filename does not exist: ' + ven_filename
+        assert (not ctv_filename) or isfile(ctv_filename), 'ctv_filename does not exist: ' + ctv_filename
+        assert isdir(out_dir), 'out_dir does not exist: ' + out_dir
 
     # declare options
     erode_csf = False
+    tool = 'contralateral_rois'
+    params = {'erode_csf': erode_csf}
+    masks = {} # masks shared between sessions, read once
+    c_slices = {} # axial projections of contralateral masks
 
-    # declare output names
-    seg_name = os.path.basename(seg_filename).split('.')[0]
-    out_filenames = [join(out_dir,seg_name.replace('_seg','_'+x+'.nii.gz')) for x in ['csf','gm','wm']]
+    # loop sessions
+    for seg_filename, c_filename, ven_filename, out_dir, ctv_filename in zip(seg_filenames,c_filenames,ven_filenames,out_dirs,ctv_filenames):
 
-    # loop ROIs
-    volumes_loaded = False # have volumes been loaded already?
-    for ix,out_filename in zip(range(3),out_filenames):
-        if isfile(out_filename) and (not overwrite):
+        # declare output names
+        seg_name = os.path.basename(seg_filename).split('.')[0]
+        out_filenames = [join(out_dir,seg_name.replace('_seg','_'+x+'.nii.gz')) for x in ['csf','gm','wm']]
+        in_filenames = [x for x in [seg_filename,c_filename,ven_filename,ctv_filename] if x]
+        todo = [needs_update([x],in_filenames,tool,params,overwrite,manifest) for x in out_filenames]
+        for out_filename in [x for x,y in zip(out_filenames,todo) if not y]:
             print('ROI already exists: ' + out_filename)
-        else:
-            if not volumes_loaded:
-                # load segmentation and contralateral mask and ventricle mask and CTV mask if requested
-                nii_seg = nib.load(seg_filename)
-                seg = nii_seg.get_fdata()
-                nii_c = nib.load(c_filename)
-                c = nii_c.get_fdata() 
-                nii_ven = nib.load(ven_filename)
-                ven = nii_ven.get_fdata()
-                if ctv_filename:
-                    nii_ctv = nib.load(ctv_filename)
-                    ctv = nii_ctv.get_fdata()
-
-                # repeat contralateral mask axially
-                c_slice = np.any(c,axis=2)
-                c = np.transpose(np.tile(c_slice,(c.shape[2],1,1)),(1,2,0))
-
-                # set flag to skip loading on next iteration 
-                volumes_loaded = True
-
-            # get channel
-            channel = seg == ix+1
-            # intersect channel with contralateral 
-            c_channel = np.logical_and(channel,c)
-            if ix == 0:
-                # intersect CSF with ventricles
-                c_channel = np.logical_and(c_channel,ven)
-                if erode_csf:
-                    # erode CSF 
-                    c_channel = erode_mask(c_channel)
-            
-            # exclude CTV
-            if ctv_filename:
-                c_channel = np.logical_and(c_channel,np.logical_not(ctv))
-
-            # save nifti
-            nii_o = nib.Nifti1Image(c_channel,nii_c.affine,nii_c.header) 
-            nib.save(nii_o,out_filename)
+        if not any(todo):
+            continue
+
+        # load segmentation, and masks not loaded for a previous session
+        seg = np.asanyarray(nib.load(seg_filename).dataobj).astype(np.uint8)
+        nii_c, c = load_mask(c_filename,masks)
+        if c_filename not in c_slices:
+            c_slices[c_filename] = np.any(c,axis=2)[:,:,None]
+        ven = load_mask(ven_filename,masks)[1]
+
+        # label all ROIs in one pass, then restrict to contralateral region outside CTV
+        seg[seg > 3] = 0
+        labels = np.take(ROI_LUT,2*seg + ven)
+        valid = c_slices[c_filename]
+        if ctv_filename:
+            valid = valid & np.logical_not(load_mask(ctv_filename,masks)[1])
+        labels *= valid
+
+        # save ROIs
+        for ix, out_filename in enumerate(out_filenames):
+            if not todo[ix]:
+                continue
+            c_channel = labels == ix+1
+            if (ix == 0) and erode_csf:
+                # erode CSF
+                c_channel = erode_mask(c_channel)
+            SparseMask.from_array(c_channel,nii_c.affine,nii_c.header).save(out_filename)
             print('ROI created: ' + out_filename)
+            if manifest:
+                manifest.record([out_filename],in_filenames,tool,params)
+
+# HD-BET parameters, shared by do_hdbet and hdbet_batch so that manifest records match between the two
+HDBET_PARAMS = {'device': 'cpu', 'mode': 'fast', 'tta': 0}
 
-def do_hdbet(t1w_path,output_folder):
+def do_hdbet(t1w_path,output_folder,manifest=None,nifti_cache=None):
 	'''Applies HD-BET to extract brain from a T1w volume and saves to desired folder.
 	IN
 	t1w_path: full path to T1w volume.
 	output_folder: folder in which to save brain.
+	manifest: BuildManifest; if given, an existing brain is rebuilt when the T1w, HD-BET version or options changed.
+	nifti_cache: NiftiCache; if given, HD-BET reads the uncompressed copy of the T1w from this cache.
 	OUT
 	output_path: full path to output volume
+	Raises RuntimeError if HD-BET fails, in which case the output is not recorded in the manifest.
 	'''
 	# Check if volume exists
 	if not os.path.exists(t1w_path):
@@ -124,22 +200,138 @@ def do_hdbet(t1w_path,output_folder):
 	output_path = os.path.join(output_folder,output_name)
 
 	# Check if output path exists
-	if os.path.exists(output_path):
+	tool = 'hd-bet ' + package_version('HD_BET')
+	params = HDBET_PARAMS
+	if not needs_update([output_path],[t1w_path],tool,params,manifest=manifest):
 		print('Brain volume %s already exists.' % (output_path))
 	else:
 		# Call HD-BET
-		command = 'hd-bet -i %s -o %s -device cpu -mode fast -tta 0' % (t1w_path,output_path)
+		in_path = nifti_cache.path(t1w_path) if nifti_cache else t1w_path
+		command = 'hd-bet -i %s -o %s -device cpu -mode fast -tta 0' % (in_path,output_path)
 		print('Calling HD-BET for brain extraction.')
 		print(command)
-		subprocess.call(command,shell=True)
+		returncode, seconds = run_command(command)
+		if returncode != 0:
+			# remove a partial brain, which would otherwise be adopted as current by the next run
+			if os.path.exists(output_path):
+				os.remove(output_path)
+			raise RuntimeError('HD-BET failed with return code %d: %s' % (returncode,t1w_path))
+		if manifest:
+			manifest.record([output_path],[t1w_path],tool,params)
 	return output_path
 
-def do_fast(brain_path,output_folder):
+def _hdbet_init(threads):
+    '''Initializes an HD-BET worker process: limits its threads and imports HD-BET (and torch) once'''
+    for key in ['OMP_NUM_THREADS','MKL_NUM_THREADS']:
+        os.environ[key] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    global _run_hd_bet
+    from HD_BET.run import run_hd_bet as _run_hd_bet
+
+def _hdbet_chunk(t1w_paths,output_paths):
+    '''Runs HD-BET on a chunk of T1w volumes in a worker process; the network is loaded once for the chunk.
+    Raises RuntimeError if any brain of the chunk was not written.'''
+    print('HD-BET worker %d: extracting %d brains' %(os.getpid(),len(t1w_paths)))
+    # outputs left by an earlier run must not be taken for outputs of this one
+    for output_path in output_paths:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    try:
+        _run_hd_bet(t1w_paths,output_paths,mode=HDBET_PARAMS['mode'],device=HDBET_PARAMS['device'],
+            postprocess=True,do_tta=bool(HDBET_PARAMS['tta']),keep_mask=True,overwrite=True)
+    except Exception:
+        # the brain being written when HD-BET failed may be partial
+        for output_path in output_paths:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        raise
+    missing = [x for x in output_paths if not os.path.exists(x)]
+    if missing:
+        raise RuntimeError('HD-BET failed to write %d of %d brains: %s' %(len(missing),len(output_paths),', '.join(missing)))
+    return output_paths
+
+def hdbet_batch(t1w_paths,output_folders,workers=1,threads=1,chunk_size=None,manifest=None,nifti_cache=None):
+    '''Applies HD-BET to many T1w volumes in persistent worker processes, each of which loads the network once,
+    with the same options and outputs as do_hdbet
+    Parameters:
+        t1w_paths: list of full paths to T1w volumes
+        output_folders: list of folders in which to save brains, one per T1w volume
+        workers: number of worker processes
+        threads: number of torch threads per worker
+        chunk_size: number of volumes a worker takes from the queue at a time; each chunk loads the network once
+            (default = volumes split evenly between workers, i.e. one load per worker)
+        manifest: BuildManifest; if given, an existing brain is rebuilt when the T1w, HD-BET version or options changed
+        nifti_cache: NiftiCache; if given, HD-BET reads uncompressed copies of the T1w volumes from this cache
+    Returns:
+        output_paths: list of full paths to output volumes, one per T1w volume
+    Notes:
+        - raises RuntimeError once all chunks have run if any chunk failed; brains of failed chunks are not recorded
+    '''
+
+    # check inputs
+    assert len(t1w_paths) == len(output_folders), 't1w_paths and output_folders must have the same length'
+    assert isinstance(workers,int) and workers>0, 'workers must be a positive integer'
+    assert isinstance(threads,int) and threads>0, 'threads must be a positive integer'
+    for t1w_path in t1w_paths:
+        if not os.path.exists(t1w_path):
+            raise ValueError('T1w volume %s does not exist.' % (t1w_path))
+
+    # declare outputs, and queue only those that are missing or stale
+    tool = 'hd-bet ' + package_version('HD_BET')
+    output_paths = []
+    todo = []
+    for t1w_path, output_folder in zip(t1w_paths,output_folders):
+        os.makedirs(output_folder,exist_ok=True)
+        output_path = join(output_folder,'%s_brain.nii.gz' % (os.path.basename(t1w_path).split('.')[0]))
+        output_paths.append(output_path)
+        if needs_update([output_path],[t1w_path],tool,HDBET_PARAMS,manifest=manifest):
+            todo.append((t1w_path,output_path))
+        else:
+            print('Brain volume %s already exists.' % (output_path))
+    if not todo:
+        return output_paths
+
+    # split queue into chunks
+    workers = min(workers,len(todo))
+    if chunk_size is None:
+        chunk_size = int(np.ceil(len(todo)/workers))
+    chunks = [todo[ii:ii+chunk_size] for ii in range(0,len(todo),chunk_size)]
+
+    # run chunks in pool of workers; outputs are recorded as each chunk succeeds, and failed chunks are reported at the end
+    print('Calling HD-BET for brain extraction: %d volumes, %d workers x %d threads' %(len(todo),workers,threads))
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers,initializer=_hdbet_init,initargs=(threads,)) as pool:
+        read_path = nifti_cache.path if nifti_cache else (lambda x: x)
+        futures = [pool.submit(_hdbet_chunk,[read_path(x[0]) for x in chunk],[x[1] for x in chunk]) for chunk in chunks]
+        for chunk, future in zip(chunks,futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('HD-BET chunk failed (%d volumes): %s' %(len(chunk),e))
+                failures.append(e)
+                continue
+            for t1w_path, output_path in chunk:
+                print('Brain extracted: ' + output_path)
+                if manifest:
+                    manifest.record([output_path],[t1w_path],tool,HDBET_PARAMS)
+    if failures:
+        raise RuntimeError('HD-BET failed for %d of %d chunks; their brains are not recorded' %(len(failures),len(chunks))) from failures[0]
+
+    return output_paths
+
+def do_fast(brain_path,output_folder,manifest=None,cores_per_job=0):
 	'''Applies FSL FAST to a T1w brain volume and saves results in desired folder.
+	FAST waits for a free FSL slot (see parallel.fsl_slot), so concurrent calls never exceed the machine-wide cap.
 	IN
 	brain_path: full path to T1w brain volume.
 	output_folder: folder in which to save FAST segmentation.
+	manifest: BuildManifest; if given, an existing segmentation is rebuilt when the brain, FSL version or options changed.
+	cores_per_job: if nonzero, FAST is pinned to this many cores of the slot it runs in.
 	OUT
+	output_seg_path: full path to segmentation volume
+	returncode: return code of FAST (0 if the segmentation already existed)
+	seconds: wall time of FAST (0 if the segmentation already existed)
 	'''
 	# Check if brain volume exists
 	if not os.path.exists(brain_path):
@@ -159,14 +351,55 @@ def do_fast(brain_path,output_folder):
 
 	# Check if output path already exists
 	output_seg_path = output_path+'_seg.nii.gz'
-	if os.path.exists(output_seg_path):
+	tool = 'fast ' + fsl_version()
+	params = {'t': 1, 'n': 3, 'H': 0.1, 'I': 4, 'l': 20.0}
+	returncode, seconds = 0, 0.
+	if not needs_update([output_seg_path],[brain_path],tool,params,manifest=manifest):
 		print('Segmentation volume %s already exists.' % (output_seg_path))
 	else:
 		# Call FSL FAST
-		command = '/usr/local/fsl/bin/fast -t 1 -n 3 -H 0.1 -I 4 -l 20.0 -o %s %s' % (output_path,brain_path)
-		print('Calling FSL FAST for segmentation.')
-		print(command)
-		subprocess.call(command,shell=True)
+		fast = os.path.join(os.environ.get('FSLDIR','/usr/local/fsl'),'bin','fast')
+		command = '%s -t 1 -n 3 -H 0.1 -I 4 -l 20.0 -o %s %s' % (fast,output_path,brain_path)
+		with fsl_slot() as slot:
+			cores = slot_cores(slot,cores_per_job) if cores_per_job else None
+			print('Calling FSL FAST for segmentation (slot %d, cores %s).' % (slot,sorted(cores) if cores else 'all'))
+			print(command)
+			returncode, seconds = run_command(command,cores=cores)
+		if returncode != 0:
+			print('FAST failed with return code %d: %s' % (returncode,brain_path))
+		elif manifest:
+			manifest.record([output_seg_path],[brain_path],tool,params)
+	return output_seg_path, returncode, seconds
+
+def fast_batch(brain_paths,output_folders,jobs=1,cores_per_job=1,manifest=None):
+    '''Applies FSL FAST to many brain volumes in a pool, one job per core set
+    Parameters:
+        brain_paths: list of full paths to T1w brain volumes
+        output_folders: list of folders in which to save FAST segmentations, one per brain volume
+        jobs: number of FAST jobs to run at once; jobs also wait for free FSL slots, so other FSL stages
+            running on the machine lower the number of jobs that actually run
+        cores_per_job: number of cores each job is pinned to (FAST is single-threaded, so 1 core per job)
+        manifest: BuildManifest; if given, existing segmentations are rebuilt when their inputs changed
+    Returns:
+        results: list of (output_seg_path, returncode, seconds), one per brain volume
+    '''
+
+    # check inputs
+    assert len(brain_paths) == len(output_folders), 'brain_paths and output_folders must have the same length'
+    assert isinstance(jobs,int) and jobs>0, 'jobs must be a positive integer'
+
+    # FAST runs in its own process, so threads are enough to keep jobs in flight
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(do_fast,x,y,manifest,cores_per_job) for x,y in zip(brain_paths,output_folders)]
+        results = [future.result() for future in futures]
+
+    # summarize
+    seconds = [x[2] for x in results if x[2] > 0]
+    failed = [x[0] for x in results if x[1] != 0]
+    print('FAST: %d segmentations run (%.1f s total, %.1f s max), %d failed' %(len(seconds),sum(seconds),max(seconds + [0.]),len(failed)))
+    for fname in failed:
+        print('FAST failed: ' + fname)
+    return results
 
 if __name__ == '__main__':
     
@@ -1,7 +1,7 @@
 # imports
 import numpy as np
 import pandas as pd
-from utils.preproc.project_parameters import get_bids_layout
+from utils.preproc.project_parameters import get_bids_layout, session_to_date
 from utils.preproc.align_volumes import get_sessions
 from utils.preproc.io import func_msg
 from os.path import join, isfile, isdir
@@ -13,6 +13,10 @@ def make_session_day_table(dirs,subjects):
     Parameters:
         dirs: directories
         subjects: subject list
+    Notes:
+        - if a table already exists, only the sessions that are not yet in it are added
+        - subjects without a treatment start date are listed in debug_<scanner>.csv, which keeps those of earlier runs
+          until their start date is found
     '''
 
     # communciate with user
@@ -23,88 +27,76 @@ def make_session_day_table(dirs,subjects):
     #fn_tracker = join(dirs['proj'],'data','momentum_tracker_full.xlsx')
     fn_tracker = join(dirs['proj'],'data','MOMENTUM_study_tracker_20220518.xlsx')
     df_tracker = pd.read_excel(fn_tracker,usecols="B,Z",header=3) # usecol: B=Study ID, Z=Tx start date
+    df_start = get_start_dates(df_tracker)
     
     # loop scanners
     scanners = ['mrl','sim']
+    columns = ['Subject','Session','TxStartDate','Date','TxDay']
     for scanner in scanners:
 
-        # declare filename
+        # read existing table
         fn_table = join(dirs['proj'],'results','metadata','session_day_'+scanner+'.csv')
         if isfile(fn_table):
-            print('Session-day table already exists: ' + fn_table)
+            df_old = pd.read_csv(fn_table,dtype={'Subject':str,'Session':str,'TxStartDate':str,'Date':str})
+            print('Session-day table exists, adding new sessions: ' + fn_table)
         else:
-
-            # get layout
-            layout = get_bids_layout(scanner)
-
-            # loop subjects
-            rows = []
-            rows_debug = []
-            for subject in subjects:
-
-                print('Processing: ' + subject)
-
-                # find sessions
-                sessions = get_sessions(layout,subject)
-
-                # loop sessions
-                for session in sessions:
-
-                    # find date
-                    date = session_to_date(layout,subject,session)
-
-                    # convert date to day
-                    day, start_date = date_2_day(df_tracker,subject,date)
-
-                    # store date
-                    if start_date:
-                        rows.append([subject,session,start_date,date,day])
-
-                    else:
-                        rows_debug.append([subject])
-
-            # write table to csv
-            df_table = pd.DataFrame(rows,columns=['Subject','Session','TxStartDate','Date','TxDay'])
-            df_table.to_csv(fn_table,index=False)
-            print('Session-day table written: ' + fn_table)
-
-            # write table of failure cases to csv
-            df_debug = pd.DataFrame(rows_debug,columns=['Subject'])
-            df_debug.to_csv(join(dirs['proj'],'results','metadata','debug_'+scanner+'.csv'),index=False)
+            df_old = pd.DataFrame(columns=columns)
+        done = set(zip(df_old['Subject'],df_old['Session']))
+
+        # get layout
+        layout = get_bids_layout(scanner)
+
+        # collect sessions that are not yet in the table, with their dates
+        rows = []
+        for subject in subjects:
+            for session in get_sessions(layout,subject):
+                if (subject,session) not in done:
+                    rows.append([subject,session,session_to_date(layout,subject,session)])
+        if not rows:
+            print('Session-day table is up to date: ' + fn_table)
+            continue
+        df_new = pd.DataFrame(rows,columns=['Subject','Session','Date'])
+
+        # join with treatment start dates and compute days
+        df_new = df_new.merge(df_start,on='Subject',how='left')
+        has_start = df_new['TxStart'].notna()
+        df_debug = df_new.loc[~has_start,['Subject']].drop_duplicates()
+        df_new = df_new[has_start].copy()
+        start = df_new['TxStart']
+        df_new['TxStartDate'] = start.dt.year.astype(str) + start.dt.month.astype(str) + start.dt.day.astype(str)
+        df_new['TxDay'] = (pd.to_datetime(df_new['Date'],format='%Y%m%d') - start.dt.normalize()).dt.days
+
+        # write table to csv
+        df_table = pd.concat([df_old,df_new[columns]],ignore_index=True)
+        df_table.to_csv(fn_table,index=False)
+        print('Session-day table written (%d new sessions): %s' %(len(df_new),fn_table))
+
+        # add failure cases to table of earlier failures, dropping subjects that now have a start date
+        fn_debug = join(dirs['proj'],'results','metadata','debug_'+scanner+'.csv')
+        if isfile(fn_debug):
+            df_debug = pd.concat([pd.read_csv(fn_debug,dtype={'Subject':str}),df_debug],ignore_index=True)
+        has_start_date = df_start.loc[df_start['TxStart'].notna(),'Subject']
+        df_debug = df_debug[~df_debug['Subject'].isin(has_start_date)].drop_duplicates()
+        df_debug.to_csv(fn_debug,index=False)
 
     func_msg(func,'end')
 
-def session_to_date(layout,subject,session):
-    '''Returns the date of the session for a given subject
-    Parameters:
-        layout: bids layout
-        subject: subject name
-        session: session name
-    '''
-    fn_json = layout.get(subject=subject,session=session,suffix='T1w',extension='json',return_type='filename')[0]
-#    if subject == 'M082' and session == 'MRL006':
-#        import pdb; pdb.set_trace()
-    with open(fn_json) as f:
-        js = json.load(f)
-    adt = js['AcquisitionDateTime']
-    date = adt.split('T')[0].replace('-','')
-    return date
-
-def date_2_day(df_tracker,subject,date):
-    '''Returns the start date and  treatment day for a given subject and date
+def get_start_dates(df_tracker):
+    '''Returns the treatment start date of each subject
     Parameters:
         df_tracker: pandas dataframe from momentum tracker
-        subject: subject name
-        date: date
+    Returns:
+        df_start: dataframe with columns Subject, TxStart (datetime)
     '''
-    is_subject = df_tracker['Study ID']==subject
-    if subject == 'M007':
-        date_start = datetime.datetime(2019,9,25) # from fraction schedule spreadsheet; start date not listed in momentum tracker
-    else:
-        date_start = df_tracker[is_subject].iloc[0]['TX START DATE']
-    date_now = datetime.date(int(date[0:4]),int(date[4:6]),int(date[6:8]))
-    tdelta = date_now - date_start.date()
-    day = tdelta.days
-    start_date = str(date_start.year) + str(date_start.month) + str(date_start.day)
-
-    return day, start_date
+    df_start = df_tracker.rename(columns={'Study ID':'Subject','TX START DATE':'TxStart'})[['Subject','TxStart']]
+    df_start = df_start.dropna(subset=['Subject']).drop_duplicates(subset='Subject',keep='first')
+    df_start['TxStart'] = pd.to_datetime(df_start['TxStart'],errors='coerce')
+
+    # from fraction schedule spreadsheet; start date not listed in momentum tracker
+    override = {'M007': datetime.datetime(2019,9,25)}
+    for subject, date_start in override.items():
+        if subject in df_start['Subject'].values:
+            df_start.loc[df_start['Subject']==subject,'TxStart'] = date_start
+        else:
+            df_start = pd.concat([df_start,pd.DataFrame({'Subject':[subject],'TxStart':[date_start]})],ignore_index=True)
+    return df_start
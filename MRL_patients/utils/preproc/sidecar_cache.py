@@ -0,0 +1,83 @@
+# cache of the metadata in BIDS .json sidecars, so that each sidecar is parsed once rather than on every date/session lookup
+
+import sqlite3
+import json
+import os
+from os.path import dirname, basename
+from utils.preproc.bids_index import get_bids_index, parse_bids_name, natural_key
+
+class SidecarCache(object):
+    """
+    SQLite table of (path, subject, session, run, suffix, AcquisitionDateTime) for the sidecars of a BIDS dataset.
+    A sidecar is parsed again only if its size or modification time changed.
+
+    Args:
+        root (str): root of BIDS dataset
+        db_fname (str): filename of database
+    """
+
+    def __init__(self, root, db_fname):
+        self.root = root
+        self.db_fname = db_fname
+        self.memo = {}
+        os.makedirs(dirname(db_fname),exist_ok=True)
+        with self.connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('CREATE TABLE IF NOT EXISTS sidecars (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, subject TEXT, session TEXT, run TEXT, suffix TEXT, acquisition_datetime TEXT)')
+            con.execute('CREATE INDEX IF NOT EXISTS sidecars_subject ON sidecars (subject, suffix)')
+        con.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memo'] = {}
+        return state
+
+    def connect(self):
+        return sqlite3.connect(self.db_fname,timeout=60)
+
+    def sidecars(self, subject, suffix='T1w'):
+        '''returns a list of (session, path, AcquisitionDateTime) for the sidecars of a subject, in filename order;
+        new and changed sidecars are parsed and stored, and the result is kept for the rest of the process. Sidecars
+        without AcquisitionDateTime are left out, with a message'''
+        key = (subject,suffix)
+        if key in self.memo:
+            return self.memo[key]
+
+        fnames = get_bids_index(self.root).get(subject,suffix=suffix,extension='json')
+        con = self.connect()
+        with con:
+            cached = {x[0]: x[1:] for x in con.execute('SELECT path, size, mtime_ns, session, acquisition_datetime FROM sidecars WHERE subject=? AND suffix=?',(subject,suffix))}
+            rows = []
+            for fname in fnames:
+                st = os.stat(fname)
+                row = cached.get(fname)
+                if row and (row[0] == st.st_size) and (row[1] == st.st_mtime_ns):
+                    session, adt = row[2], row[3]
+                else:
+                    with open(fname) as f:
+                        data = json.load(f)
+                    entities = parse_bids_name(fname)[0]
+                    session = entities.get('ses',basename(dirname(dirname(fname))).replace('ses-',''))
+                    adt = data.get('AcquisitionDateTime') # stored as NULL if missing, so the sidecar is not parsed again
+                    con.execute('INSERT OR REPLACE INTO sidecars VALUES (?,?,?,?,?,?,?,?)',(fname,st.st_size,st.st_mtime_ns,subject,session,entities.get('run'),suffix,adt))
+                if not adt:
+                    print('no AcquisitionDateTime in sidecar, skipping: ' + fname)
+                    continue
+                rows.append((session,fname,adt))
+        con.close()
+        rows.sort(key=lambda x: natural_key(x[1]))
+        self.memo[key] = rows
+        return rows
+
+    def session_to_date(self, subject, session, suffix='T1w'):
+        '''returns the acquisition date (YYYYmmdd) of a session, from its first sidecar'''
+        rows = [x for x in self.sidecars(subject,suffix) if x[0] == session]
+        assert len(rows)>0, 'no %s .json file with AcquisitionDateTime found: %s %s'%(suffix,subject,session)
+        return rows[0][2].split('T')[0].replace('-','')
+
+    def date_to_session(self, subject, date, suffix='T1w'):
+        '''returns the session acquired on a date (YYYYmmdd), or '' if there is none'''
+        for session, fname, adt in self.sidecars(subject,suffix):
+            if adt.split('T')[0].replace('-','') == date:
+                return session
+        return ''
@@ -0,0 +1,161 @@
+# compact representation of binary masks (contours, AIAA segmentations, contralateral ROIs) as sorted linear indices
+#
+# Voxels are indexed in the on-disk (Fortran) order of NIfTI, i + nx*(j + ny*k), so the voxels of an axial slice are a
+# contiguous range of indices, set operations are merges of sorted arrays, and per-slice run-length encodings follow
+# from the indices directly.
+
+import numpy as np
+import nibabel as nib
+
+def merge_sorted(a,b):
+    '''Merges two sorted arrays of unique values in linear time
+    Parameters:
+        a, b: sorted arrays of unique values
+    Returns:
+        merged: sorted concatenation of a and b; a value in both appears twice, first from a
+        from_b: boolean array of which elements of merged come from b
+    Notes:
+        - the stable sort of numpy (timsort) finds the two sorted runs of the concatenation and merges them in one pass
+    '''
+    c = np.concatenate([a,b])
+    order = np.argsort(c,kind='stable')
+    return c[order], order >= a.size
+
+def repeated(merged):
+    '''Returns a boolean array of which elements of a merged array (see merge_sorted) are equal to the next element'''
+    rep = np.zeros(merged.size,dtype=bool)
+    rep[:-1] = merged[1:] == merged[:-1]
+    return rep
+
+class SparseMask(object):
+    """
+    Binary mask stored as the sorted linear indices (Fortran order) of its nonzero voxels, with the geometry of its grid.
+    Union (|), intersection (&) and difference (-) of masks on the same grid, volume, bounding box and run-length
+    encoding cost O(nnz).
+
+    Args:
+        index (np.ndarray): sorted, unique linear indices of nonzero voxels
+        shape (tuple): shape of grid
+        affine (np.ndarray): 4x4 voxel-to-world matrix of grid
+        header (nib.Nifti1Header): header of grid, or None
+    """
+
+    def __init__(self, index, shape, affine, header=None):
+        self.index = np.asarray(index,dtype=np.int64)
+        self.shape = tuple(int(x) for x in shape[:3])
+        self.affine = np.array(affine,dtype=float)
+        self.header = header
+
+    @classmethod
+    def from_array(cls, data, affine, header=None):
+        '''returns the mask of the nonzero voxels of a 3D array'''
+        return cls(np.flatnonzero(np.asarray(data).ravel(order='F')),data.shape,affine,header)
+
+    @classmethod
+    def load(cls, fname):
+        '''returns the mask of the nonzero voxels of a NIfTI volume, read (and decompressed) once'''
+        img = nib.load(fname)
+        return cls.from_array(np.asanyarray(img.dataobj),img.affine,img.header)
+
+    @classmethod
+    def from_runs(cls, starts, lengths, shape, affine, header=None):
+        '''returns the mask of a run-length encoding (see runs)'''
+        starts = np.asarray(starts,dtype=np.int64)
+        lengths = np.asarray(lengths,dtype=np.int64)
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths,lengths)
+        return cls(offsets + np.arange(lengths.sum()),shape,affine,header)
+
+    def __len__(self):
+        return int(self.index.size)
+
+    def __eq__(self, other):
+        return self.same_grid(other) and np.array_equal(self.index,other.index)
+
+    def same_grid(self, other):
+        '''returns True if another mask is on the same grid'''
+        return (self.shape == other.shape) and np.allclose(self.affine,other.affine,atol=1e-4)
+
+    def like(self, index):
+        '''returns a mask with given indices on the grid of this mask'''
+        return SparseMask(index,self.shape,self.affine,self.header)
+
+    def __or__(self, other):
+        assert self.same_grid(other), 'masks are not on the same grid'
+        merged, _ = merge_sorted(self.index,other.index)
+        keep = np.ones(merged.size,dtype=bool)
+        keep[1:] = merged[1:] != merged[:-1]
+        return self.like(merged[keep])
+
+    def __and__(self, other):
+        assert self.same_grid(other), 'masks are not on the same grid'
+        merged, _ = merge_sorted(self.index,other.index)
+        return self.like(merged[repeated(merged)])
+
+    def __sub__(self, other):
+        assert self.same_grid(other), 'masks are not on the same grid'
+        # a voxel of both masks is merged as a pair, the voxel of this mask first
+        merged, from_b = merge_sorted(self.index,other.index)
+        return self.like(merged[~from_b & ~repeated(merged)])
+
+    def zooms(self):
+        '''returns the voxel dimensions (mm) of the grid'''
+        if self.header is not None:
+            return np.array(self.header.get_zooms()[:3],dtype=float)
+        return np.sqrt((self.affine[:3,:3]**2).sum(axis=0))
+
+    def volume(self):
+        '''returns the volume (cc) of the mask'''
+        return len(self)*np.prod(self.zooms())*1e-3
+
+    def coords(self):
+        '''returns the (i,j,k) voxel coordinates of the mask as three arrays'''
+        return np.unravel_index(self.index,self.shape,order='F')
+
+    def bbox(self):
+        '''returns the bounding box of the mask as a tuple of slices (None if the mask is empty)'''
+        if len(self) == 0:
+            return None
+        nx, ny = self.shape[:2]
+        i = self.index % nx
+        j = (self.index // nx) % ny
+        k0, k1 = self.index[0] // (nx*ny), self.index[-1] // (nx*ny) # indices are sorted by slice
+        return (slice(int(i.min()),int(i.max())+1),slice(int(j.min()),int(j.max())+1),slice(int(k0),int(k1)+1))
+
+    def slices(self):
+        '''returns the axial slices that contain voxels of the mask'''
+        return np.unique(self.index // (self.shape[0]*self.shape[1]))
+
+    def runs(self):
+        '''returns the per-slice run-length encoding of the mask: the first index and length of each run of consecutive
+        voxels, with runs split at the start of each axial slice'''
+        if len(self) == 0:
+            return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64)
+        breaks = np.flatnonzero((np.diff(self.index) != 1) | (self.index[1:] % (self.shape[0]*self.shape[1]) == 0)) + 1
+        starts = np.concatenate([[0],breaks])
+        lengths = np.diff(np.concatenate([starts,[len(self)]]))
+        return self.index[starts], lengths
+
+    def to_array(self):
+        '''returns the mask as a dense 3D boolean array'''
+        flat = np.zeros(int(np.prod(self.shape)),dtype=bool)
+        flat[self.index] = True
+        return flat.reshape(self.shape,order='F')
+
+    def to_nifti(self):
+        '''returns the mask as a uint8 NIfTI image (0/1) with the geometry of the grid'''
+        header = self.header.copy() if self.header is not None else None
+        img = nib.Nifti1Image(self.to_array().astype(np.uint8),self.affine,header)
+        img.header.set_data_dtype(np.uint8)
+        img.header.set_slope_inter(1,0)
+        return img
+
+    def save(self, fname):
+        '''saves the mask as a NIfTI volume'''
+        nib.save(self.to_nifti(),fname)
+
+def load_union(fnames):
+    '''Returns the union of the nonzero voxels of NIfTI masks on the same grid, as a SparseMask'''
+    mask = SparseMask.load(fnames[0])
+    for fname in fnames[1:]:
+        mask = mask | SparseMask.load(fname)
+    return mask
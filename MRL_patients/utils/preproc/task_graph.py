@@ -0,0 +1,195 @@
+# task graph to run pre-processing stages in dependency order
+
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from os.path import exists, getmtime, isdir, join
+from utils.preproc.io import func_msg
+
+def newest_mtime(path):
+    '''Returns the modification time of a file, or the newest modification time of the files under a directory
+    (the mtime of a directory itself changes only when its direct entries change, not when files below it are rewritten)'''
+    if not isdir(path):
+        return getmtime(path)
+    t = getmtime(path)
+    for root, folders, fnames in os.walk(path):
+        for fname in fnames:
+            try:
+                t = max(t,os.stat(join(root,fname)).st_mtime)
+            except OSError:
+                # e.g. broken symbolic link
+                pass
+    return t
+
+class Task(object):
+    """
+    Stage of the pipeline with the files it reads and writes
+
+    Args:
+        name (str): name of task
+        func (function): function that runs the stage
+        kwargs (dict): keyword arguments of func
+        inputs (list): files or directories read by the stage
+        outputs (list): files or directories written by the stage
+    """
+
+    def __init__(self, name, func, kwargs=None, inputs=None, outputs=None):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs if kwargs else {}
+        self.inputs = inputs if inputs else []
+        self.outputs = outputs if outputs else []
+        self.stamp = '' # file touched each time the task finishes (see TaskGraph)
+
+    def is_stale(self):
+        '''returns True if the task has no outputs, if an output is missing, if the task never finished, or if a file under
+        an input is newer than the last time the task finished'''
+        if not self.outputs:
+            return True
+        if not all([exists(x) for x in self.outputs]):
+            return True
+        if not (self.stamp and exists(self.stamp)):
+            return True
+        t_out = getmtime(self.stamp)
+        t_in = [newest_mtime(x) for x in self.inputs if exists(x)]
+        return any([t > t_out for t in t_in])
+
+    def run(self, jobs=None):
+        '''runs the stage, with at most jobs worker processes if the stage takes a jobs argument, then touches the stamp'''
+        kwargs = dict(self.kwargs)
+        if (jobs is not None) and ('jobs' in kwargs):
+            kwargs['jobs'] = jobs
+        self.func(**kwargs)
+        if self.stamp:
+            os.makedirs(os.path.dirname(self.stamp),exist_ok=True)
+            with open(self.stamp,'w') as f:
+                f.write(self.name + '\n')
+
+class TaskGraph(object):
+    """
+    Graph of tasks; a task depends on every task that writes one of its inputs
+
+    Args:
+        stamp_dir (str): directory of the stamp files that record when each task last finished (default = none, so tasks
+            that were not requested always run)
+    """
+
+    def __init__(self, stamp_dir=''):
+        self.tasks = {}
+        self.stamp_dir = stamp_dir
+
+    def add(self, task):
+        assert task.name not in self.tasks, 'task already exists: ' + task.name
+        if self.stamp_dir:
+            task.stamp = join(self.stamp_dir,task.name + '.done')
+        self.tasks[task.name] = task
+
+    def dependencies(self, name):
+        '''returns the names of the tasks that write the inputs of a task'''
+        inputs = self.tasks[name].inputs
+        deps = [x.name for x in self.tasks.values() if (x.name != name) and any([y in inputs for y in x.outputs])]
+        return deps
+
+    def resolve(self, targets):
+        '''returns the requested tasks and all of the tasks they depend on, checking for cycles
+        args:
+            targets (list): names of requested tasks
+        returns:
+            names (list): names of tasks, with dependencies before dependents
+        '''
+        names = []
+        visiting = []
+
+        def visit(name):
+            assert name in self.tasks, 'unknown task: ' + name
+            if name in names:
+                return
+            assert name not in visiting, 'cycle in task graph at task: ' + name
+            visiting.append(name)
+            for dep in self.dependencies(name):
+                visit(dep)
+            visiting.remove(name)
+            names.append(name)
+
+        for target in targets:
+            visit(target)
+        return names
+
+    def run(self, targets, jobs=None):
+        '''runs the requested tasks and their dependencies; tasks whose dependencies are done are run concurrently
+        args:
+            targets (list): names of requested tasks
+            jobs (int): if given, total number of worker processes shared by the tasks that run at once
+        notes:
+            - requested tasks always run; the stages skip existing outputs themselves
+            - dependencies that were not requested run only if they are stale (see Task.is_stale)
+            - each running task holds at least one of the jobs; the jobs still free are split evenly between the tasks that
+              become ready together (a task that takes a jobs argument gets at most the jobs it asks for), so independent
+              stages overlap and concurrent stages never start more than jobs worker processes between them
+        '''
+
+        # communicate with user
+        func = 'task graph (%s)' %(', '.join(targets))
+        func_msg(func,'start')
+
+        names = self.resolve(targets)
+        deps = {name: self.dependencies(name) for name in names}
+        done = []
+        running = {}
+        held = {} # jobs held by running tasks
+        failed = False
+
+        with ThreadPoolExecutor(max_workers=max(len(names),1)) as pool:
+            while len(done) < len(names):
+
+                # declare tasks whose dependencies are done
+                ready = []
+                if not failed:
+                    for name in names:
+                        if (name in done) or (name in running.values()):
+                            continue
+                        if not all([x in done for x in deps[name]]):
+                            continue
+                        if (name in targets) or self.tasks[name].is_stale():
+                            ready.append(name)
+                        else:
+                            print('Task is up to date, skipping: ' + name)
+                            done.append(name)
+
+                # start ready tasks, splitting the free jobs between them
+                if jobs is not None:
+                    free = jobs - sum(held.values())
+                    ready = ready[:max(free,0)]
+                for ix, name in enumerate(ready):
+                    task = self.tasks[name]
+                    if jobs is None:
+                        n_jobs = None
+                    else:
+                        n_jobs = min(task.kwargs.get('jobs',1),max(free//(len(ready)-ix),1))
+                        free -= n_jobs
+                    print('Starting task: ' + name + ('' if n_jobs is None else ' (%d jobs)' %(n_jobs)))
+                    future = pool.submit(task.run,n_jobs)
+                    running[future] = name
+                    held[future] = n_jobs if n_jobs else 0
+
+                if not running:
+                    if failed:
+                        break
+                    continue
+
+                # wait for a task to finish
+                finished, _ = wait(list(running.keys()),return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    held.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        print('Task failed: %s (%s)' %(name,error))
+                        failed = error
+                    else:
+                        print('Task finished: ' + name)
+                        done.append(name)
+
+        if failed:
+            raise failed
+
+        func_msg(func,'end')
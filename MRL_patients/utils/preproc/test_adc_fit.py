@@ -0,0 +1,86 @@
+# tests of the mono-exponential ADC fit (adc_fit.py): known ADC and S0 are recovered from synthetic DWI, and voxels
+# that are not fitted are 0 in the ADC map
+#
+# Run from MRL_patients: python -m pytest utils/preproc/test_adc_fit.py
+
+import sys
+import types
+import importlib
+import numpy as np
+import nibabel as nib
+import pytest
+
+# b-values (s/mm^2) of the MR-Linac DWI protocol
+BVALS = np.array([0.,30.,50.,100.,150.,200.,300.,400.,500.,600.,800.])
+
+@pytest.fixture
+def adc_fit(monkeypatch):
+    '''adc_fit module, with pybids and nipype stubbed if they are not installed (the BIDS helpers are not run here)'''
+    try:
+        import bids
+    except ImportError:
+        bids = types.ModuleType('bids')
+        bids.BIDSLayout = None
+        monkeypatch.setitem(sys.modules,'bids',bids)
+    try:
+        import nipype.interfaces.fsl
+    except ImportError:
+        for name in ['nipype','nipype.interfaces','nipype.interfaces.fsl']:
+            monkeypatch.setitem(sys.modules,name,types.ModuleType(name))
+    return importlib.import_module('utils.preproc.adc_fit')
+
+@pytest.fixture
+def phantom(tmp_path):
+    '''DWI of a volume with ADC rising from 0.5 to 3 x 10^-3 mm^2/s along x, S0 of 1000 along y; the first slice is
+    background (signal 0), and the bval file is written as on the scanner (one line)'''
+    shape = (8,6,3)
+    adc = np.broadcast_to(np.linspace(0.5e-3,3e-3,shape[0])[:,None,None],shape)
+    s0 = np.broadcast_to(np.linspace(500.,1500.,shape[1])[None,:,None],shape)
+    dwi = (s0[...,None]*np.exp(-BVALS*adc[...,None])).astype(np.float32)
+    dwi[:,:,0] = 0.
+    dwi_fname, bval_fname = str(tmp_path / 'dwi.nii.gz'), str(tmp_path / 'dwi.bval')
+    nib.save(nib.Nifti1Image(dwi,np.diag([2.,2.,4.,1.])),dwi_fname)
+    np.savetxt(bval_fname,BVALS[None,:],fmt='%d')
+    return dwi_fname, bval_fname, adc, s0
+
+@pytest.mark.parametrize('method',['ols','wls'])
+def test_fit_recovers_known_adc(adc_fit, method):
+    adc = np.array([0.5e-3,1e-3,2e-3])
+    s0 = np.array([100.,1000.,50.])
+    signal = s0[:,None]*np.exp(-adc[:,None]*BVALS[None,:])
+    adc_est, s0_est = adc_fit.fit_adc(signal,BVALS,method)
+    assert np.allclose(adc_est,adc,rtol=1e-6)
+    assert np.allclose(s0_est,s0,rtol=1e-6)
+
+def test_wls_is_less_biased_by_noise(adc_fit):
+    '''with Gaussian noise, weighting by the predicted signal brings the mean ADC closer to the truth than OLS does'''
+    rng = np.random.default_rng(0)
+    adc = 2e-3
+    signal = 100.*np.exp(-adc*BVALS)[None,:] + rng.normal(0.,3.,(20000,BVALS.size))
+    errors = [abs(np.mean(adc_fit.fit_adc(signal,BVALS,method)[0]) - adc) for method in ['ols','wls']]
+    assert errors[1] < errors[0]
+
+@pytest.mark.parametrize('chunk_size,threads',[(2**16,1),(7,1),(7,3)])
+def test_fit_volume(adc_fit, phantom, tmp_path, chunk_size, threads):
+    '''maps are in 10^-3 mm^2/s; background voxels (no signal at b = 0) are 0; chunks and threads give the same map'''
+    dwi_fname, bval_fname, adc, s0 = phantom
+    out_fname, s0_fname = str(tmp_path / 'adc.nii.gz'), str(tmp_path / 's0.nii.gz')
+    adc_fit.fit_adc_volume(dwi_fname,bval_fname,out_fname,chunk_size=chunk_size,threads=threads,s0_fname=s0_fname)
+    out = nib.load(out_fname).get_fdata()
+    assert np.allclose(out[:,:,1:],adc[:,:,1:]*1e3,rtol=1e-4)
+    assert np.all(out[:,:,0] == 0)
+    assert np.allclose(nib.load(s0_fname).get_fdata()[:,:,1:],s0[:,:,1:],rtol=1e-4)
+
+def test_fit_volume_mask_and_cache(adc_fit, phantom, tmp_path):
+    '''only voxels of the mask are fitted, and the DWI read through the nifti cache gives the same map'''
+    from utils.preproc.nifti_cache import NiftiCache
+    dwi_fname, bval_fname, adc, s0 = phantom
+    mask = np.zeros(adc.shape,dtype=np.uint8)
+    mask[2:5,1:4,1:] = 1
+    mask_fname = str(tmp_path / 'mask.nii.gz')
+    nib.save(nib.Nifti1Image(mask,np.diag([2.,2.,4.,1.])),mask_fname)
+    out_fname = str(tmp_path / 'adc.nii.gz')
+    adc_fit.fit_adc_volume(dwi_fname,bval_fname,out_fname,mask_fname=mask_fname,chunk_size=5,nifti_cache=NiftiCache(str(tmp_path / 'cache')))
+    out = nib.load(out_fname).get_fdata()
+    assert np.allclose(out[mask != 0],adc[mask != 0]*1e3,rtol=1e-4)
+    assert np.all(out[mask == 0] == 0)
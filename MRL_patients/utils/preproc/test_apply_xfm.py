@@ -0,0 +1,93 @@
+# tests of the in-process applyxfm (apply_xfm.py) against reference outputs worked out by hand: small volumes moved by
+# known FLIRT matrices, in radiological and neurological storage order
+#
+# Run from MRL_patients: python -m pytest utils/preproc/test_apply_xfm.py
+
+import numpy as np
+import nibabel as nib
+import pytest
+from utils.preproc.apply_xfm import apply_xfm_batch
+
+# voxel dimensions (mm) of the test volumes
+ZOOMS = (2.,2.,3.)
+
+def translation(t):
+    '''FLIRT matrix that translates scaled-voxel coordinates by t (mm)'''
+    matrix = np.eye(4)
+    matrix[:3,3] = t
+    return matrix
+
+def save(tmp_path, name, data, neurological=False):
+    affine = np.diag(list(ZOOMS) + [1.])
+    if not neurological:
+        # radiological storage order (negative determinant), in which FSL scaled-voxel x follows the voxel index
+        affine[0,0] = -affine[0,0]
+    fname = str(tmp_path / (name + '.nii.gz'))
+    nib.save(nib.Nifti1Image(data,affine),fname)
+    return fname
+
+def resample(tmp_path, data, matrix, interp, neurological=False):
+    in_fname = save(tmp_path,'in',data,neurological)
+    out_fname = str(tmp_path / 'out.nii.gz')
+    apply_xfm_batch([in_fname],in_fname,matrix,[out_fname],interp=interp)
+    return np.asanyarray(nib.load(out_fname).dataobj)
+
+@pytest.fixture
+def labels():
+    return np.arange(1,6*5*4 + 1,dtype=np.int16).reshape((6,5,4))
+
+def test_identity(tmp_path, labels):
+    for interp in ['nearestneighbour','trilinear']:
+        assert np.array_equal(resample(tmp_path,labels,np.eye(4),interp),labels)
+
+def test_whole_voxel_translation(tmp_path, labels):
+    '''a translation by one voxel in each axis moves the volume by one voxel; voxels mapped from outside are 0'''
+    expected = np.zeros_like(labels)
+    expected[1:,1:,1:] = labels[:-1,:-1,:-1]
+    for interp in ['nearestneighbour','trilinear']:
+        assert np.array_equal(resample(tmp_path,labels,translation(ZOOMS),interp),expected)
+
+def test_neurological_x_is_flipped(tmp_path, labels):
+    '''in neurological storage order, positive scaled-voxel x is decreasing voxel index'''
+    expected = np.zeros_like(labels)
+    expected[:-1] = labels[1:]
+    out = resample(tmp_path,labels,translation([ZOOMS[0],0.,0.]),'nearestneighbour',neurological=True)
+    assert np.array_equal(out,expected)
+
+def test_nearest_neighbour_rounds_half_up(tmp_path, labels):
+    '''half a voxel back (-1 mm in x) samples input x+0.5, which rounds to x+1; half a voxel forward samples x-0.5,
+    which rounds to x'''
+    expected = np.zeros_like(labels)
+    expected[:-1] = labels[1:]
+    assert np.array_equal(resample(tmp_path,labels,translation([-1.,0.,0.]),'nearestneighbour'),expected)
+    assert np.array_equal(resample(tmp_path,labels,translation([1.,0.,0.]),'nearestneighbour'),labels)
+
+def test_trilinear_half_voxel(tmp_path):
+    '''half a voxel back along a linear ramp gives the midpoints; the last voxel samples outside and is 0'''
+    ramp = np.broadcast_to(np.arange(6,dtype=np.float32)[:,None,None]*10.,(6,5,4)).copy()
+    out = resample(tmp_path,ramp,translation([-1.,0.,0.]),'trilinear')
+    assert np.allclose(out[:-1],ramp[:-1] + 5.)
+    assert np.all(out[-1] == 0)
+
+def test_rotation_about_axis(tmp_path):
+    '''a 90 degree rotation in the x-y plane about the centre of a square slice transposes and flips it'''
+    data = np.arange(5*5*3,dtype=np.float32).reshape((5,5,3))
+    zooms = np.array(ZOOMS)
+    centre = (np.array(data.shape) - 1)/2.*zooms
+    rot = np.eye(4)
+    rot[:2,:2] = [[0.,-1.],[1.,0.]]
+    matrix = translation(centre) @ rot @ translation(-centre)
+    out = resample(tmp_path,data,matrix,'nearestneighbour')
+    # output voxel (i,j) samples input at the inverse rotation: (j, 4-i)
+    assert np.array_equal(out,np.rot90(data,k=1,axes=(0,1)))
+
+def test_4d_and_dtype(tmp_path, labels):
+    '''each volume of a 4D input is resampled as a 3D input would be, and integer outputs keep their data type'''
+    data = np.stack([labels,2*labels],axis=-1)
+    out = resample(tmp_path,data,translation(ZOOMS),'nearestneighbour')
+    assert out.dtype == np.int16
+    assert out.shape == data.shape
+    expected = np.zeros_like(labels)
+    expected[1:,1:,1:] = labels[:-1,:-1,:-1]
+    assert np.array_equal(out[...,0],expected)
+    assert np.array_equal(out[...,1],2*expected)
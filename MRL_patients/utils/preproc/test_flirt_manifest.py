@@ -0,0 +1,145 @@
+# tests of the build manifest in flirt_utils.flirt_volumes: outputs are rebuilt when an input changes, and failed FSL
+# commands are never recorded as current
+#
+# FSL is replaced by a fake that writes the outputs FLIRT would write and fails, as FLIRT does, on missing inputs.
+# Run from MRL_patients: python -m pytest utils/preproc/test_flirt_manifest.py
+
+import sys
+import types
+import shutil
+import importlib
+import numpy as np
+import nibabel as nib
+import pytest
+from os.path import isfile, join
+
+class FakeInterface(object):
+    '''stand-in for the nipype FLIRT and ApplyXFM interfaces, which only need inputs and a command line here'''
+    flags = [('in_file','-in'),('reference','-ref'),('out_file','-out'),('in_matrix_file','-init'),('out_matrix_file','-omat'),('apply_isoxfm','-applyisoxfm'),('dof','-dof')]
+
+    def __init__(self, **kwargs):
+        self.inputs = types.SimpleNamespace(**kwargs)
+
+    @property
+    def cmdline(self):
+        parts = ['flirt']
+        for name, flag in self.flags:
+            value = getattr(self.inputs,name,None)
+            if value is not None:
+                parts += [flag,str(value) if value != '' else '.']
+        return ' '.join(parts) + ' '
+
+class FakeFSL(object):
+    '''runs fake FSL command lines, records them, and fails registrations (-dof) while fail is set'''
+
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def __call__(self, cmd, cores=None):
+        self.calls.append(cmd)
+        args = cmd.split()
+        opts = {args[ix]: args[ix+1] for ix in range(1,len(args)-1,2)}
+        if not (isfile(opts['-in']) and isfile(opts['-ref'])):
+            return 1, 0.
+        if self.fail and ('-dof' in opts):
+            return 1, 0.
+        if opts.get('-out','.') != '.':
+            shutil.copy(opts['-in'],opts['-out'])
+        if '-omat' in opts:
+            np.savetxt(opts['-omat'],np.eye(4),fmt='%.6f')
+        return 0, 0.
+
+    def registrations(self):
+        return [x for x in self.calls if '-dof' in x]
+
+@pytest.fixture
+def flirt_utils(monkeypatch, tmp_path):
+    '''flirt_utils with the fake FSL in place of nipype and of the command runner'''
+    try:
+        import nipype.interfaces.fsl
+    except ImportError:
+        for name in ['nipype','nipype.interfaces','nipype.interfaces.fsl']:
+            monkeypatch.setitem(sys.modules,name,types.ModuleType(name))
+    monkeypatch.setenv('FSL_SLOT_DIR',str(tmp_path / 'slots'))
+    module = importlib.import_module('utils.preproc.flirt_utils')
+    fake = FakeFSL()
+    preprocess = types.SimpleNamespace(FLIRT=FakeInterface,ApplyXFM=FakeInterface)
+    monkeypatch.setattr(module,'fsl',types.SimpleNamespace(FLIRT=FakeInterface,preprocess=preprocess))
+    monkeypatch.setattr(module,'run_command',fake)
+    module.fake = fake
+    return module
+
+def save_volume(fname, seed):
+    nib.save(nib.Nifti1Image(np.random.default_rng(seed).random((6,6,4)).astype(np.float32),np.eye(4)),fname)
+
+def setup_session(tmp_path):
+    from utils.preproc.build_manifest import BuildManifest
+    in_fname, ref_fname = str(tmp_path / 'sub-M1_ses-MRL002_T1w.nii.gz'), str(tmp_path / 'sub-M1_ses-MRL001_T1w.nii.gz')
+    save_volume(in_fname,0)
+    save_volume(ref_fname,1)
+    out_dir = tmp_path / 'coreg'
+    out_dir.mkdir()
+    return in_fname, ref_fname, str(out_dir), BuildManifest(str(tmp_path / 'build_manifest.sqlite'))
+
+def test_rebuild_after_input_change(flirt_utils, tmp_path):
+    '''a session whose input changed is registered again from fresh iso volumes, although its old output exists'''
+    in_fname, ref_fname, out_dir, manifest = setup_session(tmp_path)
+    run = lambda: flirt_utils.flirt_volumes(in_fname,ref_fname,[],'coreg',out_dir,overwrite=False,resample=2,manifest=manifest)
+
+    run()
+    assert len(flirt_utils.fake.registrations()) == 1
+    assert isfile(join(out_dir,'sub-M1_ses-MRL002_T1w_coreg.nii.gz'))
+
+    # nothing to do while inputs are unchanged
+    flirt_utils.fake.calls.clear()
+    run()
+    assert flirt_utils.fake.calls == []
+
+    # changed input: resampled, registered and applied again
+    save_volume(in_fname,2)
+    run()
+    assert len(flirt_utils.fake.registrations()) == 1
+    assert len([x for x in flirt_utils.fake.calls if '-applyisoxfm' in x]) == 2
+
+def test_failed_registration_is_not_recorded(flirt_utils, tmp_path):
+    '''a failed FLIRT run raises, and the registration is run again next time rather than adopted as current'''
+    in_fname, ref_fname, out_dir, manifest = setup_session(tmp_path)
+    run = lambda: flirt_utils.flirt_volumes(in_fname,ref_fname,[],'coreg',out_dir,overwrite=False,resample=2,manifest=manifest)
+    run()
+
+    save_volume(in_fname,2)
+    flirt_utils.fake.fail = True
+    with pytest.raises(RuntimeError):
+        run()
+
+    flirt_utils.fake.fail = False
+    flirt_utils.fake.calls.clear()
+    run()
+    assert len(flirt_utils.fake.registrations()) == 1
+
+def test_python_phase1_is_recorded_under_its_own_tool(flirt_utils, monkeypatch, tmp_path):
+    '''with the python backend, the other-to-input matrix is estimated from cached copies and recorded as mi_registration'''
+    import sqlite3
+    from utils.preproc.nifti_cache import NiftiCache
+    in_fname, ref_fname, out_dir, manifest = setup_session(tmp_path)
+    other_fname = str(tmp_path / 'sub-M1_ses-MRL002_ADC.nii.gz')
+    save_volume(other_fname,3)
+    cache = NiftiCache(str(tmp_path / 'nifti_cache'))
+    registered = []
+    def fake_register(in_fname, ref_fname, out_matrix_fname, **kwargs):
+        registered.append((in_fname,ref_fname))
+        np.savetxt(out_matrix_fname,np.eye(4),fmt='%.6f')
+    monkeypatch.setattr(flirt_utils,'mi_register',fake_register)
+    flirt_utils.flirt_volumes(in_fname,ref_fname,[other_fname],'coreg',out_dir,other_qform=False,overwrite=False,manifest=manifest,backend='python',nifti_cache=cache)
+
+    assert registered[-1] == (cache.path(other_fname),cache.path(in_fname))
+    with sqlite3.connect(manifest.db_fname) as con:
+        tools = dict(con.execute('SELECT path, tool FROM outputs').fetchall())
+    assert tools[join(out_dir,'sub-M1_ses-MRL002_ADC_coreg_phase1.mat')] == 'mi_registration'
+    assert tools[join(out_dir,'sub-M1_ses-MRL002_ADC_coreg.mat')].startswith('flirt')
+
+    # nothing to estimate again while inputs are unchanged
+    registered.clear()
+    flirt_utils.flirt_volumes(in_fname,ref_fname,[other_fname],'coreg',out_dir,other_qform=False,overwrite=False,manifest=manifest,backend='python',nifti_cache=cache)
+    assert registered == []
@@ -0,0 +1,50 @@
+# tests of the eviction of the iso cache: entries over budget are removed least recently used first, except those used
+# within the grace period, which workers may still be reading
+#
+# Run from MRL_patients: python -m pytest utils/preproc/test_iso_cache.py
+
+import os
+import sys
+import time
+import types
+import importlib
+import pytest
+from os.path import isfile, join
+
+@pytest.fixture
+def iso_cache(monkeypatch):
+    '''iso_cache module, with nipype stubbed if it is not installed (resampling is not run here)'''
+    try:
+        import nipype.interfaces.fsl
+    except ImportError:
+        for name in ['nipype','nipype.interfaces','nipype.interfaces.fsl']:
+            monkeypatch.setitem(sys.modules,name,types.ModuleType(name))
+    return importlib.import_module('utils.preproc.iso_cache')
+
+def add_entry(cache, name, size, age):
+    '''writes an entry of a given size (bytes) last used age seconds ago'''
+    iso_fname = join(cache.cache_dir,name + '.nii.gz')
+    for fname in [iso_fname,iso_fname.replace('.nii.gz','.mat')]:
+        with open(fname,'wb') as f:
+            f.write(b'\0'*size)
+    t = time.time() - age
+    os.utime(iso_fname,(t,t))
+    return iso_fname
+
+def test_recently_used_entries_are_kept(iso_cache, tmp_path):
+    cache = iso_cache.IsoCache(str(tmp_path / 'iso_cache'),budget=2.5e-6,grace=60.)
+    new = add_entry(cache,'new',1000,0.)
+    used = add_entry(cache,'used',1000,30.)
+    old = add_entry(cache,'old',1000,3600.)
+    older = add_entry(cache,'older',1000,7200.)
+    cache.evict(keep=new)
+    # all four are over the budget of two entries, but only the entries outside the grace period are removed
+    assert isfile(new) and isfile(used)
+    assert not isfile(old) and not isfile(older)
+    assert not isfile(old.replace('.nii.gz','.mat'))
+
+def test_least_recently_used_first(iso_cache, tmp_path):
+    cache = iso_cache.IsoCache(str(tmp_path / 'iso_cache'),budget=4.5e-6,grace=0.)
+    fnames = [add_entry(cache,'e%d' %ii,1000,100.*ii) for ii in range(4)]
+    cache.evict()
+    assert [isfile(x) for x in fnames] == [True,True,False,False]
@@ -0,0 +1,84 @@
+# tests of the low-ADC volumes and the table of volume dynamics (low_adc.py) on synthetic ADC maps and contours
+#
+# Run from MRL_patients: python -m pytest utils/preproc/test_low_adc.py
+
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from os.path import join
+from utils.preproc.low_adc import low_adc_volumes, make_dyn_table
+
+# voxel dimensions (mm) of the test volumes, and volume of one voxel (cc)
+ZOOMS = (2.,2.,2.5)
+VOXEL_CC = 2.*2.*2.5*1e-3
+
+def save(fname, data):
+    os.makedirs(os.path.dirname(fname),exist_ok=True)
+    nib.save(nib.Nifti1Image(data,np.diag(list(ZOOMS) + [1.])),fname)
+    return fname
+
+def gtv():
+    mask = np.zeros((10,10,4),dtype=np.uint8)
+    mask[2:6,2:6,1:3] = 1 # 32 voxels
+    return mask
+
+def adc_map(n_low, n_unfit):
+    '''ADC map of 1.5 with n_low GTV voxels at 0.8 and n_unfit GTV voxels at 0 (not fit)'''
+    adc = np.full((10,10,4),1.5,dtype=np.float32)
+    index = np.flatnonzero(gtv())
+    adc.flat[index[:n_low]] = 0.8
+    adc.flat[index[n_low:n_low+n_unfit]] = 0.
+    # low and unfit voxels outside the GTV are never counted
+    adc[8:,8:,:] = 0.5
+    adc[0,0,:] = 0.
+    return adc
+
+def test_unfit_voxels_are_not_low_adc(tmp_path):
+    adc_fnames = [save(str(tmp_path / ('adc%d.nii.gz' %ii)),adc_map(n_low,n_unfit)) for ii,(n_low,n_unfit) in enumerate([(5,0),(5,7),(0,10)])]
+    gtv_fname = save(str(tmp_path / 'gtv.nii.gz'),gtv())
+    volumes = low_adc_volumes(adc_fnames,[[gtv_fname]])
+    assert np.allclose(volumes[:,0],np.array([5,5,0])*VOXEL_CC)
+
+def test_relative_threshold_ignores_unfit_reference_voxels(tmp_path):
+    '''the threshold relative to a reference ROI is taken from the median of its fit voxels only'''
+    adc = adc_map(5,0)
+    ref = np.zeros((10,10,4),dtype=np.uint8)
+    ref[6:8,:,:] = 1 # 80 voxels, half of which are unfit: the median of all would be 0.5
+    adc[6:8,:5,:] = 0.
+    adc[6:8,5:,:] = 1.0
+    adc_fname = save(str(tmp_path / 'adc.nii.gz'),adc)
+    gtv_fname = save(str(tmp_path / 'gtv.nii.gz'),gtv())
+    ref_fname = save(str(tmp_path / 'wm.nii.gz'),ref)
+    volumes = low_adc_volumes([adc_fname],[[gtv_fname]],threshold=0.9,ref_fnames=[ref_fname])
+    assert np.allclose(volumes,5*VOXEL_CC)
+
+def test_union_of_contours(tmp_path):
+    '''a multifocal boundary is the union of its contours; overlapping voxels are counted once'''
+    adc_fname = save(str(tmp_path / 'adc.nii.gz'),np.full((10,10,4),0.8,dtype=np.float32))
+    a, b = np.zeros((10,10,4),dtype=np.uint8), np.zeros((10,10,4),dtype=np.uint8)
+    a[0:4,0:4,0] = 1
+    b[2:6,2:6,0] = 1
+    fnames = [save(str(tmp_path / 'a.nii.gz'),a),save(str(tmp_path / 'b.nii.gz'),b)]
+    volumes = low_adc_volumes([adc_fname],[fnames])
+    assert np.allclose(volumes,28*VOXEL_CC)
+
+def test_dyn_table(tmp_path):
+    '''every MR-Linac and MR-sim session gets a low-ADC and a tumour core row per contoured MR-sim session'''
+    dirs = {x: str(tmp_path / x) for x in ['proj','mr_linac','mr_sim']}
+    for scanner, sessions in [('mr_linac',['MRL001','MRL002']),('mr_sim',['sim001'])]:
+        for ix, session in enumerate(sessions):
+            save(join(dirs[scanner],'adc','sub-M001','ses-'+session,'sub-M001_ses-%s_adc.nii.gz' %session),adc_map(3*(ix+1),2))
+    save(join(dirs['mr_sim'],'glio_contours','sub-M001','ses-sim001','sub-M001_ses-sim001_GTV.nii.gz'),gtv())
+    os.makedirs(join(dirs['proj'],'results','metadata'))
+    with open(join(dirs['proj'],'results','metadata','session_day_mrl.csv'),'w') as f:
+        f.write('Subject,Session,TxStartDate,Date,TxDay\nM001,MRL001,2020101,20201005,4\n')
+
+    df = make_dyn_table(dirs,['M001'])
+    assert len(df) == 6
+    low = df[df['Metric'] == 'VolumeLowADC'].set_index('Session')['Value']
+    assert np.allclose(low[['MRL001','MRL002','sim001']],np.array([3,6,3])*VOXEL_CC)
+    assert np.allclose(df.loc[df['Metric'] == 'VolumeTumourcore','Value'],32*VOXEL_CC)
+    assert set(df['TumourcoreSession']) == {'sim001'}
+    assert df.set_index(['Session','Metric']).loc[('MRL001','VolumeLowADC'),'Day'] == 4
+    assert df.set_index(['Session','Metric'])['Day'].isna().sum() == 4
@@ -0,0 +1,68 @@
+# tests of the in-process rigid registration (mi_registration.py): a fixture pair related by a known rigid FLIRT matrix
+# is registered and the estimated matrix is compared with the known one
+#
+# FLIRT itself is not run here; the known matrix stands in for its result. The tolerance is stated on the matrix: the
+# points of the reference volume are moved by at most MAX_ERROR_MM between the estimated and the known transformation.
+# Run from MRL_patients: python -m pytest utils/preproc/test_mi_registration.py
+
+import numpy as np
+import nibabel as nib
+import pytest
+from utils.preproc.mi_registration import mi_register, rigid_matrix
+from utils.preproc.apply_xfm import apply_xfm_batch
+from utils.preproc.fsl_matrix import fsl_vox2mm, read_fsl_matrix, write_fsl_matrix
+
+# declare parameters
+MAX_ERROR_MM = 1. # maximum displacement of a reference point between estimated and known matrices
+MAX_ERROR_INVERSE_MM = 2. # same, registering reference to input: the moving volume then has zero-filled margins
+
+def phantom(shape=(48,48,24)):
+    '''Returns a smooth head-like phantom: nested ellipsoids of different intensities with an off-centre lesion'''
+    x, y, z = np.meshgrid(*[np.linspace(-1,1,n) for n in shape],indexing='ij')
+    data = 100.*((x/0.8)**2 + (y/0.9)**2 + (z/0.8)**2 < 1)
+    data += 60.*((x/0.6)**2 + (y/0.7)**2 + (z/0.6)**2 < 1)
+    data += 150.*(((x-0.3)/0.2)**2 + ((y+0.2)/0.25)**2 + ((z-0.1)/0.3)**2 < 1)
+    data -= 80.*(((x+0.2)/0.1)**2 + (y/0.4)**2 + (z/0.5)**2 < 1)
+    return data.astype(np.float32)
+
+def max_displacement(a, b, img):
+    '''returns the largest distance (mm) between the images of the corners of a volume under two FLIRT matrices'''
+    corners = np.array([[i,j,k,1] for i in [0,img.shape[0]-1] for j in [0,img.shape[1]-1] for k in [0,img.shape[2]-1]]).T
+    mm = fsl_vox2mm(img) @ corners
+    return np.max(np.linalg.norm((a @ mm - b @ mm)[:3],axis=0))
+
+@pytest.fixture
+def fixture_pair(tmp_path):
+    '''input volume and reference volume made from it with a known rigid matrix (input -> reference)'''
+    affine = np.diag([2.,2.,3.,1.])
+    in_fname, ref_fname = str(tmp_path / 'in.nii.gz'), str(tmp_path / 'ref.nii.gz')
+    img = nib.Nifti1Image(phantom(),affine)
+    nib.save(img,in_fname)
+    centre = (fsl_vox2mm(img) @ np.append((np.array(img.shape) - 1)/2.,1))[:3]
+    known = rigid_matrix(np.radians([3.,-2.,6.]).tolist() + [4.,-3.,2.],centre)
+    write_fsl_matrix(str(tmp_path / 'known.mat'),known)
+    apply_xfm_batch([in_fname],in_fname,known,[ref_fname],interp='trilinear')
+    return in_fname, ref_fname, known, img
+
+@pytest.mark.parametrize('levels',[None,[8.,4.,2.]])
+def test_known_rigid_transform(fixture_pair, tmp_path, levels):
+    '''the estimated matrix moves no reference point by more than MAX_ERROR_MM from where the known matrix moves it'''
+    in_fname, ref_fname, known, img = fixture_pair
+    out = str(tmp_path / 'est.mat')
+    mi_register(in_fname,ref_fname,out,sampling=2.,levels=levels)
+    assert max_displacement(read_fsl_matrix(out),known,img) < MAX_ERROR_MM
+
+def test_inverse(fixture_pair, tmp_path):
+    '''registering reference to input and inverting gives the same matrix, to within one in-plane voxel'''
+    in_fname, ref_fname, known, img = fixture_pair
+    out = str(tmp_path / 'est.mat')
+    mi_register(in_fname,ref_fname,out,sampling=2.,inverse=True)
+    assert max_displacement(read_fsl_matrix(out),known,img) < MAX_ERROR_INVERSE_MM
+
+def test_quiet_by_default(fixture_pair, tmp_path, capsys):
+    '''coarse-to-fine levels are reported only in verbose mode'''
+    in_fname, ref_fname, known, img = fixture_pair
+    mi_register(in_fname,ref_fname,str(tmp_path / 'a.mat'),levels=[8.,4.])
+    assert 'pyramid level' not in capsys.readouterr().out
+    mi_register(in_fname,ref_fname,str(tmp_path / 'b.mat'),levels=[8.,4.],verbose=True)
+    assert 'pyramid level' in capsys.readouterr().out
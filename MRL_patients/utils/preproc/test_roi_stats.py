@@ -0,0 +1,88 @@
+# tests of the ROI statistics (roi_stats.py): statistics of overlapping ROIs computed from one label image agree with
+# numpy computed ROI by ROI
+#
+# Run from MRL_patients: python -m pytest utils/preproc/test_roi_stats.py
+
+import numpy as np
+import nibabel as nib
+import pytest
+from utils.preproc.roi_stats import ADC_BINS, PERCENTILES, label_image, label_stats, session_roi_stats, sorted_percentiles
+
+ZOOMS = (2.,2.,2.5)
+
+def reference_stats(values, mask):
+    '''voxels, mean, SD, percentiles and histogram of the finite values in a mask'''
+    v = values[mask & np.isfinite(values)].astype(np.float64)
+    if v.size == 0:
+        return np.concatenate([[0],np.full(2+len(PERCENTILES),np.nan)]), np.zeros(len(ADC_BINS)-1)
+    hist = np.histogram(np.clip(v,ADC_BINS[0],ADC_BINS[-1]-1e-9),ADC_BINS)[0]
+    sd = np.std(v,ddof=1) if v.size > 1 else np.nan
+    return np.concatenate([[v.size,v.mean(),sd],np.percentile(v,PERCENTILES)]), hist
+
+def overlapping_masks(shape, seed=0):
+    '''a ROI, a ROI within it, a ROI partly overlapping both, a disjoint ROI, a one-voxel ROI and an empty ROI'''
+    rng = np.random.default_rng(seed)
+    outer = rng.random(shape) < 0.4
+    inner = outer & (rng.random(shape) < 0.5)
+    partial = np.zeros(shape,dtype=bool)
+    partial[shape[0]//2:,:,:] = True
+    disjoint = ~(outer | partial)
+    single = np.zeros(shape,dtype=bool)
+    single[0,0,0] = True
+    return [outer,inner,partial,disjoint,single,np.zeros(shape,dtype=bool)]
+
+def test_sorted_percentiles():
+    x = np.sort(np.random.default_rng(1).normal(size=101))
+    assert np.allclose(sorted_percentiles(x,PERCENTILES),np.percentile(x,PERCENTILES))
+    assert np.all(np.isnan(sorted_percentiles(np.array([]),PERCENTILES)))
+
+def test_label_image():
+    masks = overlapping_masks((8,7,3))
+    labels, membership = label_image(masks)
+    assert labels.dtype == np.int32
+    assert not membership[0].any()
+    for ix, mask in enumerate(masks):
+        assert np.array_equal(membership[labels,ix],mask)
+
+def test_label_stats_match_per_roi():
+    shape = (12,10,4)
+    values = np.random.default_rng(2).gamma(4.,0.3,shape)
+    values[0,1,:] = np.nan # ignored
+    values[1,1,:] = 5. # beyond the last bin
+    masks = overlapping_masks(shape)
+    labels, membership = label_image(masks)
+    stats, hist = label_stats(values,labels,membership)
+    assert stats.shape == (len(masks),3+len(PERCENTILES))
+    for ix, mask in enumerate(masks):
+        ref_stats, ref_hist = reference_stats(values,mask)
+        assert np.allclose(stats[ix],ref_stats,equal_nan=True)
+        assert np.array_equal(hist[ix],ref_hist)
+
+def test_session_roi_stats(tmp_path):
+    '''ROIs with several files are their union, and low-ADC subregions exclude unfit voxels (ADC of 0)'''
+    shape = (12,10,4)
+    affine = np.diag(list(ZOOMS) + [1.])
+    adc = np.random.default_rng(3).uniform(0.5,2.5,shape).astype(np.float32)
+    adc[:3,:3,:] = 0.
+    adc_fname = str(tmp_path / 'adc.nii.gz')
+    nib.save(nib.Nifti1Image(adc,affine),adc_fname)
+    gtv_a, gtv_b, ctv = np.zeros(shape,dtype=np.uint8), np.zeros(shape,dtype=np.uint8), np.zeros(shape,dtype=np.uint8)
+    gtv_a[1:5,1:5,1:3] = 1
+    gtv_b[4:7,4:7,1:3] = 1
+    ctv[:8,:8,:] = 1
+    rois = {}
+    for name, masks in [('GTV',[gtv_a,gtv_b]),('CTV',[ctv])]:
+        rois[name] = []
+        for ix, mask in enumerate(masks):
+            rois[name].append(str(tmp_path / ('%s%d.nii.gz' %(name,ix))))
+            nib.save(nib.Nifti1Image(mask,affine),rois[name][-1])
+
+    names, stats, hist = session_roi_stats(adc_fname,rois,threshold=1.)
+    assert names == ['GTV','CTV','GTV_LowADC','CTV_LowADC']
+    gtv = (gtv_a > 0) | (gtv_b > 0)
+    low = (adc > 0) & (adc < 1.)
+    for ix, mask in enumerate([gtv,ctv > 0,gtv & low,(ctv > 0) & low]):
+        ref_stats, ref_hist = reference_stats(adc,mask)
+        assert np.allclose(stats[ix,:-1],ref_stats,rtol=1e-5,equal_nan=True)
+        assert np.array_equal(hist[ix],ref_hist)
+        assert stats[ix,-1] == pytest.approx(mask.sum()*np.prod(ZOOMS)*1e-3)
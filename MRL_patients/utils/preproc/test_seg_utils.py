@@ -0,0 +1,116 @@
+# tests of seg_utils: failed HD-BET runs raise and are never recorded in the build manifest, and in-plane erosion
+# (3D and fast paths) equals eroding each axial slice with ndimage.binary_erosion
+#
+# HD-BET is replaced by fakes that write (or fail to write) the brain.
+# Run from MRL_patients: python -m pytest utils/preproc/test_seg_utils.py
+
+import shutil
+import numpy as np
+from scipy import ndimage
+import nibabel as nib
+import pytest
+from os.path import isfile, join
+from utils.preproc import seg_utils
+from utils.preproc.build_manifest import BuildManifest
+
+def save_volume(fname, seed=0):
+    nib.save(nib.Nifti1Image(np.random.default_rng(seed).random((6,6,4)).astype(np.float32),np.eye(4)),fname)
+
+class FakeHDBET(object):
+    '''runs fake hd-bet command lines: copies the input to the output, and fails with return code 1 while fail is set'''
+
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def __call__(self, cmd, cores=None):
+        self.calls.append(cmd)
+        args = cmd.split()
+        shutil.copy(args[args.index('-i')+1],args[args.index('-o')+1])
+        return (1 if self.fail else 0), 0.
+
+@pytest.fixture
+def session(tmp_path):
+    t1w_path = str(tmp_path / 'sub-M1_ses-MRL001_T1w.nii.gz')
+    save_volume(t1w_path)
+    return t1w_path, str(tmp_path / 'seg'), BuildManifest(str(tmp_path / 'build_manifest.sqlite'))
+
+def test_failed_hdbet_raises_and_is_not_recorded(session, monkeypatch):
+    t1w_path, output_folder, manifest = session
+    fake = FakeHDBET()
+    monkeypatch.setattr(seg_utils,'run_command',fake)
+
+    fake.fail = True
+    with pytest.raises(RuntimeError):
+        seg_utils.do_hdbet(t1w_path,output_folder,manifest=manifest)
+
+    # the brain written by the failed run is removed, so it is not adopted: HD-BET runs again
+    assert not isfile(join(output_folder,'sub-M1_ses-MRL001_T1w_brain.nii.gz'))
+    fake.fail = False
+    seg_utils.do_hdbet(t1w_path,output_folder,manifest=manifest)
+    assert len(fake.calls) == 2
+
+    # recorded after success
+    seg_utils.do_hdbet(t1w_path,output_folder,manifest=manifest)
+    assert len(fake.calls) == 2
+
+def test_batch_worker_raises_on_missing_brains(tmp_path, monkeypatch):
+    '''a chunk in which HD-BET writes only some brains fails, even if older brains exist for the others'''
+    t1w_paths = [str(tmp_path / ('t1w%d.nii.gz' %ii)) for ii in range(2)]
+    output_paths = [str(tmp_path / ('brain%d.nii.gz' %ii)) for ii in range(2)]
+    for fname in t1w_paths + output_paths:
+        save_volume(fname)
+    def partial(t1w_paths, output_paths, **kwargs):
+        shutil.copy(t1w_paths[0],output_paths[0])
+    monkeypatch.setattr(seg_utils,'_run_hd_bet',partial,raising=False)
+    with pytest.raises(RuntimeError,match='1 of 2'):
+        seg_utils._hdbet_chunk(t1w_paths,output_paths)
+    assert isfile(output_paths[0]) and not isfile(output_paths[1])
+
+def test_batch_worker_removes_brains_when_hdbet_raises(tmp_path, monkeypatch):
+    t1w_path, output_path = str(tmp_path / 't1w.nii.gz'), str(tmp_path / 'brain.nii.gz')
+    save_volume(t1w_path)
+    def crash(t1w_paths, output_paths, **kwargs):
+        with open(output_paths[0],'wb') as f:
+            f.write(b'partial')
+        raise MemoryError
+    monkeypatch.setattr(seg_utils,'_run_hd_bet',crash,raising=False)
+    with pytest.raises(MemoryError):
+        seg_utils._hdbet_chunk([t1w_path],[output_path])
+    assert not isfile(output_path)
+
+def erode_slices(mask, radius, iterations, shape):
+    '''reference erosion: each axial slice eroded on its own by a 3x3 element, once per unit of radius and iteration'''
+    el = ndimage.generate_binary_structure(2,1 if shape == 'cross' else 2)
+    out = np.asarray(mask) != 0
+    for k in range(out.shape[2]):
+        s = out[:,:,k]
+        for _ in range(radius*iterations):
+            s = ndimage.binary_erosion(s,el)
+        out[:,:,k] = s
+    return out
+
+def random_masks():
+    '''masks of blobs, a mask that fills the volume (every edge voxel touches the border) and one with holes'''
+    rng = np.random.default_rng(0)
+    blobs = ndimage.gaussian_filter(rng.random((24,20,5)),2) > 0.5
+    full = np.ones((12,10,3),dtype=np.uint8)
+    holes = (rng.random((16,16,4)) > 0.1).astype(np.int16)
+    return [blobs,full,holes]
+
+@pytest.mark.parametrize('shape',['cross','square'])
+@pytest.mark.parametrize('fast',[False,True])
+@pytest.mark.parametrize('radius,iterations',[(0,1),(1,1),(1,3),(2,1),(2,2),(4,1)])
+def test_erode_mask_matches_slice_loop(shape, fast, radius, iterations):
+    for mask in random_masks():
+        out = seg_utils.erode_mask(mask,radius=radius,iterations=iterations,shape=shape,fast=fast)
+        assert out.dtype == mask.dtype
+        assert np.array_equal(out != 0,erode_slices(mask,radius,iterations,shape))
+
+@pytest.mark.parametrize('fast',[False,True])
+def test_erode_mask_list_of_radii(fast):
+    '''erosions by several radii, each built on the previous one, equal separate erosions'''
+    for mask in random_masks():
+        outs = seg_utils.erode_mask(mask,radius=[3,1,2],iterations=2,fast=fast)
+        for r, out in zip([3,1,2],outs):
+            assert np.array_equal(out != 0,erode_slices(mask,r,2,'cross'))
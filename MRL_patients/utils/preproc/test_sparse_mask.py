@@ -0,0 +1,66 @@
+# tests of sparse masks (sparse_mask.py): set operations, run-length encoding and the NIfTI round trip agree with the
+# same operations on dense arrays
+#
+# Run from MRL_patients: python -m pytest utils/preproc/test_sparse_mask.py
+
+import numpy as np
+import nibabel as nib
+import pytest
+from utils.preproc.sparse_mask import SparseMask, load_union, merge_sorted
+
+AFFINE = np.diag([2.,2.,3.,1.])
+
+def random_masks(shape=(9,7,5), n=6, seed=0):
+    '''random masks of different densities, including an empty and a full mask'''
+    rng = np.random.default_rng(seed)
+    masks = [rng.random(shape) < p for p in np.linspace(0.05,0.95,n-2)]
+    return masks + [np.zeros(shape,dtype=bool),np.ones(shape,dtype=bool)]
+
+def test_merge_sorted():
+    a, b = np.array([1,4,6,9]), np.array([0,4,5,9,12])
+    merged, from_b = merge_sorted(a,b)
+    assert list(merged) == [0,1,4,4,5,6,9,9,12]
+    assert list(from_b) == [True,False,False,True,True,False,False,True,True]
+
+def test_set_operations_match_dense():
+    masks = random_masks()
+    for x in masks:
+        for y in masks:
+            a, b = SparseMask.from_array(x,AFFINE), SparseMask.from_array(y,AFFINE)
+            assert np.array_equal((a | b).to_array(),x | y)
+            assert np.array_equal((a & b).to_array(),x & y)
+            assert np.array_equal((a - b).to_array(),x & ~y)
+
+def test_operations_need_same_grid():
+    a = SparseMask.from_array(np.ones((4,4,2)),AFFINE)
+    with pytest.raises(AssertionError):
+        a | SparseMask.from_array(np.ones((4,4,2)),np.eye(4))
+
+def test_load_and_union(tmp_path):
+    masks = random_masks()
+    fnames = []
+    for ii, x in enumerate(masks[:3]):
+        fnames.append(str(tmp_path / ('roi%d.nii.gz' %ii)))
+        nib.save(nib.Nifti1Image(x.astype(np.uint8)*(ii+1),AFFINE),fnames[-1])
+    assert np.array_equal(SparseMask.load(fnames[1]).to_array(),masks[1])
+    union = load_union(fnames)
+    assert np.array_equal(union.to_array(),masks[0] | masks[1] | masks[2])
+    assert np.isclose(union.volume(),(masks[0] | masks[1] | masks[2]).sum()*12e-3)
+
+    # round trip through NIfTI
+    union.save(str(tmp_path / 'union.nii.gz'))
+    img = nib.load(str(tmp_path / 'union.nii.gz'))
+    assert img.get_data_dtype() == np.uint8
+    assert SparseMask.load(str(tmp_path / 'union.nii.gz')) == union
+
+def test_runs_bbox_and_slices():
+    for x in random_masks()[:-2]:
+        mask = SparseMask.from_array(x,AFFINE)
+        starts, lengths = mask.runs()
+        # runs do not cross slices
+        nxy = x.shape[0]*x.shape[1]
+        assert np.all(starts // nxy == (starts + lengths - 1) // nxy)
+        assert SparseMask.from_runs(starts,lengths,x.shape,AFFINE) == mask
+        i, j, k = np.nonzero(x)
+        assert mask.bbox() == (slice(i.min(),i.max()+1),slice(j.min(),j.max()+1),slice(k.min(),k.max()+1))
+        assert list(mask.slices()) == sorted(set(k))
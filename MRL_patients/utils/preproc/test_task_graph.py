@@ -0,0 +1,60 @@
+# tests of the task graph: independent stages overlap and share the job budget, and a stage waits for the stages that
+# write its inputs
+#
+# Run from MRL_patients: python -m pytest utils/preproc/test_task_graph.py
+
+import time
+import threading
+from utils.preproc.task_graph import Task, TaskGraph
+
+class Recorder(object):
+    '''stage functions that record the jobs they were given and when they ran'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.spans = {}
+
+    def stage(self, name):
+        def run(jobs=1):
+            start = time.time()
+            time.sleep(0.2)
+            with self.lock:
+                self.jobs[name] = jobs
+                self.spans[name] = (start,time.time())
+        return run
+
+def overlap(a, b):
+    return (a[0] < b[1]) and (b[0] < a[1])
+
+def test_independent_tasks_share_jobs(tmp_path):
+    '''three ready tasks that each ask for the whole budget run at once, with a third of it each'''
+    rec = Recorder()
+    graph = TaskGraph()
+    for name in ['a','b','c']:
+        graph.add(Task(name,rec.stage(name),kwargs=dict(jobs=6),outputs=[str(tmp_path / name)]))
+    graph.run(['a','b','c'],jobs=6)
+    assert rec.jobs == {'a': 2, 'b': 2, 'c': 2}
+    assert overlap(rec.spans['a'],rec.spans['b']) and overlap(rec.spans['b'],rec.spans['c'])
+
+def test_jobs_are_never_exceeded(tmp_path):
+    '''with fewer jobs than ready tasks, the tasks that do not fit wait for a free job'''
+    rec = Recorder()
+    graph = TaskGraph()
+    for name in ['a','b','c']:
+        graph.add(Task(name,rec.stage(name),kwargs=dict(jobs=4),outputs=[str(tmp_path / name)]))
+    graph.run(['a','b','c'],jobs=2)
+    # jobs held by the tasks running when each task starts
+    held = [sum([rec.jobs[y] for y in rec.spans if rec.spans[y][0] <= rec.spans[x][0] < rec.spans[y][1]]) for x in rec.spans]
+    assert max(held) <= 2
+
+def test_task_waits_for_writers_of_its_inputs(tmp_path):
+    '''a task starts only after the tasks that write its inputs, and those run even if they were not requested'''
+    rec = Recorder()
+    graph = TaskGraph(stamp_dir=str(tmp_path / 'stamps'))
+    contours, seg = str(tmp_path / 'contours'), str(tmp_path / 'seg')
+    graph.add(Task('prop-contours',rec.stage('prop-contours'),outputs=[contours]))
+    graph.add(Task('do-bet',rec.stage('do-bet'),outputs=[seg]))
+    graph.add(Task('roi-stats',rec.stage('roi-stats'),inputs=[contours,seg],outputs=[str(tmp_path / 'roi_stats')]))
+    graph.run(['roi-stats'],jobs=4)
+    assert rec.spans['roi-stats'][0] >= max(rec.spans['prop-contours'][1],rec.spans['do-bet'][1])
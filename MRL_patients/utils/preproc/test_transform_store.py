@@ -0,0 +1,46 @@
+# tests of the transform store: composed matrices, stamps of unchanged matrices, and one store per folder
+#
+# Run from MRL_patients: python -m pytest utils/preproc/test_transform_store.py
+
+import os
+import numpy as np
+from utils.preproc.transform_store import get_transform_store
+from utils.preproc.fsl_matrix import write_fsl_matrix
+
+def translation(t):
+    matrix = np.eye(4)
+    matrix[:3,3] = t
+    return matrix
+
+def test_sessions_map_through_reference(tmp_path):
+    '''two sessions registered to one reference map onto each other, and a rewritten matrix is used at once'''
+    store = get_transform_store(str(tmp_path))
+    a_mat, b_mat = str(tmp_path / 'a.mat'), str(tmp_path / 'b.mat')
+    write_fsl_matrix(a_mat,translation([1.,0.,0.]))
+    write_fsl_matrix(b_mat,translation([0.,2.,0.]))
+    store.add('a.nii.gz','ref.nii.gz',a_mat)
+    store.add('b.nii.gz','ref.nii.gz',b_mat)
+    assert np.allclose(store.matrix('a.nii.gz','b.nii.gz'),translation([1.,-2.,0.]))
+
+    # rewritten by another process: the memoized matrix is not reused
+    write_fsl_matrix(a_mat,translation([3.,0.,0.]))
+    os.utime(a_mat,ns=(0,10**18))
+    assert np.allclose(store.matrix('a.nii.gz','b.nii.gz'),translation([3.,-2.,0.]))
+
+def test_unchanged_matrices_are_current(tmp_path):
+    store = get_transform_store(str(tmp_path))
+    a_mat = str(tmp_path / 'a.mat')
+    write_fsl_matrix(a_mat,np.eye(4))
+    assert not store.is_current('a.nii.gz','ref.nii.gz',a_mat)
+    store.add('a.nii.gz','ref.nii.gz',a_mat)
+    stamps = store.stamps()
+    assert store.is_current('a.nii.gz','ref.nii.gz',a_mat,stamps)
+    assert not store.is_current('a.nii.gz','other_ref.nii.gz',a_mat,stamps)
+    os.utime(a_mat,ns=(0,10**18))
+    assert not store.is_current('a.nii.gz','ref.nii.gz',a_mat,stamps)
+
+def test_one_store_per_folder(tmp_path, monkeypatch):
+    '''relative and absolute names of a folder give the same store'''
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('derivatives')
+    assert get_transform_store('derivatives') is get_transform_store(str(tmp_path / 'derivatives') + '/')
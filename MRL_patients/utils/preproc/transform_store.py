@@ -0,0 +1,148 @@
+# store of the transformations between image spaces, as a graph whose nodes are volumes and whose edges are FLIRT matrices
+
+import sqlite3
+import os
+import numpy as np
+import hashlib
+from collections import deque
+from os.path import join, dirname, isfile, getmtime, abspath
+from utils.preproc.fsl_matrix import read_fsl_matrix, write_fsl_matrix, concat_fsl_matrices, invert_fsl_matrix
+
+class TransformStore(object):
+    """
+    SQLite index of FLIRT matrices between volumes. Every edge can be followed in both directions, so any two
+    volumes connected through registrations (e.g. two sessions registered to the same reference) can be mapped
+    onto each other by composing edges, without a new registration.
+
+    Args:
+        db_fname (str): filename of database (e.g. <derivatives root>/transforms.sqlite)
+    """
+
+    def __init__(self, db_fname):
+        self.db_fname = db_fname
+        self.composed_dir = join(dirname(db_fname),'composed_transforms')
+        self.memo = {}
+        os.makedirs(dirname(db_fname),exist_ok=True)
+        with self.connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('CREATE TABLE IF NOT EXISTS edges (src TEXT, dst TEXT, matrix TEXT, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (src, dst))')
+            columns = [x[1] for x in con.execute('PRAGMA table_info(edges)').fetchall()]
+            for column in ['size','mtime_ns']:
+                if column not in columns:
+                    # stores made before matrices were stamped are rebuilt edge by edge as they are indexed again
+                    con.execute('ALTER TABLE edges ADD COLUMN %s INTEGER' %column)
+        con.close()
+
+    def __getstate__(self):
+        # memoized matrices are not sent to worker processes
+        state = self.__dict__.copy()
+        state['memo'] = {}
+        return state
+
+    def connect(self):
+        # connections are opened per call so that the store can be passed to worker processes
+        return sqlite3.connect(self.db_fname,timeout=60)
+
+    def add(self, src, dst, matrix_fname):
+        '''adds (or replaces) the matrix that maps volume src onto volume dst'''
+        stat = os.stat(matrix_fname)
+        con = self.connect()
+        with con:
+            con.execute('INSERT OR REPLACE INTO edges VALUES (?,?,?,?,?)',(abspath(src),abspath(dst),abspath(matrix_fname),stat.st_size,stat.st_mtime_ns))
+        con.close()
+        self.memo = {}
+
+    def stamps(self):
+        '''returns a dictionary {(src, dst): (matrix_fname, size, mtime_ns)} of the edges as they were added'''
+        con = self.connect()
+        rows = con.execute('SELECT src, dst, matrix, size, mtime_ns FROM edges').fetchall()
+        con.close()
+        return {(src,dst): (matrix_fname,size,mtime_ns) for src, dst, matrix_fname, size, mtime_ns in rows}
+
+    def is_current(self, src, dst, matrix_fname, stamps=None):
+        '''returns True if the edge from src to dst is this matrix file, unchanged (same size and modification time)
+        since it was added; stamps (see stamps()) can be given to check many edges with one query'''
+        if stamps is None:
+            stamps = self.stamps()
+        stat = os.stat(matrix_fname)
+        return stamps.get((abspath(src),abspath(dst))) == (abspath(matrix_fname),stat.st_size,stat.st_mtime_ns)
+
+    def edges(self):
+        '''returns a dictionary {src: [(dst, matrix_fname, inverted)]} of all edges in both directions'''
+        con = self.connect()
+        rows = con.execute('SELECT src, dst, matrix FROM edges').fetchall()
+        con.close()
+        graph = {}
+        for src, dst, matrix_fname in rows:
+            graph.setdefault(src,[]).append((dst,matrix_fname,False))
+            graph.setdefault(dst,[]).append((src,matrix_fname,True))
+        return graph
+
+    def path(self, src, dst):
+        '''returns the shortest list of edges (matrix_fname, inverted) from src to dst, or None if they are not connected'''
+        src, dst = abspath(src), abspath(dst)
+        if src == dst:
+            return []
+        graph = self.edges()
+        previous = {src: None}
+        queue = deque([src])
+        while queue:
+            node = queue.popleft()
+            for nxt, matrix_fname, inverted in graph.get(node,[]):
+                if nxt in previous:
+                    continue
+                previous[nxt] = (node,matrix_fname,inverted)
+                if nxt == dst:
+                    edges = []
+                    while previous[nxt] is not None:
+                        node, matrix_fname, inverted = previous[nxt]
+                        edges.insert(0,(matrix_fname,inverted))
+                        nxt = node
+                    return edges
+                queue.append(nxt)
+        return None
+
+    def matrix(self, src, dst):
+        '''returns the 4x4 FLIRT matrix from volume src to volume dst, composing edges as needed'''
+        edges = self.path(src,dst)
+        assert edges is not None, 'no transformation from %s to %s' %(src,dst)
+        # the store is shared within a process and matrices can be rewritten by other processes, so composed matrices
+        # are memoized with the modification times of the matrices they were composed from
+        key = (abspath(src),abspath(dst),tuple([(x,inverted,getmtime(x)) for x,inverted in edges]))
+        if key not in self.memo:
+            matrix = np.eye(4)
+            for matrix_fname, inverted in edges:
+                step = read_fsl_matrix(matrix_fname)
+                if inverted:
+                    step = invert_fsl_matrix(step)
+                matrix = concat_fsl_matrices(matrix,step)
+            self.memo[key] = matrix
+        return self.memo[key]
+
+    def matrix_file(self, src, dst):
+        '''returns a .mat file from volume src to volume dst: the registration output if there is a direct edge,
+        otherwise a composed matrix written under composed_transforms/ (rewritten if any matrix on the path changes)'''
+        edges = self.path(src,dst)
+        assert edges is not None, 'no transformation from %s to %s' %(src,dst)
+        if (len(edges) == 1) and (not edges[0][1]):
+            return edges[0][0]
+        key = [(x,inverted,getmtime(x)) for x,inverted in edges]
+        name = hashlib.sha1(('%s -> %s | %s' %(src,dst,key)).encode()).hexdigest()
+        fname = join(self.composed_dir,name + '.mat')
+        if not isfile(fname):
+            os.makedirs(self.composed_dir,exist_ok=True)
+            write_fsl_matrix(fname,self.matrix(src,dst))
+        return fname
+
+# transform stores opened in this process, by absolute root, so that memoized matrices are shared between callers
+_store_cache = {}
+
+def get_transform_store(root):
+    '''Returns the transform store of a derivatives folder (one per folder and process)
+    Parameters:
+        root: root of derivatives folder
+    '''
+    root = abspath(root)
+    if root not in _store_cache:
+        _store_cache[root] = TransformStore(join(root,'transforms.sqlite'))
+    return _store_cache[root]